@@ -5,5 +5,16 @@ import aws_cdk as cdk
 from part1.part1_stack import Part1Stack
 
 app = cdk.App()
-outbound_stack = Part1Stack(app, "part-1-stack")
+# PEM file with the public key of the key pair signing CloudFront media URLs
+media_public_key_file = app.node.try_get_context("media_public_key_file")
+media_public_key = None
+if media_public_key_file:
+    with open(media_public_key_file) as f:
+        media_public_key = f.read()
+outbound_stack = Part1Stack(
+    app,
+    "part-1-stack",
+    send_mode=app.node.try_get_context("send_mode") or "direct",
+    media_public_key=media_public_key,
+)
 app.synth()
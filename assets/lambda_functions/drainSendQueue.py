@@ -0,0 +1,113 @@
+import json
+import logging
+
+import audience
+import client_registry
+import dispatcher
+import http_pool
+import payload_cache
+import retry
+import send_queue
+import templates
+
+# Open the LINE API connection during the Lambda INIT phase
+http_pool.warm_up()
+
+
+def lambda_handler(event, context):
+    # Stop retrying in time to report what was not sent before the timeout
+    retry.set_deadline(context)
+    # Merge the recipients of queued jobs that share an identical message
+    groups = {}
+    jobs = {}
+    failed_message_ids = set()
+    for record in event["Records"]:
+        job = json.loads(record["body"])
+        jobs[record["messageId"]] = job
+        # Continue narrowcasts waiting for their audience or delivery
+        if "Stage" in job:
+            try:
+                audience.handle_stage(job)
+            except Exception:
+                logging.exception("Could not continue narrowcast %s", job)
+                failed_message_ids.add(record["messageId"])
+            continue
+        group = groups.setdefault(
+            send_queue.job_key(job), {"job": job, "recipients": {}, "endpoints": {}}
+        )
+        group["endpoints"].update(job.get("Endpoints") or {})
+        for recipient in job["Recipients"]:
+            group["recipients"].setdefault(recipient, []).append(record["messageId"])
+
+    # Send one multicast per 500 merged recipients and report the SQS messages
+    # of failed recipients so that only those are delivered again. The groups
+    # of very large campaigns are added to one uploaded audience per campaign
+    # and sent as one narrowcast instead, and personalized texts as one
+    # multicast per group of identical renderings
+    for group in groups.values():
+        job = group["job"]
+        if group["endpoints"]:
+            report = _send_personalized(job, group["endpoints"])
+        else:
+            try:
+                narrowcast = audience.add_recipients(
+                    job, list(group["recipients"]), send_queue.job_key(job)
+                )
+            except Exception:
+                logging.exception("Could not upload audience for %s", job["Kind"])
+                for message_ids in group["recipients"].values():
+                    failed_message_ids.update(message_ids)
+                continue
+            if narrowcast:
+                continue
+            try:
+                message = payload_cache.get_messages(job["Kind"], job)
+            except Exception:
+                logging.exception("Could not build %s message", job["Kind"])
+                for message_ids in group["recipients"].values():
+                    failed_message_ids.update(message_ids)
+                continue
+            report = dispatcher.send_campaign(
+                list(group["recipients"]), message, job["Data"], send_queue.job_key(job)
+            )
+        report.log()
+        failed_message_ids.update(_failed_messages(report, group, jobs))
+
+    client_registry.publish_stats()
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in sorted(failed_message_ids)
+        ]
+    }
+
+
+# SQS messages to report for the recipients of failed chunks. A chunk merges
+# recipients of several messages and is merged differently when they are
+# delivered again, so its retry key would change. Messages with recipients in
+# succeeded chunks are therefore queued again for their failed recipients only
+def _failed_messages(report, group, jobs):
+    failed_recipients = {}
+    for chunk in report.failed:
+        for recipient in chunk.recipients:
+            for message_id in group["recipients"][recipient]:
+                failed_recipients.setdefault(message_id, set()).add(recipient)
+    failed_message_ids = set()
+    for message_id, recipients in failed_recipients.items():
+        job = jobs[message_id]
+        if recipients != set(job["Recipients"]):
+            try:
+                send_queue.requeue(job, sorted(recipients))
+                continue
+            except Exception:
+                logging.exception("Could not queue failed recipients again")
+        failed_message_ids.add(message_id)
+    return failed_message_ids
+
+
+# Send one multicast per group of merged endpoints with the same rendered text
+def _send_personalized(job, endpoints):
+    campaign_key = send_queue.job_key(job)
+    return dispatcher.send_groups(
+        templates.render_groups(endpoints, job["Data"], campaign_key),
+        campaign_key=campaign_key,
+    )
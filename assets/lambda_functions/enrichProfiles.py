@@ -0,0 +1,62 @@
+import json
+import logging
+
+from linebot.exceptions import LineBotApiError
+
+import client_registry
+import http_pool
+import pinpoint_endpoints
+import profile_cache
+import profile_enrichment
+import secret_cache
+
+# Open the LINE API connection during the Lambda INIT phase
+http_pool.warm_up()
+
+
+def lambda_handler(event, context):
+    # Merge the lookups queued for the same user, keeping the latest follow
+    followers = {}
+    message_ids = {}
+    for record in event["Records"]:
+        job = json.loads(record["body"])
+        followers[job["UserId"]] = max(
+            job["FollowedAt"], followers.get(job["UserId"], 0)
+        )
+        message_ids.setdefault(job["UserId"], []).append(record["messageId"])
+
+    # Users who unfollowed since no longer have an endpoint to enrich
+    unfollows = profile_cache.get_unfollows(list(followers))
+    user_ids = [
+        user_id
+        for user_id, followed_at in followers.items()
+        if unfollows.get(user_id, -1) < followed_at
+    ]
+
+    # Profiles are fetched within the profile rate limit shared by all functions
+    profiles, errors = profile_cache.get_profiles(user_ids)
+    failed_user_ids = []
+    for user_id, error in errors.items():
+        if isinstance(error, LineBotApiError) and error.status_code == 401:
+            secret_cache.invalidate()
+        # LINE has no profile for users who blocked the channel in the meantime
+        if isinstance(error, LineBotApiError) and error.status_code == 404:
+            continue
+        logging.error("Could not get the profile of %s: %r", user_id, error)
+        failed_user_ids.append(user_id)
+
+    endpoint_batch = pinpoint_endpoints.EndpointBatch()
+    for user_id, profile in profiles.items():
+        endpoint_batch.add(
+            user_id, profile_enrichment.endpoint_request(user_id, profile)
+        )
+    failed_user_ids += endpoint_batch.flush()
+    endpoint_batch.publish()
+    client_registry.publish_stats()
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id}
+            for user_id in failed_user_ids
+            for message_id in message_ids[user_id]
+        ]
+    }
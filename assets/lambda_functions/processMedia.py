@@ -0,0 +1,219 @@
+import io
+import json
+import logging
+import os
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import audio_metadata
+import client_registry
+import media_derivatives
+import metrics
+
+
+def lambda_handler(event, context):
+    s3 = client_registry.get_aws_client("s3")
+    processed = 0
+    violations = 0
+    for record in event["Records"]:
+        bucket = record["s3"]["bucket"]["name"]
+        key = unquote_plus(record["s3"]["object"]["key"])
+        # Skip the files written here and the server access logs
+        if media_derivatives.is_derived(key) or key.startswith("access-logs"):
+            continue
+        size = record["s3"]["object"].get("size", 0)
+        if media_derivatives.is_video(key):
+            manifest = process_video(s3, bucket, key, size)
+        elif media_derivatives.is_audio(key):
+            manifest = process_audio(s3, bucket, key, size)
+        elif media_derivatives.is_imagemap(key):
+            manifest = process_imagemap(s3, bucket, key)
+        else:
+            manifest = process_image(s3, bucket, key)
+            _attach_cover(s3, bucket, key)
+        manifest.update(key=key, size=size)
+        # Senders load the manifest instead of looking for each derived file
+        media_derivatives.write_manifest(s3, bucket, key, manifest)
+        if manifest["problems"]:
+            violations += 1
+            logging.warning(
+                json.dumps(
+                    {"bucket": bucket, "key": key, "problems": manifest["problems"]}
+                )
+            )
+        processed += 1
+    metrics.put_metrics(
+        {"MediaProcessed": processed, "MediaLimitViolations": violations}
+    )
+    return {"processed": processed, "violations": violations}
+
+
+# Check the size of an uploaded video and record the image next to it with
+# the same name as its cover
+def process_video(s3, bucket, key, size):
+    problems = []
+    if size > media_derivatives.MAX_VIDEO_BYTES:
+        problems.append("video is larger than 200 MB")
+    return {
+        "kind": "video",
+        "original": key,
+        "cover": _find_cover(s3, bucket, key),
+        "problems": problems,
+    }
+
+
+# Check the size of an uploaded audio file and record its duration
+def process_audio(s3, bucket, key, size):
+    problems = []
+    if size > media_derivatives.MAX_AUDIO_BYTES:
+        problems.append("audio is larger than 200 MB")
+    duration = audio_metadata.get_duration_ms(s3, bucket, key)
+    if duration is None:
+        problems.append("duration could not be read")
+    return {
+        "kind": "audio",
+        "original": key,
+        "duration_ms": duration,
+        "problems": problems,
+    }
+
+
+# Write a preview of an uploaded image, and a JPEG copy of the image when it
+# breaks the LINE format or size limits
+def process_image(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    image, problem = _open_image(body)
+    if image is None:
+        return {"kind": "image", "original": key, "problems": [problem]}
+    problems = check_image(image.format, len(body))
+    image = _as_rgb(ImageOps.exif_transpose(image))
+    original = key
+    if problems:
+        original = media_derivatives.original_key(key)
+        _put_jpeg(s3, bucket, original, image, media_derivatives.MAX_IMAGE_BYTES)
+    preview = image.copy()
+    preview.thumbnail(media_derivatives.PREVIEW_SIZE)
+    _put_jpeg(
+        s3,
+        bucket,
+        media_derivatives.preview_key(key),
+        preview,
+        media_derivatives.MAX_PREVIEW_BYTES,
+    )
+    return {
+        "kind": "image",
+        "original": original,
+        "preview": media_derivatives.preview_key(key),
+        "width": image.width,
+        "height": image.height,
+        "problems": problems,
+    }
+
+
+# Write the tiles of an imagemap in every width LINE asks for, as
+# <base>/<width> objects that the imagemap base URL points at
+def process_imagemap(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    image, problem = _open_image(body)
+    if image is None:
+        return {"kind": "imagemap", "original": key, "problems": [problem]}
+    image = _as_rgb(ImageOps.exif_transpose(image))
+    base = media_derivatives.imagemap_base_key(key)
+    for width in media_derivatives.IMAGEMAP_WIDTHS:
+        height = round(image.height * width / image.width)
+        _put_jpeg(
+            s3,
+            bucket,
+            "{}/{}".format(base, width),
+            image.resize((width, height), Image.LANCZOS),
+            media_derivatives.MAX_IMAGE_BYTES,
+        )
+    problems = []
+    if image.width < media_derivatives.IMAGEMAP_BASE_WIDTH:
+        problems.append("imagemap is narrower than 1040 pixels and was upscaled")
+    base_width = media_derivatives.IMAGEMAP_BASE_WIDTH
+    return {
+        "kind": "imagemap",
+        "original": key,
+        "base": base,
+        "base_width": base_width,
+        "base_height": round(image.height * base_width / image.width),
+        "problems": problems,
+    }
+
+
+# Decode an image, returning it or the problem that kept it from being read,
+# e.g. a file that is not an image, is truncated or has so many pixels that
+# decoding it would exhaust the function memory
+def _open_image(body):
+    try:
+        image = Image.open(io.BytesIO(body))
+        image.load()
+    except UnidentifiedImageError:
+        return None, "not an image"
+    except Image.DecompressionBombError:
+        return None, "image has too many pixels"
+    except (OSError, SyntaxError, ValueError) as e:
+        return None, "image could not be read: {}".format(e)
+    return image, None
+
+
+def check_image(image_format, size):
+    problems = []
+    if image_format not in media_derivatives.IMAGE_FORMATS:
+        problems.append("{} is not JPEG or PNG".format(image_format))
+    if size > media_derivatives.MAX_IMAGE_BYTES:
+        problems.append("image is larger than 10 MB")
+    return problems
+
+
+def _find_cover(s3, bucket, key):
+    stem = os.path.splitext(key)[0]
+    for extension in media_derivatives.COVER_EXTENSIONS:
+        try:
+            s3.head_object(Bucket=bucket, Key=stem + extension)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                continue
+            raise
+        return stem + extension
+    return None
+
+
+# Record an image as the cover of the video with the same name, when the
+# video was processed before the image was uploaded
+def _attach_cover(s3, bucket, key):
+    stem, extension = os.path.splitext(key)
+    if extension.lower() not in media_derivatives.COVER_EXTENSIONS:
+        return
+    for video_extension in media_derivatives.VIDEO_EXTENSIONS:
+        video_key = stem + video_extension
+        manifest = media_derivatives.read_manifest(s3, bucket, video_key)
+        if manifest is not None and not manifest.get("cover"):
+            manifest["cover"] = key
+            media_derivatives.write_manifest(s3, bucket, video_key, manifest)
+
+
+# Flatten transparency onto a white background, as JPEG has no alpha channel
+def _as_rgb(image):
+    if image.mode == "RGB":
+        return image
+    image = image.convert("RGBA")
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+
+# Encode as JPEG, halving the dimensions until the file fits max_bytes
+def _put_jpeg(s3, bucket, key, image, max_bytes):
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85, optimize=True)
+        if buffer.tell() <= max_bytes or min(image.size) <= 1:
+            break
+        image = image.resize((max(1, image.width // 2), max(1, image.height // 2)))
+    s3.put_object(
+        Bucket=bucket, Key=key, Body=buffer.getvalue(), ContentType="image/jpeg"
+    )
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+
+from botocore.exceptions import ClientError
+from linebot.models import FollowEvent, UnfollowEvent
+
+import client_registry
+import idempotency
+import metrics
+import pinpoint_endpoints
+import profile_cache
+import profile_enrichment
+
+# LINE redelivers webhook events for a while after a failed delivery, and the
+# IDs of handled events are kept for a day to drop those redeliveries
+DEFAULT_EVENT_TTL_SECONDS = 24 * 3600
+# Events are claimed for this long while they are handled: longer than the
+# function timeout, and shorter than the visibility timeout of the queue so
+# that the events of a crashed invocation are not dropped when SQS retries
+IN_PROGRESS_SECONDS = 2 * 60
+
+
+def _get_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def lambda_handler(event, context):
+    # Keys of the events claimed by this invocation, by SQS message ID
+    claimed_keys = {}
+    try:
+        failed_message_ids = handle_records(event["Records"], claimed_keys)
+    except BaseException:
+        # None of the events is known to be done, so they are all handled again
+        for key in claimed_keys.values():
+            idempotency.release(key)
+        raise
+    # Events that are handled again must not be dropped as duplicates
+    ttl_seconds = _get_int("webhook_event_ttl_seconds", DEFAULT_EVENT_TTL_SECONDS)
+    for message_id, key in claimed_keys.items():
+        if message_id in failed_message_ids:
+            idempotency.release(key)
+        else:
+            idempotency.complete(key, ttl_seconds)
+    client_registry.publish_stats()
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in failed_message_ids
+        ]
+    }
+
+
+# Handle the events of a batch and return the SQS message IDs of those that
+# failed, in order
+def handle_records(sqs_records, claimed_keys):
+    # Endpoint updates of the batch, written together once it is handled
+    endpoint_batch = pinpoint_endpoints.EndpointBatch()
+    failed_message_ids = set()
+    failed_groups = set()
+    endpoint_message_ids = {}
+    duplicates = 0
+    redeliveries = 0
+    # Followers whose profile is not cached yet, with the time they followed
+    followers = {}
+    records = []
+    for record in sqs_records:
+        data = json.loads(record["body"])
+        if (data.get("deliveryContext") or {}).get("isRedelivery"):
+            redeliveries += 1
+        # Drop events handled before, e.g. redelivered after a LINE timeout,
+        # before making any other call for them
+        if data.get("webhookEventId"):
+            key = "webhook:" + data["webhookEventId"]
+            if not idempotency.claim_recent(key, IN_PROGRESS_SECONDS):
+                duplicates += 1
+                continue
+            claimed_keys[record["messageId"]] = key
+        records.append((record, data))
+    # The profiles are only taken from the cache, the endpoints of the other
+    # followers are written without a display name and enriched later
+    profiles, _ = profile_cache.get_profiles(
+        [data["source"]["userId"] for _, data in records if data["type"] == "follow"],
+        fetch=False,
+    )
+    for record, data in records:
+        # Events after a failed one of the same user wait for it to be retried
+        group_id = record["attributes"].get("MessageGroupId")
+        if group_id in failed_groups:
+            failed_message_ids.add(record["messageId"])
+            continue
+        try:
+            endpoint_id = handle_event(data, endpoint_batch, profiles, followers)
+        except Exception:
+            logging.exception("Could not handle webhook event %s", record["body"])
+            failed_message_ids.add(record["messageId"])
+            failed_groups.add(group_id)
+            continue
+        if endpoint_id is not None:
+            endpoint_message_ids.setdefault(endpoint_id, []).append(record["messageId"])
+    failed_endpoint_ids = endpoint_batch.flush()
+    for endpoint_id in failed_endpoint_ids:
+        followers.pop(endpoint_id, None)
+    # Followers that could not be queued for enrichment are followed again
+    failed_endpoint_ids += profile_enrichment.enqueue(followers)
+    for endpoint_id in failed_endpoint_ids:
+        failed_message_ids.update(endpoint_message_ids.get(endpoint_id, []))
+    endpoint_batch.publish()
+    metrics.put_metrics(
+        {
+            "WebhookEvents": len(sqs_records),
+            "WebhookRedeliveries": redeliveries,
+            "WebhookDuplicates": duplicates,
+        }
+    )
+    return _keep_order(sqs_records, failed_message_ids)
+
+
+# Handle a LINE webhook event and return the ID of the endpoint it queued an
+# update for, if any
+def handle_event(data, endpoint_batch, profiles, followers):
+    if data["type"] == "follow":
+        return handle_follow(
+            FollowEvent.new_from_json_dict(data), endpoint_batch, profiles, followers
+        )
+    if data["type"] == "unfollow":
+        handle_unfollow(
+            UnfollowEvent.new_from_json_dict(data), endpoint_batch, followers
+        )
+    return None
+
+
+# Add the user to the Pinpoint endpoints, with the display name when the
+# profile is cached and otherwise queue the profile lookup
+def handle_follow(event, endpoint_batch, profiles, followers):
+    user_id = event.source.user_id
+    user = {"UserId": user_id}
+    if user_id in profiles:
+        user["UserAttributes"] = {"DisplayName": [profiles[user_id].display_name]}
+        followers.pop(user_id, None)
+    else:
+        followers[user_id] = event.timestamp
+    endpoint_batch.add(
+        user_id,
+        {
+            "Address": user_id,
+            "ChannelType": "CUSTOM",
+            "OptOut": "NONE",
+            "User": user,
+        },
+    )
+    return user_id
+
+
+# Delete the endpoint of the user
+def handle_unfollow(event, endpoint_batch, followers):
+    user_id = event.source.user_id
+    # A follow earlier in the same batch must not recreate the endpoint
+    endpoint_batch.discard(user_id)
+    followers.pop(user_id, None)
+    # Profile lookups queued before must not recreate it either
+    profile_cache.record_unfollow(user_id, event.timestamp)
+    try:
+        client_registry.get_aws_client("pinpoint").delete_endpoint(
+            ApplicationId=endpoint_batch.application_id, EndpointId=user_id
+        )
+    except ClientError as e:
+        # Already deleted, e.g. when the event is handled again
+        if e.response["Error"]["Code"] != "NotFoundException":
+            raise
+
+
+# The events after a failed one in the same message group are reported as
+# failed too, so they are handled again after it and each user's events stay
+# in order
+def _keep_order(records, failed_message_ids):
+    failed_groups = set()
+    result = []
+    for record in records:
+        group_id = record["attributes"].get("MessageGroupId")
+        if record["messageId"] in failed_message_ids or group_id in failed_groups:
+            failed_groups.add(group_id)
+            result.append(record["messageId"])
+    return result
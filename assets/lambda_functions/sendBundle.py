@@ -0,0 +1,44 @@
+import logging
+from botocore.exceptions import ClientError
+
+import client_registry
+import dispatcher
+import http_pool
+import payload_cache
+import retry
+import send_queue
+
+# Open the LINE API connection during the Lambda INIT phase
+if not send_queue.is_queued():
+    http_pool.warm_up()
+
+
+def lambda_handler(event, context):
+    # Stop retrying in time to report what was not sent before the timeout
+    retry.set_deadline(context)
+    # Hand the recipients over to the send queue worker when it is enabled
+    if send_queue.is_queued():
+        try:
+            send_queue.enqueue("bundle", event)
+        except (KeyError, ValueError, ClientError) as e:
+            logging.error("Invalid campaign payload: %r", e)
+            return None
+        return "Line bundle Campaign successfully queued"
+    # Build up to 5 messages, in order, from the message specs passed by user,
+    # or reuse the ones built by an earlier invocation of the campaign
+    try:
+        messages = payload_cache.get_messages("bundle", event)
+    except (KeyError, ValueError, ClientError) as e:
+        logging.error("Invalid campaign payload: %r", e)
+        return None
+    # Send all messages of the bundle together, in one request per chunk of up
+    # to 500 users, or as one broadcast when the campaign targets every follower
+    report = dispatcher.send_campaign(
+        dispatcher.get_recipients(event),
+        messages,
+        event.get("Data"),
+        dispatcher.campaign_key("bundle", event),
+    )
+    report.log()
+    client_registry.publish_stats()
+    return "Line bundle Campaign successfully ran"
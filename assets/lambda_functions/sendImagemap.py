@@ -0,0 +1,44 @@
+import logging
+from botocore.exceptions import ClientError
+
+import client_registry
+import dispatcher
+import http_pool
+import payload_cache
+import retry
+import send_queue
+
+# Open the LINE API connection during the Lambda INIT phase
+if not send_queue.is_queued():
+    http_pool.warm_up()
+
+
+def lambda_handler(event, context):
+    # Stop retrying in time to report what was not sent before the timeout
+    retry.set_deadline(context)
+    # Hand the recipients over to the send queue worker when it is enabled
+    if send_queue.is_queued():
+        try:
+            send_queue.enqueue("imagemap", event)
+        except (KeyError, ValueError, ClientError) as e:
+            logging.error("Invalid campaign payload: %r", e)
+            return None
+        return "Line imagemap Campaign successfully queued"
+    # Build Message from the custom data passed by user, pointing at the
+    # precomputed tiles, or reuse the one built by an earlier invocation
+    try:
+        imagemap_message = payload_cache.get_messages("imagemap", event)
+    except (KeyError, ValueError, ClientError) as e:
+        logging.error("Invalid campaign payload: %r", e)
+        return None
+    # Send Message to all endpoints, in chunks of up to 500 users, or as one
+    # broadcast when the campaign targets every follower
+    report = dispatcher.send_campaign(
+        dispatcher.get_recipients(event),
+        imagemap_message,
+        event.get("Data"),
+        dispatcher.campaign_key("imagemap", event),
+    )
+    report.log()
+    client_registry.publish_stats()
+    return "Line imagemap Campaign successfully ran"
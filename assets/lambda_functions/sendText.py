@@ -1,60 +1,51 @@
-import boto3
-import json
-import os
+import logging
 from botocore.exceptions import ClientError
 
-from linebot import (
-    LineBotApi,
-    exceptions
-)
-from linebot.models import TextSendMessage
+import client_registry
+import dispatcher
+import http_pool
+import payload_cache
+import retry
+import send_queue
+import templates
 
-cloudwatch = boto3.client('cloudwatch')
+# Open the LINE API connection during the Lambda INIT phase
+if not send_queue.is_queued():
+    http_pool.warm_up()
 
-def lambda_handler(event, context):
-    # Get Line Secrets from Secrets Manager
-    secret = get_secret()
-    line_bot_api = LineBotApi(secret["YOUR_CHANNEL_ACCESS_TOKEN"])
-    line_user_ids = []
-    # Check whether custom data is passed by user
-    if event.get("Data") is not None:
-        custom_message = event["Data"]
-    else:
-        custom_message = "Hello, congratulations! You are eligible for a 15% off on hotel bookings and car rental. Chat with us to find out more!"
-    # Build Message
-    text_message = TextSendMessage(text=custom_message)
-    # Loop through all endpoints for lists of users
-    for key in event['Endpoints'].keys():
-        line_user_ids.append(event['Endpoints'][key]['Address'])
-    # Send Message
-    try:
-        line_bot_api.multicast(line_user_ids, text_message)
-    except exceptions as e:
-        print(e.status_code)
-        print(e.request_id)
-        print(e.error.message)
-        print(e.error.details)
-    return "Line Text Campaign successfully ran"
-        
-def get_secret():
-
-    secret_arn = os.getenv("secret_arn")
-    region_name = os.getenv("secret_region")
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_arn
+def lambda_handler(event, context):
+    # Stop retrying in time to report what was not sent before the timeout
+    retry.set_deadline(context)
+    # Hand the recipients over to the send queue worker when it is enabled
+    if send_queue.is_queued():
+        try:
+            send_queue.enqueue("text", event)
+        except (KeyError, ValueError, ClientError) as e:
+            logging.error("Invalid campaign payload: %r", e)
+            return None
+        return "Line Text Campaign successfully queued"
+    campaign_key = dispatcher.campaign_key("text", event)
+    # Render personalized or localized text for every endpoint and send one
+    # multicast per group of recipients with the same rendered text
+    if templates.is_personalized(event.get("Data")):
+        report = dispatcher.send_groups(
+            templates.render_groups(
+                event["Endpoints"], event.get("Data"), campaign_key
+            ),
+            campaign_key=campaign_key,
         )
-    except ClientError as e:
-        raise e
-
-    # Decrypts secret using the associated KMS key and return a dict
-    secret = json.loads(get_secret_value_response['SecretString'])
-    return(secret)
\ No newline at end of file
+        report.log()
+        client_registry.publish_stats()
+        return "Line Text Campaign successfully ran"
+    # Build Message from the custom data passed by user, or reuse the one
+    # built by an earlier invocation of the campaign
+    text_message = payload_cache.get_messages("text", event)
+    # Send Message to all endpoints, in chunks of up to 500 users, or as one
+    # broadcast when the campaign targets every follower
+    report = dispatcher.send_campaign(
+        dispatcher.get_recipients(event), text_message, event.get("Data"), campaign_key
+    )
+    report.log()
+    client_registry.publish_stats()
+    return "Line Text Campaign successfully ran"
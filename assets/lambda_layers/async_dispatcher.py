@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import logging
+import os
+import uuid
+
+import aiohttp
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import LineBotApiError
+
+import client_registry
+import dispatcher
+import http_pool
+import payload_cache
+import rate_limiter
+import retry
+import secret_cache
+
+DEFAULT_CONCURRENCY = 16
+
+# The event loop and its aiohttp session are kept across invocations, so the
+# connections to the LINE API stay open like in the threaded path
+_loop = None
+_session = None
+
+
+def get_concurrency():
+    try:
+        return max(1, int(os.getenv("dispatch_max_concurrency", DEFAULT_CONCURRENCY)))
+    except ValueError:
+        return DEFAULT_CONCURRENCY
+
+
+# AsyncLineBotApi counterpart of line_client.LineClient: rate limited, retried
+# and with the X-Line-Retry-Key passed per request
+class AsyncLineClient(AsyncLineBotApi):
+    async def push_message(
+        self, to, messages, retry_key=None, notification_disabled=False, timeout=None
+    ):
+        data = {
+            "to": to,
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        await self._send("push", "/v2/bot/message/push", data, retry_key, timeout)
+
+    async def multicast(
+        self, to, messages, retry_key=None, notification_disabled=False, timeout=None
+    ):
+        data = {
+            "to": to,
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        await self._send(
+            "multicast", "/v2/bot/message/multicast", data, retry_key, timeout
+        )
+
+    async def _send(self, endpoint_class, path, data, retry_key, timeout):
+        retry_key = retry_key or str(uuid.uuid4())
+        body = payload_cache.encode_body(data)
+
+        async def call():
+            # The limiter blocks on DynamoDB, so keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    rate_limiter.acquire,
+                    endpoint_class,
+                    timeout=retry.time_left(rate_limiter.DEFAULT_TIMEOUT_SECONDS),
+                ),
+            )
+            headers = {
+                "Content-Type": "application/json",
+                "X-Line-Retry-Key": retry_key,
+            }
+            response = await self._post(
+                path, data=body, headers=headers, timeout=timeout
+            )
+            # aiohttp closes connections released before their body is read, so
+            # read the short body to keep the connection open for the next one
+            await response.response.read()
+            return response
+
+        try:
+            response = await retry.call_with_retry_async(call)
+        except LineBotApiError as e:
+            if not retry.is_already_accepted(e):
+                raise
+            logging.info(
+                "Request %s was already accepted as %s",
+                retry_key,
+                e.accepted_request_id,
+            )
+            return e.accepted_request_id
+        return response.headers.get("X-Line-Request-Id")
+
+
+# Send dispatcher tasks like the threaded path, but with one coroutine per
+# task and at most max_concurrency requests in flight
+def send_tasks(tasks, max_concurrency=None):
+    # Secrets Manager is called with boto3, which would block the event loop
+    secret = secret_cache.get_secret()
+    return _get_loop().run_until_complete(
+        _send_tasks(tasks, max_concurrency or get_concurrency(), secret)
+    )
+
+
+async def _send_tasks(tasks, max_concurrency, secret):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(
+        *[_send_chunk(semaphore, task, secret) for task in tasks]
+    )
+    report = dispatcher.DispatchReport()
+    for result in results:
+        if result.error is None:
+            report.succeeded.append(result)
+        else:
+            report.failed.append(result)
+    return report
+
+
+async def _send_chunk(semaphore, task, secret):
+    async with semaphore:
+        try:
+            try:
+                line_bot_api = await _get_line_bot_api(secret)
+                await _send_task(line_bot_api, task)
+            except LineBotApiError as e:
+                if e.status_code != 401:
+                    raise
+                # Same refresh on rotated credentials as secret_cache.call_with_secret
+                secret = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: secret_cache.get_secret(force_refresh=True)
+                )
+                line_bot_api = await _get_line_bot_api(secret)
+                await _send_task(line_bot_api, task)
+        except Exception as e:
+            return dispatcher.ChunkResult(
+                task.index, task.recipients, dispatcher.describe_error(e)
+            )
+    return dispatcher.ChunkResult(task.index, task.recipients)
+
+
+# Coroutine version of dispatcher.send_task
+async def _send_task(line_bot_api, task):
+    if len(task.recipients) == 1:
+        await line_bot_api.push_message(
+            task.recipients[0], task.messages, retry_key=task.retry_key
+        )
+    else:
+        await line_bot_api.multicast(
+            task.recipients, task.messages, retry_key=task.retry_key
+        )
+
+
+async def _get_line_bot_api(secret):
+    session = await _get_session()
+    token = secret["YOUR_CHANNEL_ACCESS_TOKEN"]
+    connect_timeout, read_timeout = http_pool.get_timeout()
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=connect_timeout, sock_read=read_timeout
+    )
+    return client_registry.get_client(
+        "async_line_bot_api",
+        client_registry.fingerprint(token),
+        lambda: AsyncLineClient(
+            token, AiohttpAsyncHttpClient(session, timeout=timeout)
+        ),
+    )
+
+
+async def _get_session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=get_concurrency(), keepalive_timeout=60
+            )
+        )
+    return _session
+
+
+def _get_loop():
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop
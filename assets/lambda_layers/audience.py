@@ -0,0 +1,333 @@
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+from linebot.models import AudienceRecipient
+
+import client_registry
+import message_builders
+import metrics
+import rate_limiter
+import retry
+import secret_cache
+
+# LINE accepts at most 10,000 user IDs per audience upload request
+MAX_AUDIENCES_PER_UPLOAD = 10000
+# Seconds between two progress checks of an audience or a narrowcast
+POLL_DELAY_SECONDS = 60
+# The audience group of a campaign is tracked in the idempotency_table for as
+# long as its invocations can be redelivered by the send queue
+CAMPAIGN_TTL_SECONDS = 2 * 24 * 3600
+
+
+# Recipient count of a campaign from which its merged send jobs go through
+# one uploaded audience and one narrowcast instead of multicasts. 0 disables
+# narrowcasts. Progress is polled through the send queue, so it needs a
+# queued send_mode
+def get_threshold():
+    try:
+        return int(os.getenv("narrowcast_threshold", 0))
+    except ValueError:
+        return 0
+
+
+def is_enabled():
+    return (
+        get_threshold() > 0
+        and bool(os.getenv("send_queue_url"))
+        and bool(os.getenv("idempotency_table"))
+    )
+
+
+# Hand the recipients of a merged send job over to the one audience group of
+# its campaign, which is narrowcast once no recipients were added to it for
+# POLL_DELAY_SECONDS. The recipients of every drain batch of the campaign are
+# counted, and the audience group is created once the count reaches the
+# threshold. Returns False when the recipients are to be sent as multicasts
+# instead: below the threshold, while another function creates the audience
+# group and after its narrowcast was sent
+def add_recipients(job, recipients, campaign_key):
+    if not is_enabled():
+        return False
+    table_name = os.getenv("idempotency_table")
+    key = {"pk": {"S": "audience:" + campaign_key}}
+    dynamodb = client_registry.get_aws_client("dynamodb")
+    item = _update_campaign(
+        dynamodb,
+        table_name,
+        key,
+        "ADD recipient_count :count"
+        " SET expires_at = if_not_exists(expires_at, :expires_at)",
+        {
+            ":count": {"N": str(len(recipients))},
+            ":expires_at": {"N": str(int(time.time()) + CAMPAIGN_TTL_SECONDS)},
+        },
+    )
+    if item is None:
+        return False
+    if "audience_group_id" in item:
+        return _add_to_audience(
+            dynamodb, table_name, key, int(item["audience_group_id"]["N"]), recipients
+        )
+    if int(item["recipient_count"]["N"]) < get_threshold():
+        return False
+    # Only one function creates the audience group of a campaign
+    if _update_campaign(
+        dynamodb,
+        table_name,
+        key,
+        "SET creating = :true",
+        {":true": {"BOOL": True}},
+        condition="attribute_not_exists(creating)",
+    ):
+        _create_audience(dynamodb, table_name, key, job, recipients, campaign_key)
+        return True
+    return False
+
+
+def _create_audience(dynamodb, table_name, key, job, recipients, campaign_key):
+    line_bot_api = client_registry.get_line_bot_api()
+    chunks = _chunks(recipients)
+    try:
+        audience_group = _call_audience_api(
+            lambda: line_bot_api.create_audience_group(
+                "pinpoint-{}".format(retry.retry_key(campaign_key)),
+                audiences=[{"id": user_id} for user_id in chunks[0]],
+            )
+        )
+    except Exception:
+        # Let the next drain batch of the campaign try again
+        _update_campaign(dynamodb, table_name, key, "REMOVE creating")
+        raise
+    audience_group_id = audience_group.audience_group_id
+    try:
+        for chunk in chunks[1:]:
+            _upload(line_bot_api, audience_group_id, chunk)
+        _update_campaign(
+            dynamodb,
+            table_name,
+            key,
+            "SET audience_group_id = :id, updated_at = :now",
+            {":id": {"N": str(audience_group_id)}, ":now": _now()},
+        )
+        _queue_stage(
+            {
+                "Stage": "audience",
+                "Kind": job["Kind"],
+                "Data": job["Data"],
+                "CampaignKey": campaign_key,
+                "AudienceGroupId": audience_group_id,
+            }
+        )
+    except Exception:
+        # The recipients are reported failed and added again on redelivery, so
+        # the audience group would never be used
+        _delete_audience(line_bot_api, audience_group_id)
+        _update_campaign(dynamodb, table_name, key, "REMOVE creating")
+        raise
+    logging.info(
+        "Uploaded %d recipients to audience group %s",
+        len(recipients),
+        audience_group_id,
+    )
+
+
+# Add recipients to the audience group of a campaign unless its narrowcast
+# was sent, counting the uploads in flight so that it is not sent before they
+# have finished
+def _add_to_audience(dynamodb, table_name, key, audience_group_id, recipients):
+    if not _update_campaign(
+        dynamodb,
+        table_name,
+        key,
+        "ADD uploads :one SET updated_at = :now",
+        {":one": {"N": "1"}, ":now": _now()},
+    ):
+        return False
+    try:
+        line_bot_api = client_registry.get_line_bot_api()
+        for chunk in _chunks(recipients):
+            _upload(line_bot_api, audience_group_id, chunk)
+    finally:
+        _update_campaign(
+            dynamodb,
+            table_name,
+            key,
+            "ADD uploads :minus_one SET updated_at = :now",
+            {":minus_one": {"N": "-1"}, ":now": _now()},
+            condition=None,
+        )
+    logging.info(
+        "Added %d recipients to audience group %s", len(recipients), audience_group_id
+    )
+    return True
+
+
+# Update the campaign item and return it, or None when the condition, by
+# default that its narrowcast was not sent yet, does not hold
+def _update_campaign(
+    dynamodb,
+    table_name,
+    key,
+    update_expression,
+    values=None,
+    condition="attribute_not_exists(closed)",
+):
+    request = {
+        "TableName": table_name,
+        "Key": key,
+        "UpdateExpression": update_expression,
+        "ReturnValues": "ALL_NEW",
+    }
+    if values:
+        request["ExpressionAttributeValues"] = values
+    if condition:
+        request["ConditionExpression"] = condition
+    try:
+        return dynamodb.update_item(**request)["Attributes"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return None
+        raise
+
+
+def _chunks(recipients):
+    return [
+        recipients[i : i + MAX_AUDIENCES_PER_UPLOAD]
+        for i in range(0, len(recipients), MAX_AUDIENCES_PER_UPLOAD)
+    ]
+
+
+def _upload(line_bot_api, audience_group_id, recipients):
+    _call_audience_api(
+        lambda: line_bot_api.add_audiences_to_audience_group(
+            audience_group_id, [{"id": user_id} for user_id in recipients]
+        )
+    )
+
+
+# Audience calls share the audience rate limit of all functions
+def _call_audience_api(func):
+    def call():
+        rate_limiter.acquire(
+            "audience", timeout=retry.time_left(rate_limiter.DEFAULT_TIMEOUT_SECONDS)
+        )
+        return func()
+
+    return retry.call_with_retry(call)
+
+
+def _delete_audience(line_bot_api, audience_group_id):
+    try:
+        _call_audience_api(
+            lambda: line_bot_api.delete_audience_group(audience_group_id)
+        )
+    except Exception:
+        logging.exception("Could not delete audience group %s", audience_group_id)
+
+
+def _now():
+    return {"N": str(int(time.time()))}
+
+
+# Continue a narrowcast queued by add_recipients: close the audience group of
+# the campaign once no recipients are being added, send the narrowcast when
+# LINE has processed it, then follow its progress until LINE has delivered it
+def handle_stage(stage):
+    line_bot_api = client_registry.get_line_bot_api()
+    if stage["Stage"] == "audience":
+        if not stage.get("Closed"):
+            if not _close_campaign(stage["CampaignKey"]):
+                _queue_stage(stage)
+                return
+            stage = dict(stage, Closed=True)
+        status = line_bot_api.get_audience_group_status(stage["AudienceGroupId"])
+        if status == "IN_PROGRESS":
+            _queue_stage(stage)
+        elif status == "READY":
+            message = message_builders.build_message(stage["Kind"], stage["Data"])
+            try:
+                response = secret_cache.call_with_secret(
+                    lambda secret: client_registry.get_line_bot_api(secret).narrowcast(
+                        message,
+                        retry_key=retry.retry_key(
+                            stage["CampaignKey"], stage["AudienceGroupId"]
+                        ),
+                        recipient=AudienceRecipient(stage["AudienceGroupId"]),
+                    )
+                )
+            except Exception:
+                logging.exception(
+                    "Could not send narrowcast to %s", stage["AudienceGroupId"]
+                )
+                metrics.put_metrics({"NarrowcastsFailed": 1})
+                _delete_audience(line_bot_api, stage["AudienceGroupId"])
+                return
+            _queue_stage(dict(stage, Stage="progress", RequestId=response.request_id))
+        else:
+            logging.error(
+                "Audience group %s is %s, narrowcast not sent",
+                stage["AudienceGroupId"],
+                status,
+            )
+            metrics.put_metrics({"NarrowcastsFailed": 1})
+            _delete_audience(line_bot_api, stage["AudienceGroupId"])
+    elif stage["Stage"] == "progress":
+        progress = line_bot_api.get_progress_status_narrowcast(stage["RequestId"])
+        if progress.phase in ("waiting", "sending"):
+            _queue_stage(stage)
+            return
+        logging.info(
+            "Narrowcast %s %s: %s sent, %s failed (%s)",
+            stage["RequestId"],
+            progress.phase,
+            progress.success_count,
+            progress.failure_count,
+            progress.failed_description,
+        )
+        metrics.put_metrics(
+            {
+                "NarrowcastsSucceeded": int(progress.phase == "succeeded"),
+                "NarrowcastsFailed": int(progress.phase != "succeeded"),
+                "NarrowcastRecipients": progress.success_count or 0,
+            }
+        )
+        _delete_audience(line_bot_api, stage["AudienceGroupId"])
+
+
+# Stop adding recipients to the audience group of a campaign once none were
+# added for POLL_DELAY_SECONDS and no upload is in flight. Later drain batches
+# of the campaign are sent as multicasts
+def _close_campaign(campaign_key):
+    dynamodb = client_registry.get_aws_client("dynamodb")
+    try:
+        dynamodb.update_item(
+            TableName=os.getenv("idempotency_table"),
+            Key={"pk": {"S": "audience:" + campaign_key}},
+            UpdateExpression="SET closed = :true",
+            ConditionExpression=(
+                "(attribute_not_exists(uploads) OR uploads <= :zero)"
+                " AND updated_at <= :quiet_since"
+            ),
+            ExpressionAttributeValues={
+                ":true": {"BOOL": True},
+                ":zero": {"N": "0"},
+                ":quiet_since": {"N": str(int(time.time()) - POLL_DELAY_SECONDS)},
+            },
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+# Stages are delayed queue messages, so waiting costs no Lambda time
+def _queue_stage(stage):
+    client_registry.get_aws_client("sqs").send_message(
+        QueueUrl=os.getenv("send_queue_url"),
+        MessageBody=json.dumps(stage),
+        DelaySeconds=POLL_DELAY_SECONDS,
+    )
@@ -0,0 +1,215 @@
+import logging
+import struct
+import threading
+
+# Bytes fetched from the start of an audio file, enough for the ID3 tag of
+# most files and the first MP3 frames or the leading boxes of an M4A file
+HEAD_BYTES = 64 * 1024
+# S3 user metadata that can hold the duration of a file, set on upload
+METADATA_KEY = "duration-ms"
+
+_lock = threading.Lock()
+# Durations by ETag, so a replaced file is measured again
+_durations = {}
+stats = {"hits": 0, "metadata_hits": 0, "parsed": 0, "failures": 0}
+
+
+# Duration of an MP3 or M4A file in S3 in milliseconds, or None when it
+# cannot be read from the file header. processMedia keeps it in the manifest
+# of the file, the object itself is left as is
+def get_duration_ms(s3, bucket, key):
+    head = s3.head_object(Bucket=bucket, Key=key)
+    etag = head["ETag"]
+    with _lock:
+        if etag in _durations:
+            stats["hits"] += 1
+            return _durations[etag]
+    duration = head.get("Metadata", {}).get(METADATA_KEY)
+    if duration is not None:
+        duration = int(duration)
+        stats["metadata_hits"] += 1
+    else:
+        reader = _RangeReader(s3, bucket, key, head["ContentLength"])
+        try:
+            duration = parse_duration_ms(reader)
+        except (ValueError, struct.error) as e:
+            logging.warning("Could not read the duration of %s: %s", key, e)
+            duration = None
+        if duration is None:
+            stats["failures"] += 1
+            return None
+        stats["parsed"] += 1
+    with _lock:
+        _durations[etag] = duration
+    return duration
+
+
+def get_stats():
+    return dict(stats)
+
+
+# Read the duration from an M4A (MP4) or MP3 file, given a reader of byte
+# ranges of the file
+def parse_duration_ms(reader):
+    start = reader.read(0, 12)
+    if start[4:8] == b"ftyp":
+        return _mp4_duration_ms(reader)
+    return _mp3_duration_ms(reader)
+
+
+class _RangeReader:
+    def __init__(self, s3, bucket, key, size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.head = self._get(0, HEAD_BYTES)
+
+    def read(self, offset, length):
+        if offset + length <= len(self.head):
+            return self.head[offset : offset + length]
+        return self._get(offset, length)
+
+    def _get(self, offset, length):
+        if offset >= self.size:
+            return b""
+        end = min(offset + length, self.size) - 1
+        response = self.s3.get_object(
+            Bucket=self.bucket, Key=self.key, Range="bytes={}-{}".format(offset, end)
+        )
+        return response["Body"].read()
+
+
+def _mp4_duration_ms(reader):
+    # The duration is in the movie header, moov/mvhd, and moov can come
+    # after the media data, so walk the top level boxes with ranged reads
+    moov = _find_box(reader, 0, reader.size, b"moov")
+    if moov is None:
+        raise ValueError("no moov box")
+    mvhd = _find_box(reader, moov[0], moov[1], b"mvhd")
+    if mvhd is None:
+        raise ValueError("no mvhd box")
+    body = reader.read(mvhd[0], 32)
+    if body[0] == 1:
+        timescale, duration = struct.unpack(">IQ", body[20:32])
+    else:
+        timescale, duration = struct.unpack(">II", body[12:20])
+    if not timescale:
+        raise ValueError("mvhd has no timescale")
+    return duration * 1000 // timescale
+
+
+# Return the (start, end) of the content of the first box of the given type
+# between start and end
+def _find_box(reader, start, end, box_type):
+    offset = start
+    while offset + 8 <= end:
+        header = reader.read(offset, 16)
+        size, found_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ValueError("invalid box size")
+        if found_type == box_type:
+            return offset + header_size, offset + size
+        offset += size
+    return None
+
+
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    25: [11025, 12000, 8000],
+}
+
+
+def _mp3_duration_ms(reader):
+    audio_start = 0
+    header = reader.read(0, 10)
+    # Skip the ID3v2 tag, whose size is stored as a synchsafe integer
+    if header[:3] == b"ID3":
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        audio_start = 10 + size + (10 if header[5] & 0x10 else 0)
+    data = reader.read(audio_start, HEAD_BYTES)
+    for position in range(len(data) - 4):
+        frame = _parse_mp3_frame(data, position)
+        if frame is None:
+            continue
+        # A real frame is followed by another one
+        following = position + frame["length"]
+        if following + 4 <= len(data) and _parse_mp3_frame(data, following) is None:
+            continue
+        frames = _mp3_vbr_frames(data, position, frame)
+        if frames is not None:
+            return frames * frame["samples"] * 1000 // frame["sample_rate"]
+        # Constant bitrate: the duration follows from the audio size
+        audio_bytes = reader.size - audio_start - position
+        return audio_bytes * 8 // frame["bitrate"]
+    raise ValueError("no MPEG audio frame found")
+
+
+def _parse_mp3_frame(data, position):
+    b0, b1, b2, b3 = data[position : position + 4]
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = {0: 25, 2: 2, 3: 1}.get((b1 >> 3) & 3)
+    layer = {1: 3, 2: 2, 3: 1}.get((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 3
+    if (
+        version is None
+        or layer is None
+        or bitrate_index in (0, 15)
+        or sample_rate_index == 3
+    ):
+        return None
+    bitrate = MP3_BITRATES[(min(version, 2), layer)][bitrate_index]
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate * 1000 // sample_rate + padding
+    return {
+        "version": version,
+        "layer": layer,
+        "mono": b3 >> 6 == 3,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples": samples,
+        "length": length,
+    }
+
+
+# Number of frames from the Xing/Info or VBRI header of a variable bitrate
+# file, which sits in its first frame
+def _mp3_vbr_frames(data, position, frame):
+    if frame["version"] == 1:
+        side_info = 17 if frame["mono"] else 32
+    else:
+        side_info = 9 if frame["mono"] else 17
+    xing = position + 4 + side_info
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4 : xing + 8])[0]
+        if flags & 1:
+            return struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+    vbri = position + 36
+    if data[vbri : vbri + 4] == b"VBRI":
+        return struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+    return None
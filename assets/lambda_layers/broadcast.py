@@ -0,0 +1,57 @@
+import logging
+import os
+
+import client_registry
+import idempotency
+import retry
+import secret_cache
+
+# Value of Data["Audience"] marking a campaign whose segment is every follower
+ALL_FOLLOWERS = "ALL_FOLLOWERS"
+
+
+def is_marked_all_followers(data):
+    return isinstance(data, dict) and data.get("Audience") == ALL_FOLLOWERS
+
+
+# The idempotency table records each broadcast, so that later invocations of
+# the same campaign run do not broadcast it again
+def is_guarded():
+    return bool(os.getenv("idempotency_table"))
+
+
+# A campaign goes to every follower when its data says so. Without the table
+# guarding against repeated broadcasts it is sent as multicasts instead
+def targets_all_followers(data):
+    if not is_marked_all_followers(data):
+        return False
+    if not is_guarded():
+        logging.warning(
+            "No idempotency_table to broadcast a campaign once, sending multicasts"
+        )
+        return False
+    return True
+
+
+# Broadcast messages once per campaign key. Returns False when the campaign
+# was already broadcast by an earlier invocation
+def broadcast_once(messages, campaign_key):
+    if not is_guarded():
+        raise ValueError("Broadcasting needs the idempotency_table")
+    guard_key = "broadcast#" + retry.retry_key(campaign_key)
+    if not idempotency.claim(guard_key):
+        logging.info("Campaign %s was already broadcast", campaign_key)
+        return False
+    try:
+        response = secret_cache.call_with_secret(
+            lambda secret: client_registry.get_line_bot_api(secret).broadcast(
+                messages, retry_key=retry.retry_key(campaign_key, "broadcast")
+            )
+        )
+    except Exception:
+        idempotency.release(guard_key)
+        raise
+    logging.info(
+        "Broadcast campaign %s as request %s", campaign_key, response.request_id
+    )
+    return True
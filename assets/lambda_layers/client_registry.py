@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+
+import boto3
+from linebot import SignatureValidator
+
+import metrics
+import secret_cache
+
+_lock = threading.Lock()
+_clients = {}
+stats = {"builds": 0, "reuses": 0, "build_ms": 0.0}
+
+
+# Return the client registered under name, building it with factory() the
+# first time and again only when key (e.g. the credentials) has changed
+def get_client(name, key, factory):
+    with _lock:
+        cached = _clients.get(name)
+        if cached is not None and cached[0] == key:
+            stats["reuses"] += 1
+            return cached[1]
+        start = time.perf_counter()
+        client = factory()
+        stats["build_ms"] += (time.perf_counter() - start) * 1000
+        stats["builds"] += 1
+        _clients[name] = (key, client)
+        return client
+
+
+def get_line_bot_api(secret=None):
+    # Imported on first use, as it pulls in the message builders and caches,
+    # which the webhook receiver does not need at INIT
+    import line_client
+
+    token = (secret or secret_cache.get_secret())["YOUR_CHANNEL_ACCESS_TOKEN"]
+    return get_client(
+        "line_bot_api", fingerprint(token), lambda: line_client.LineClient(token)
+    )
+
+
+# The webhook only checks signatures, the events are handled from the queue
+def get_signature_validator(secret=None):
+    channel_secret = (secret or secret_cache.get_secret())["YOUR_CHANNEL_SECRET"]
+    return get_client(
+        "signature_validator",
+        fingerprint(channel_secret),
+        lambda: SignatureValidator(channel_secret),
+    )
+
+
+def get_aws_client(service_name, region_name=None):
+    return get_client(
+        "aws:" + service_name,
+        region_name,
+        lambda: boto3.client(service_name, region_name=region_name),
+    )
+
+
+def get_stats():
+    result = dict(stats)
+    average_build_ms = stats["build_ms"] / stats["builds"] if stats["builds"] else 0.0
+    # Every reuse skips one build, so this is the setup time saved so far
+    result["saved_ms"] = stats["reuses"] * average_build_ms
+    return result
+
+
+# Publish the counters of the client registry and of every module that
+# registered its own, e.g. the caches the function imported
+def publish_stats():
+    metrics.publish_counters()
+
+
+def fingerprint(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def _counters():
+    current = get_stats()
+    return {
+        "ClientBuilds": current["builds"],
+        "ClientReuses": current["reuses"],
+        "ClientSetupTime": current["build_ms"],
+        "ClientSetupTimeSaved": current["saved_ms"],
+    }
+
+
+metrics.register_counters(
+    "client_registry",
+    _counters,
+    units={"ClientSetupTime": "Milliseconds", "ClientSetupTimeSaved": "Milliseconds"},
+)
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from linebot.exceptions import LineBotApiError
+
+import broadcast
+import client_registry
+import metrics
+import payload_cache
+import retry
+import secret_cache
+
+# LINE accepts at most 500 user IDs per multicast request
+MAX_RECIPIENTS_PER_MULTICAST = 500
+DEFAULT_MAX_WORKERS = 8
+
+# Pinpoint event fields that identify one run of a campaign or journey activity
+CAMPAIGN_FIELDS = [
+    "ApplicationId",
+    "CampaignId",
+    "JourneyId",
+    "ActivityId",
+    "TreatmentId",
+    "ScheduledTime",
+]
+
+
+# One multicast, or push for a single recipient, to send
+@dataclass
+class SendTask:
+    index: int
+    recipients: List[str]
+    messages: object
+    retry_key: Optional[str] = None
+
+
+@dataclass
+class ChunkResult:
+    index: int
+    recipients: List[str]
+    error: Optional[str] = None
+
+
+@dataclass
+class DispatchReport:
+    succeeded: List[ChunkResult] = field(default_factory=list)
+    failed: List[ChunkResult] = field(default_factory=list)
+    mode: str = "threaded"
+    elapsed_ms: float = 0.0
+
+    @property
+    def recipient_count(self):
+        return sum(len(chunk.recipients) for chunk in self.succeeded + self.failed)
+
+    def log(self):
+        logging.info(
+            "Sent %d/%d chunks to %d recipients in %.0f ms (%s)",
+            len(self.succeeded),
+            len(self.succeeded) + len(self.failed),
+            self.recipient_count,
+            self.elapsed_ms,
+            self.mode,
+        )
+        for chunk in self.failed:
+            logging.error(
+                "Chunk %d (%d recipients) failed: %s",
+                chunk.index,
+                len(chunk.recipients),
+                chunk.error,
+            )
+        metrics.put_metrics(
+            {
+                "ChunksSucceeded": len(self.succeeded),
+                "ChunksFailed": len(self.failed),
+                "RecipientsFailed": sum(len(chunk.recipients) for chunk in self.failed),
+                "DispatchTime": self.elapsed_ms,
+            },
+            units={"DispatchTime": "Milliseconds"},
+            dimensions={
+                "FunctionName": os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local"),
+                "DispatchMode": self.mode,
+            },
+        )
+
+
+# "threaded" sends chunks from a thread pool, "sequential" one after the other
+# and "asyncio" from coroutines on line-bot-sdk's aiohttp based client
+def get_dispatch_mode():
+    return os.getenv("dispatch_mode", "threaded")
+
+
+def get_max_workers():
+    try:
+        return max(1, int(os.getenv("dispatch_max_workers", DEFAULT_MAX_WORKERS)))
+    except ValueError:
+        return DEFAULT_MAX_WORKERS
+
+
+# Collect the LINE user IDs of all endpoints in a Pinpoint custom channel event
+def get_recipients(event):
+    return [endpoint["Address"] for endpoint in event["Endpoints"].values()]
+
+
+# Events or queued jobs with the same campaign key send byte-identical messages
+def campaign_key(kind, event):
+    return json.dumps(
+        [kind, event.get("Data")] + [event.get(field) for field in CAMPAIGN_FIELDS],
+        sort_keys=True,
+    )
+
+
+def chunk_recipients(recipients, size=MAX_RECIPIENTS_PER_MULTICAST):
+    return [recipients[i : i + size] for i in range(0, len(recipients), size)]
+
+
+# Send the messages of a campaign: one broadcast when it targets every
+# follower, otherwise multicasts to the recipients
+def send_campaign(recipients, messages, data, campaign_key):
+    if not broadcast.targets_all_followers(data):
+        return multicast(recipients, messages, campaign_key=campaign_key)
+    start = time.perf_counter()
+    report = DispatchReport(mode="broadcast")
+    try:
+        broadcast.broadcast_once(messages, campaign_key)
+        report.succeeded.append(ChunkResult(0, recipients))
+    except Exception as e:
+        report.failed.append(ChunkResult(0, recipients, describe_error(e)))
+    report.elapsed_ms = (time.perf_counter() - start) * 1000
+    return report
+
+
+# Send messages to all recipients, one multicast per chunk of up to 500 users,
+# with at most max_workers chunks in flight at the same time. Chunks of the
+# same campaign key and recipients always get the same X-Line-Retry-Key
+def multicast(recipients, messages, max_workers=None, campaign_key=None):
+    return send_groups([(messages, recipients)], max_workers, campaign_key)
+
+
+# Send each (messages, recipients) group in chunks like multicast, with the
+# chunks of all groups sharing the same workers
+def send_groups(groups, max_workers=None, campaign_key=None):
+    mode = get_dispatch_mode()
+    start = time.perf_counter()
+    tasks = build_tasks(groups, campaign_key)
+    if mode == "asyncio":
+        import async_dispatcher
+
+        report = async_dispatcher.send_tasks(tasks)
+    else:
+        if mode == "sequential":
+            max_workers = 1
+        report = _send_threaded(tasks, max_workers)
+    report.mode = mode
+    report.elapsed_ms = (time.perf_counter() - start) * 1000
+    return report
+
+
+def build_tasks(groups, campaign_key=None):
+    tasks = []
+    for messages, recipients in groups:
+        group_key = campaign_key
+        # Groups of one campaign differ by their messages, so tell them apart
+        if campaign_key is not None and len(groups) > 1:
+            group_key = retry.retry_key(
+                campaign_key, payload_cache.as_json_dicts(messages)
+            )
+        for chunk in chunk_recipients(recipients):
+            retry_key = None
+            if group_key is not None:
+                retry_key = retry.retry_key(group_key, sorted(chunk))
+            tasks.append(SendTask(len(tasks), chunk, messages, retry_key))
+    return tasks
+
+
+# Send a task with the given client, as a push when it has a single recipient
+def send_task(line_bot_api, task):
+    if len(task.recipients) == 1:
+        line_bot_api.push_message(
+            task.recipients[0], task.messages, retry_key=task.retry_key
+        )
+    else:
+        line_bot_api.multicast(task.recipients, task.messages, retry_key=task.retry_key)
+
+
+def _send_threaded(tasks, max_workers):
+    max_workers = min(max_workers or get_max_workers(), len(tasks)) or 1
+    report = DispatchReport()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(_send_chunk, tasks):
+            if result.error is None:
+                report.succeeded.append(result)
+            else:
+                report.failed.append(result)
+    return report
+
+
+def _send_chunk(task):
+    try:
+        secret_cache.call_with_secret(
+            lambda secret: send_task(client_registry.get_line_bot_api(secret), task)
+        )
+    except Exception as e:
+        return ChunkResult(task.index, task.recipients, describe_error(e))
+    return ChunkResult(task.index, task.recipients)
+
+
+def describe_error(error):
+    if isinstance(error, LineBotApiError):
+        return "{} {} (request id {})".format(
+            error.status_code, error.error.message, error.request_id
+        )
+    return repr(error)
@@ -0,0 +1,144 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+
+import metrics
+
+LINE_API_ENDPOINT = "https://api.line.me"
+# Same default as the dispatcher's dispatch_max_workers, so every chunk in
+# flight gets its own kept-alive connection
+DEFAULT_POOL_SIZE = 8
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+# Short enough that a slow LINE API does not hold up the cold start
+WARM_UP_TIMEOUT = (1, 1)
+# Probe idle connections so that connections dropped while the execution
+# environment was frozen are detected rather than hanging a request
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+_lock = threading.Lock()
+_session = None
+stats = {"requests": 0, "connections": 0, "connect_ms": 0.0}
+
+
+def get_pool_size():
+    try:
+        return max(1, int(os.getenv("dispatch_max_workers", DEFAULT_POOL_SIZE)))
+    except ValueError:
+        return DEFAULT_POOL_SIZE
+
+
+def get_timeout():
+    try:
+        return (
+            DEFAULT_TIMEOUT[0],
+            float(os.getenv("line_api_read_timeout", DEFAULT_TIMEOUT[1])),
+        )
+    except ValueError:
+        return DEFAULT_TIMEOUT
+
+
+# HTTPS connection that records how long TCP connect and TLS handshake take
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        with _lock:
+            stats["connections"] += 1
+            stats["connect_ms"] += (time.perf_counter() - start) * 1000
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = (
+            HTTPSConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS
+        )
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme, https=TimedHTTPSConnectionPool
+        )
+
+
+# One session per execution environment, so connections to the LINE API are
+# kept alive and reused across invocations
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            # Retries are left to the retry module, which knows the retry keys
+            adapter = KeepAliveAdapter(
+                pool_connections=2, pool_maxsize=get_pool_size(), max_retries=0
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+# Open a connection to the LINE API ahead of the first request. Called at
+# module level by the handlers, so it happens during the Lambda INIT phase,
+# where a failure must not stop the function from starting
+def warm_up(url=LINE_API_ENDPOINT):
+    try:
+        get_session().head(url, timeout=WARM_UP_TIMEOUT)
+    except Exception as e:
+        logging.warning("Could not open a connection to %s: %s", url, e)
+
+
+def get_stats():
+    with _lock:
+        return dict(stats)
+
+
+# RequestsHttpClient sending through the shared keep-alive session
+class PooledHttpClient(RequestsHttpClient):
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request(
+            "GET", url, headers=headers, params=params, stream=stream, timeout=timeout
+        )
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        with _lock:
+            stats["requests"] += 1
+        response = get_session().request(
+            method, url, timeout=timeout or self.timeout, **kwargs
+        )
+        return RequestsHttpResponse(response)
+
+
+metrics.register_counters(
+    "http_pool",
+    lambda: {
+        "LineApiRequests": stats["requests"],
+        "LineApiConnections": stats["connections"],
+        "LineApiConnectTime": stats["connect_ms"],
+    },
+    units={"LineApiConnectTime": "Milliseconds"},
+)
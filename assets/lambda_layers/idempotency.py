@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import client_registry
+import metrics
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+# Keys completed by this execution environment that are remembered in memory
+MAX_RECENT_KEYS = 10000
+
+_lock = threading.Lock()
+_recent = OrderedDict()
+stats = {"claims": 0, "duplicates": 0, "memory_hits": 0}
+
+
+# Record that the work identified by key has been started. Returns False when
+# it was already claimed, by this or any other function, within the TTL
+def claim(key, ttl_seconds=DEFAULT_TTL_SECONDS):
+    table_name = os.getenv("idempotency_table")
+    if not table_name:
+        return True
+    try:
+        client_registry.get_aws_client("dynamodb").put_item(
+            TableName=table_name,
+            Item={
+                "pk": {"S": key},
+                "expires_at": {"N": str(int(time.time()) + ttl_seconds)},
+            },
+            ConditionExpression="attribute_not_exists(pk) OR expires_at < :now",
+            ExpressionAttributeValues={":now": {"N": str(int(time.time()))}},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+# Claim work that is often claimed again, such as webhook events redelivered
+# by LINE. Keys this execution environment completed within their TTL are
+# turned down from memory, the others are claimed in the table for
+# in_progress_seconds only, so that work which never completes, e.g. because
+# the function timed out, can be claimed again once that time has passed
+def claim_recent(key, in_progress_seconds):
+    now = time.time()
+    with _lock:
+        expires_at = _recent.get(key)
+        if expires_at is not None and expires_at > now:
+            _recent.move_to_end(key)
+            stats["duplicates"] += 1
+            stats["memory_hits"] += 1
+            return False
+    claimed = claim(key, in_progress_seconds)
+    with _lock:
+        stats["claims" if claimed else "duplicates"] += 1
+    return claimed
+
+
+# Keep a key claimed with claim_recent for ttl_seconds once its work is done
+def complete(key, ttl_seconds=DEFAULT_TTL_SECONDS):
+    expires_at = int(time.time()) + ttl_seconds
+    with _lock:
+        _recent.pop(key, None)
+        _recent[key] = expires_at
+        while len(_recent) > MAX_RECENT_KEYS:
+            _recent.popitem(last=False)
+    table_name = os.getenv("idempotency_table")
+    if not table_name:
+        return
+    try:
+        client_registry.get_aws_client("dynamodb").update_item(
+            TableName=table_name,
+            Key={"pk": {"S": key}},
+            UpdateExpression="SET expires_at = :expires_at",
+            ExpressionAttributeValues={":expires_at": {"N": str(expires_at)}},
+        )
+    except ClientError as e:
+        # The in progress claim expires, and a redelivery is handled again
+        logging.warning("Could not complete %s: %s", key, e)
+
+
+# Give up a claim, e.g. when the claimed work failed and should be retried
+def release(key):
+    with _lock:
+        _recent.pop(key, None)
+    table_name = os.getenv("idempotency_table")
+    if not table_name:
+        return
+    try:
+        client_registry.get_aws_client("dynamodb").delete_item(
+            TableName=table_name, Key={"pk": {"S": key}}
+        )
+    except ClientError as e:
+        logging.warning("Could not release %s: %s", key, e)
+
+
+def get_stats():
+    with _lock:
+        return dict(stats)
+
+
+metrics.register_counters(
+    "idempotency",
+    lambda: {
+        "IdempotencyClaims": stats["claims"],
+        "IdempotencyDuplicates": stats["duplicates"],
+        "IdempotencyMemoryHits": stats["memory_hits"],
+    },
+)
@@ -0,0 +1,154 @@
+import logging
+import uuid
+
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import BroadcastResponse, NarrowcastResponse
+
+import http_pool
+import payload_cache
+import rate_limiter
+import retry
+
+
+# LineBotApi sending through the shared keep-alive connection pool, whose
+# calls are throttled by the shared rate limiter, one budget per LINE endpoint
+# class, and retried with backoff. All handlers get it through client_registry.
+#
+# Sending calls always carry an X-Line-Retry-Key, so a retried request is
+# never delivered twice. The key is passed per request rather than stored in
+# self.headers like LineBotApi does, as the client is shared between threads.
+class LineClient(LineBotApi):
+    def __init__(self, channel_access_token, **kwargs):
+        kwargs.setdefault("http_client", http_pool.PooledHttpClient)
+        kwargs.setdefault("timeout", http_pool.get_timeout())
+        super().__init__(channel_access_token, **kwargs)
+
+    def push_message(
+        self,
+        to,
+        messages,
+        retry_key=None,
+        notification_disabled=False,
+        custom_aggregation_units=None,
+        timeout=None,
+    ):
+        data = {
+            "to": to,
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        _add_aggregation_units(data, custom_aggregation_units)
+        self._send("push", "/v2/bot/message/push", data, retry_key, timeout)
+
+    def multicast(
+        self,
+        to,
+        messages,
+        retry_key=None,
+        notification_disabled=False,
+        custom_aggregation_units=None,
+        timeout=None,
+    ):
+        data = {
+            "to": to,
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        _add_aggregation_units(data, custom_aggregation_units)
+        self._send("multicast", "/v2/bot/message/multicast", data, retry_key, timeout)
+
+    def broadcast(
+        self, messages, retry_key=None, notification_disabled=False, timeout=None
+    ):
+        data = {
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        request_id = self._send(
+            "broadcast", "/v2/bot/message/broadcast", data, retry_key, timeout
+        )
+        return BroadcastResponse(request_id=request_id)
+
+    def narrowcast(
+        self,
+        messages,
+        retry_key=None,
+        recipient=None,
+        filter=None,
+        limit=None,
+        notification_disabled=False,
+        timeout=None,
+    ):
+        data = {
+            "messages": payload_cache.request_messages(messages),
+            "notificationDisabled": notification_disabled,
+        }
+        # Unlike LineBotApi, recipient, filter and limit are all optional
+        for name, value in [
+            ("recipient", recipient),
+            ("filter", filter),
+            ("limit", limit),
+        ]:
+            if value is not None:
+                data[name] = value.as_json_dict()
+        request_id = self._send(
+            "narrowcast", "/v2/bot/message/narrowcast", data, retry_key, timeout
+        )
+        return NarrowcastResponse(request_id=request_id)
+
+    def get_profile(self, user_id, timeout=None):
+        def call():
+            rate_limiter.acquire(
+                "profile", timeout=retry.time_left(rate_limiter.DEFAULT_TIMEOUT_SECONDS)
+            )
+            return super(LineClient, self).get_profile(user_id, timeout=timeout)
+
+        return retry.call_with_retry(call)
+
+    # Status of an audience group: IN_PROGRESS, READY, FAILED or EXPIRED
+    def get_audience_group_status(self, audience_group_id, timeout=None):
+        response = retry.call_with_retry(
+            lambda: self._get(
+                "/v2/bot/audienceGroup/{}".format(audience_group_id), timeout=timeout
+            )
+        )
+        # The audience group is wrapped in the response, which
+        # LineBotApi.get_audience_group does not expect
+        return response.json.get("audienceGroup", response.json).get("status")
+
+    # Post a sending request and return its LINE request ID
+    def _send(self, endpoint_class, path, data, retry_key, timeout):
+        retry_key = retry_key or str(uuid.uuid4())
+        body = payload_cache.encode_body(data)
+
+        def call():
+            rate_limiter.acquire(
+                endpoint_class,
+                timeout=retry.time_left(rate_limiter.DEFAULT_TIMEOUT_SECONDS),
+            )
+            headers = {
+                "Content-Type": "application/json",
+                "X-Line-Retry-Key": retry_key,
+            }
+            return self._post(path, data=body, headers=headers, timeout=timeout)
+
+        try:
+            response = retry.call_with_retry(call)
+        except LineBotApiError as e:
+            if not retry.is_already_accepted(e):
+                raise
+            logging.info(
+                "Request %s was already accepted as %s",
+                retry_key,
+                e.accepted_request_id,
+            )
+            return e.accepted_request_id
+        return response.headers.get("X-Line-Request-Id")
+
+
+def _add_aggregation_units(data, custom_aggregation_units):
+    if custom_aggregation_units is not None:
+        if not isinstance(custom_aggregation_units, (list, tuple)):
+            custom_aggregation_units = [custom_aggregation_units]
+        data["customAggregationUnits"] = custom_aggregation_units
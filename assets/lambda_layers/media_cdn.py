@@ -0,0 +1,65 @@
+import datetime
+import os
+from urllib.parse import quote
+
+from botocore.signers import CloudFrontSigner
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+import client_registry
+import secret_cache
+
+
+# Media is served from CloudFront when the stack was deployed with a public
+# key for signed URLs, otherwise the senders fall back to S3 presigned URLs
+def is_enabled():
+    return bool(os.getenv("media_domain"))
+
+
+# Sign a CloudFront URL for an object of the image, audio or video bucket,
+# which the distribution serves under /<kind>/<key>. Signing happens locally
+# with the private key, without any AWS API call
+def signed_url(kind, key, expires_in):
+    url = "https://{}/{}/{}".format(os.getenv("media_domain"), kind, quote(key))
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=expires_in
+    )
+    return _get_signer().generate_presigned_url(url, date_less_than=expires)
+
+
+# Sign a CloudFront URL for a path under which clients add more path
+# segments, such as the base URL of an imagemap that LINE completes with the
+# image width. The custom policy allows every URL under the path
+def signed_base_url(kind, path, expires_in):
+    url = "https://{}/{}/{}".format(os.getenv("media_domain"), kind, quote(path))
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=expires_in
+    )
+    signer = _get_signer()
+    policy = signer.build_policy(url + "/*", date_less_than=expires)
+    return signer.generate_presigned_url(url, policy=policy)
+
+
+# Raises ValueError when the secret holds no usable private key, e.g. the
+# placeholder the stack creates it with
+def _get_signer():
+    private_key = secret_cache.get_secret(os.getenv("media_key_secret_arn")).get(
+        "private_key", ""
+    )
+
+    def build():
+        try:
+            key = serialization.load_pem_private_key(
+                private_key.encode("utf-8"), password=None
+            )
+        except (ValueError, TypeError) as e:
+            raise ValueError("The media signing key is not configured") from e
+        # CloudFront signatures are RSA-SHA1 with PKCS#1 v1.5 padding
+        return CloudFrontSigner(
+            os.getenv("media_key_pair_id"),
+            lambda message: key.sign(message, padding.PKCS1v15(), hashes.SHA1()),
+        )
+
+    return client_registry.get_client(
+        "cloudfront_signer", client_registry.fingerprint(private_key), build
+    )
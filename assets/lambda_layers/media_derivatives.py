@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import metrics
+
+# LINE Messaging API limits for the media of image, video and audio messages
+IMAGE_FORMATS = ("JPEG", "PNG")
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_PREVIEW_BYTES = 1024 * 1024
+AUDIO_EXTENSIONS = (".mp3", ".m4a")
+VIDEO_EXTENSIONS = (".mp4",)
+MAX_VIDEO_BYTES = 200 * 1024 * 1024
+MAX_AUDIO_BYTES = 200 * 1024 * 1024
+# Previews are shown as thumbnails in the chat, so they are kept small
+PREVIEW_SIZE = (240, 240)
+# Images next to a video with the same name and one of these extensions are
+# used as its cover
+COVER_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Images uploaded under this prefix of the image bucket are imagemaps, which
+# LINE fetches in each of these widths
+IMAGEMAP_PREFIX = "imagemap/"
+IMAGEMAP_WIDTHS = (240, 300, 460, 700, 1040)
+IMAGEMAP_BASE_WIDTH = 1040
+# Loaded manifests, and missing ones, are kept this long before being read
+# again, which also picks up files uploaded again
+MANIFEST_TTL_SECONDS = 300
+
+# processMedia writes the files it derives from an upload under this prefix
+# of the same bucket, and ignores uploads under it
+DERIVED_PREFIX = "derived/"
+
+
+# Small JPEG preview of an image
+def preview_key(key):
+    return "{}preview/{}.jpg".format(DERIVED_PREFIX, key)
+
+
+# JPEG copy of an image that LINE does not accept as is, e.g. a WebP or a
+# file over 10 MB
+def original_key(key):
+    return "{}original/{}.jpg".format(DERIVED_PREFIX, key)
+
+
+# Base path of the imagemap tiles of an image, stored as <base>/<width>
+def imagemap_base_key(key):
+    return "{}imagemap/{}".format(DERIVED_PREFIX, key)
+
+
+def is_imagemap(key):
+    return key.startswith(IMAGEMAP_PREFIX)
+
+
+# Manifest of an uploaded file: the keys to send for it, with its size and,
+# depending on the kind of file, dimensions, duration or cover
+def manifest_key(key):
+    return "{}manifest/{}.json".format(DERIVED_PREFIX, key)
+
+
+def is_derived(key):
+    return key.startswith(DERIVED_PREFIX)
+
+
+def is_video(key):
+    return os.path.splitext(key)[1].lower() in VIDEO_EXTENSIONS
+
+
+def is_audio(key):
+    return os.path.splitext(key)[1].lower() in AUDIO_EXTENSIONS
+
+
+_lock = threading.Lock()
+_manifests = {}
+stats = {"hits": 0, "misses": 0}
+
+
+# Manifest written by processMedia for an uploaded file, or None for files
+# uploaded before there was one. Loaded with a single GET and cached
+def load_manifest(s3, bucket, key):
+    now = time.monotonic()
+    with _lock:
+        cached = _manifests.get((bucket, key))
+        if cached is not None and cached[1] > now:
+            stats["hits"] += 1
+            return cached[0]
+        stats["misses"] += 1
+    manifest = read_manifest(s3, bucket, key)
+    with _lock:
+        _manifests[(bucket, key)] = (manifest, now + MANIFEST_TTL_SECONDS)
+    return manifest
+
+
+# Manifest of an uploaded file as it is in S3 right now, or None
+def read_manifest(s3, bucket, key):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=manifest_key(key))["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        return None
+    return json.loads(body)
+
+
+def write_manifest(s3, bucket, key, manifest):
+    s3.put_object(
+        Bucket=bucket,
+        Key=manifest_key(key),
+        Body=json.dumps(manifest).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def get_stats():
+    return dict(stats)
+
+
+metrics.register_counters(
+    "media_manifests",
+    lambda: {
+        "MediaManifestHits": stats["hits"],
+        "MediaManifestMisses": stats["misses"],
+    },
+)
@@ -0,0 +1,276 @@
+import logging
+import os
+import threading
+import time
+
+import boto3
+from linebot.models import (
+    AudioSendMessage,
+    BaseSize,
+    ImagemapSendMessage,
+    ImageSendMessage,
+    MessageImagemapAction,
+    TextSendMessage,
+    URIImagemapAction,
+    VideoSendMessage,
+)
+
+import audio_metadata
+import media_cdn
+import media_derivatives
+import metrics
+import templates
+
+# Duration in milliseconds of audio messages whose file cannot be measured
+DEFAULT_AUDIO_DURATION = 5
+# LINE accepts at most 5 message objects per request
+MAX_MESSAGES_PER_REQUEST = 5
+DEFAULT_TEXT = "Hello, congratulations! You are eligible for a 15% off on hotel bookings and car rental. Chat with us to find out more!"
+PRESIGNED_URL_EXPIRY = 3600
+# A presigned URL is reused until this many seconds before it expires, which
+# leaves LINE time to fetch the content and covers cached payloads
+DEFAULT_PRESIGNED_URL_MARGIN = 900
+
+s3 = boto3.client("s3")
+_url_lock = threading.Lock()
+_urls = {}
+url_stats = {"hits": 0, "misses": 0}
+
+
+def get_presigned_url_margin():
+    try:
+        margin = int(
+            os.getenv("presigned_url_margin_seconds", DEFAULT_PRESIGNED_URL_MARGIN)
+        )
+    except ValueError:
+        return DEFAULT_PRESIGNED_URL_MARGIN
+    return min(max(margin, 0), PRESIGNED_URL_EXPIRY)
+
+
+# Generate a presigned URL for an S3 object, or reuse the one generated for
+# it earlier, so all batches of a campaign send the same URL for an asset
+def presigned_url(bucket, key):
+    return _cached_url(
+        ("s3", bucket, key),
+        lambda: s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
+        ),
+    )
+
+
+# URL of an object of the image, audio or video bucket: a CloudFront signed
+# URL when the media distribution is deployed, otherwise an S3 presigned URL.
+# S3 is also used while the distribution has no signing key to sign with
+def media_url(kind, key):
+    if media_cdn.is_enabled():
+        try:
+            return _cached_url(
+                ("cloudfront", kind, key),
+                lambda: media_cdn.signed_url(kind, key, PRESIGNED_URL_EXPIRY),
+            )
+        except ValueError as e:
+            logging.warning("Could not sign a CloudFront URL, using S3: %s", e)
+    return presigned_url(os.getenv(kind + "_bucket"), key)
+
+
+# URL under which LINE fetches <url>/<width>. Presigned S3 URLs only cover one
+# object, so this needs the CloudFront media distribution
+def media_base_url(kind, path):
+    if not media_cdn.is_enabled():
+        raise ValueError("Imagemaps need the CloudFront media distribution")
+    return _cached_url(
+        ("cloudfront-base", kind, path),
+        lambda: media_cdn.signed_base_url(kind, path, PRESIGNED_URL_EXPIRY),
+    )
+
+
+def _cached_url(cache_key, generate):
+    now = time.monotonic()
+    with _url_lock:
+        cached = _urls.get(cache_key)
+        if cached is not None and cached[1] > now:
+            url_stats["hits"] += 1
+            return cached[0]
+        url_stats["misses"] += 1
+        # Drop expired URLs so the cache only holds assets in use
+        for expired in [k for k, (_, until) in _urls.items() if until <= now]:
+            del _urls[expired]
+    url = generate()
+    reuse_until = now + PRESIGNED_URL_EXPIRY - get_presigned_url_margin()
+    with _url_lock:
+        _urls[cache_key] = (url, reuse_until)
+    return url
+
+
+def get_url_stats():
+    return dict(url_stats)
+
+
+def build_text_message(data):
+    # Check whether custom data is passed by user, either as the text itself or
+    # as {"Text": ...} next to other settings such as "Audience"
+    if isinstance(data, dict):
+        custom_message = data.get("Text", DEFAULT_TEXT)
+    elif data is not None:
+        custom_message = data
+    else:
+        custom_message = DEFAULT_TEXT
+    # A locale map is never sent as is, LINE rejects a text that is not a string
+    if isinstance(custom_message, dict):
+        custom_message = templates.render_default({"Text": custom_message})
+    return TextSendMessage(text=custom_message)
+
+
+def build_image_message(data):
+    if isinstance(data, dict):
+        image_bucket_key = data.get("Image_bucket_key", "sample_image.jpg")
+    elif data is not None:
+        image_bucket_key = data
+    else:
+        image_bucket_key = "sample_image.jpg"
+    original_key, preview_key = _image_keys(os.getenv("image_bucket"), image_bucket_key)
+    return ImageSendMessage(
+        original_content_url=media_url("image", original_key),
+        preview_image_url=media_url("image", preview_key),
+    )
+
+
+# Keys of the image to send and its preview: the LINE compliant copy and the
+# small preview listed in the manifest written by processMedia, or the
+# uploaded image itself for files without a manifest
+def _image_keys(bucket, key):
+    manifest = media_derivatives.load_manifest(s3, bucket, key)
+    if manifest is None or "preview" not in manifest:
+        return key, key
+    return manifest["original"], manifest["preview"]
+
+
+def build_audio_message(data):
+    audio_duration = None
+    if data is not None:
+        audio_bucket_key = data["Audio_bucket_key"]
+        audio_duration = data.get("Audio_duration")
+    else:
+        audio_bucket_key = "sample_audio.mp3"
+    # Take the duration from the manifest, or from the file header for files
+    # without one, unless the campaign sets it
+    if audio_duration is None:
+        audio_bucket = os.getenv("audio_bucket")
+        manifest = media_derivatives.load_manifest(s3, audio_bucket, audio_bucket_key)
+        if manifest is not None:
+            audio_duration = manifest.get("duration_ms")
+        else:
+            audio_duration = audio_metadata.get_duration_ms(
+                s3, audio_bucket, audio_bucket_key
+            )
+        audio_duration = audio_duration or DEFAULT_AUDIO_DURATION
+    return AudioSendMessage(
+        original_content_url=media_url("audio", audio_bucket_key),
+        duration=audio_duration,
+    )
+
+
+def build_video_message(data):
+    video_image_key = None
+    if data is not None:
+        video_file_key = data["video_file_key"]
+        video_image_key = data.get("video_image_key")
+    else:
+        video_file_key = "sample_video.mp4"
+    video_bucket = os.getenv("video_bucket")
+    # Without a cover in the campaign, use the one found next to the video
+    if video_image_key is None:
+        manifest = media_derivatives.load_manifest(s3, video_bucket, video_file_key)
+        video_image_key = (manifest or {}).get("cover") or "sample_image.jpg"
+    # The cover is in the video bucket, and its preview is sent when it has one
+    _, cover_preview_key = _image_keys(video_bucket, video_image_key)
+    return VideoSendMessage(
+        original_content_url=media_url("video", video_file_key),
+        preview_image_url=media_url("video", cover_preview_key),
+    )
+
+
+# Imagemap actions in the LINE JSON format, by type
+IMAGEMAP_ACTIONS = {"uri": URIImagemapAction, "message": MessageImagemapAction}
+
+
+# Build an imagemap from an image uploaded under imagemap/ in the image
+# bucket, e.g. {"Imagemap_bucket_key": "imagemap/sale.png", "Alt_text": "Sale",
+# "Actions": [{"type": "uri", "linkUri": "https://example.com", "area": {"x": 0,
+# "y": 0, "width": 1040, "height": 1040}}]}. The message only points at the
+# tiles processMedia wrote for every width LINE asks for
+def build_imagemap_message(data):
+    image_bucket_key = data["Imagemap_bucket_key"]
+    manifest = media_derivatives.load_manifest(
+        s3, os.getenv("image_bucket"), image_bucket_key
+    )
+    if manifest is None or "base" not in manifest:
+        raise ValueError(
+            "{} has no imagemap tiles, upload it under {}".format(
+                image_bucket_key, media_derivatives.IMAGEMAP_PREFIX
+            )
+        )
+    actions = []
+    for action in data["Actions"]:
+        if action.get("type") not in IMAGEMAP_ACTIONS:
+            raise ValueError("Unknown imagemap action: {}".format(action.get("type")))
+        actions.append(IMAGEMAP_ACTIONS[action["type"]].new_from_json_dict(action))
+    return ImagemapSendMessage(
+        base_url=media_base_url("image", manifest["base"]),
+        alt_text=data.get("Alt_text", "Imagemap"),
+        base_size=BaseSize(
+            width=manifest["base_width"], height=manifest["base_height"]
+        ),
+        actions=actions,
+    )
+
+
+# Build the messages of a bundle, in order, from a list of message specs such
+# as {"Messages": [{"Type": "text", "Text": "Hi"}, {"Type": "image", ...}]},
+# where every spec holds the custom data of its message kind
+def build_bundle_messages(data):
+    specs = data.get("Messages") if isinstance(data, dict) else data
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("A bundle needs a non-empty list of message specs")
+    if len(specs) > MAX_MESSAGES_PER_REQUEST:
+        raise ValueError(
+            "A bundle has at most {} messages, got {}".format(
+                MAX_MESSAGES_PER_REQUEST, len(specs)
+            )
+        )
+    messages = []
+    for spec in specs:
+        kind = spec.get("Type")
+        if kind not in BUILDERS or kind == "bundle":
+            raise ValueError("Unknown message kind in bundle: {}".format(kind))
+        messages.append(
+            build_message(kind, {k: v for k, v in spec.items() if k != "Type"})
+        )
+    return messages
+
+
+# Message kinds sent by the send* functions and the send queue worker
+BUILDERS = {
+    "text": build_text_message,
+    "image": build_image_message,
+    "audio": build_audio_message,
+    "video": build_video_message,
+    "imagemap": build_imagemap_message,
+    "bundle": build_bundle_messages,
+}
+
+
+# Build the LINE message for a kind from the Pinpoint custom data
+def build_message(kind, data):
+    return BUILDERS[kind](data)
+
+
+metrics.register_counters(
+    "presigned_urls",
+    lambda: {
+        "PresignedUrlCacheHits": url_stats["hits"],
+        "PresignedUrlCacheMisses": url_stats["misses"],
+    },
+)
@@ -0,0 +1,56 @@
+import json
+import os
+import time
+
+# CloudWatch namespace used for all custom metrics of the integration
+NAMESPACE = "LinePinpointIntegration"
+
+_published = {}
+_counters = {}
+
+
+# Write metrics to the function's log in CloudWatch Embedded Metric Format,
+# which CloudWatch turns into metrics without any PutMetricData call
+def put_metrics(values, units=None, dimensions=None):
+    units = units or {}
+    if dimensions is None:
+        dimensions = {"FunctionName": os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [
+                        {"Name": name, "Unit": units.get(name, "Count")}
+                        for name in values
+                    ],
+                }
+            ],
+        }
+    }
+    record.update(dimensions)
+    record.update(values)
+    print(json.dumps(record))
+
+
+# Publish how much each counter grew since the previous call for the same
+# source, so that cumulative per-environment counters sum up correctly
+def put_counter_deltas(source, counters, units=None, dimensions=None):
+    previous = _published.get(source, {})
+    deltas = {name: value - previous.get(name, 0) for name, value in counters.items()}
+    _published[source] = dict(counters)
+    if any(deltas.values()):
+        put_metrics(deltas, units=units, dimensions=dimensions)
+
+
+# Register the cumulative counters of a module, e.g. its cache hits, which
+# publish_counters publishes in every function that imports the module
+def register_counters(source, get_counters, units=None):
+    _counters[source] = (get_counters, units)
+
+
+def publish_counters():
+    for source, (get_counters, units) in list(_counters.items()):
+        put_counter_deltas(source, get_counters(), units=units)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import message_builders
+import metrics
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_size = 0
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+# JSON that is already encoded and goes into request bodies as is
+class RawJson(bytes):
+    pass
+
+
+# Built messages of a campaign together with their encoded JSON, so sending
+# them only needs the recipients to be encoded
+class PreparedMessages(list):
+    def __init__(self, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        super().__init__(messages)
+        self.json = RawJson(json.dumps(as_json_dicts(messages)).encode("utf-8"))
+
+
+def as_json_dicts(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return [message.as_json_dict() for message in messages]
+
+
+# Messages as they go into a request body, with prepared messages spliced in
+# as their already encoded JSON
+def request_messages(messages):
+    if isinstance(messages, PreparedMessages):
+        return messages.json
+    return as_json_dicts(messages)
+
+
+def _get_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+# Messages of a campaign or journey activity, built once per execution
+# environment and Data, and kept for payload_cache_ttl_seconds as they can
+# contain presigned URLs
+def get_messages(kind, event):
+    key = cache_key(kind, event)
+    now = time.monotonic()
+    with _lock:
+        cached = _entries.get(key)
+        if cached is not None and cached[1] > now:
+            _entries.move_to_end(key)
+            stats["hits"] += 1
+            return cached[0]
+        stats["misses"] += 1
+    messages = PreparedMessages(message_builders.build_message(kind, event.get("Data")))
+    ttl_seconds = _get_int("payload_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+    _store(key, messages, now + ttl_seconds)
+    return messages
+
+
+# Campaign or journey, treatment and a hash of the custom data
+def cache_key(kind, event):
+    data_hash = hashlib.sha256(
+        json.dumps(event.get("Data"), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return (
+        kind,
+        event.get("CampaignId") or event.get("JourneyId"),
+        event.get("ActivityId"),
+        event.get("TreatmentId"),
+        data_hash,
+    )
+
+
+def _store(key, messages, expires_at):
+    global _size
+    max_bytes = _get_int("payload_cache_max_bytes", DEFAULT_MAX_BYTES)
+    max_entries = _get_int("payload_cache_max_entries", DEFAULT_MAX_ENTRIES)
+    if len(messages.json) > max_bytes:
+        return
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _size -= len(previous[0].json)
+        _entries[key] = (messages, expires_at)
+        _size += len(messages.json)
+        # Evict the least recently used entries
+        while len(_entries) > max_entries or _size > max_bytes:
+            _, (evicted, _) = _entries.popitem(last=False)
+            _size -= len(evicted.json)
+            stats["evictions"] += 1
+
+
+# Encode a request body, splicing in values that are already encoded
+def encode_body(data):
+    members = []
+    for name, value in data.items():
+        if not isinstance(value, RawJson):
+            value = json.dumps(value).encode("utf-8")
+        members.append(json.dumps(name).encode("utf-8") + b": " + value)
+    return b"{" + b", ".join(members) + b"}"
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, entries=len(_entries), bytes=_size)
+
+
+metrics.register_counters(
+    "payload_cache",
+    lambda: {
+        "PayloadCacheHits": stats["hits"],
+        "PayloadCacheMisses": stats["misses"],
+        "PayloadCacheEvictions": stats["evictions"],
+    },
+)
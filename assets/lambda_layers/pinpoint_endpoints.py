@@ -0,0 +1,93 @@
+import logging
+import os
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import client_registry
+import metrics
+import retry
+
+# Amazon Pinpoint accepts at most 100 endpoints per UpdateEndpointsBatch call
+MAX_ENDPOINTS_PER_BATCH = 100
+
+
+# Endpoint updates collected while handling a webhook, written with
+# UpdateEndpointsBatch in groups of up to 100 endpoints when flushed. A later
+# update of the same endpoint replaces an earlier one
+class EndpointBatch:
+    def __init__(self, application_id=None):
+        self.application_id = application_id or os.getenv("pinpoint_app_id")
+        self.pending = OrderedDict()
+        self.calls = 0
+        self.failed = []
+
+    def add(self, endpoint_id, endpoint_request):
+        self.pending.pop(endpoint_id, None)
+        self.pending[endpoint_id] = dict(endpoint_request, Id=endpoint_id)
+
+    # Forget a pending update, e.g. when the user unfollows in the same webhook
+    def discard(self, endpoint_id):
+        self.pending.pop(endpoint_id, None)
+
+    # Write the pending updates and return the IDs of the endpoints that
+    # could not be written
+    def flush(self):
+        items = list(self.pending.values())
+        self.pending.clear()
+        for i in range(0, len(items), MAX_ENDPOINTS_PER_BATCH):
+            self._write(items[i : i + MAX_ENDPOINTS_PER_BATCH])
+        return list(self.failed)
+
+    def publish(self):
+        metrics.put_metrics(
+            {"PinpointCalls": self.calls, "EndpointWriteFailures": len(self.failed)}
+        )
+
+    def _write(self, items):
+        try:
+            self._call(
+                lambda: self._client().update_endpoints_batch(
+                    ApplicationId=self.application_id,
+                    EndpointBatchRequest={"Item": items},
+                )
+            )
+            return
+        except ClientError as e:
+            if len(items) == 1:
+                self._fail(items[0], e)
+                return
+            logging.warning(
+                "UpdateEndpointsBatch failed (%r), writing %d endpoints one by one",
+                e,
+                len(items),
+            )
+        # Pinpoint rejects the whole batch for one invalid endpoint, so write
+        # them one by one to find which one it was
+        for item in items:
+            endpoint_request = {k: v for k, v in item.items() if k != "Id"}
+            try:
+                self._call(
+                    lambda: self._client().update_endpoint(
+                        ApplicationId=self.application_id,
+                        EndpointId=item["Id"],
+                        EndpointRequest=endpoint_request,
+                    )
+                )
+            except ClientError as e:
+                self._fail(item, e)
+
+    # Throttled and failed calls are retried with backoff
+    def _call(self, func):
+        def counted():
+            self.calls += 1
+            return func()
+
+        return retry.call_with_retry(counted)
+
+    def _fail(self, item, error):
+        logging.error("Could not write endpoint %s: %r", item["Id"], error)
+        self.failed.append(item["Id"])
+
+    def _client(self):
+        return client_registry.get_aws_client("pinpoint")
@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from linebot.models import Profile
+
+import client_registry
+import metrics
+import retry
+
+DEFAULT_TTL_SECONDS = 24 * 3600
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_WORKERS = 8
+# DynamoDB accepts at most 100 keys per BatchGetItem call
+MAX_KEYS_PER_GET = 100
+
+_lock = threading.Lock()
+_profiles = OrderedDict()
+stats = {"hits": 0, "table_hits": 0, "fetches": 0, "evictions": 0}
+
+
+def _get_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+# Profiles of the given users, looked up in this execution environment first,
+# then in the profile_table when there is one, and fetched from LINE last with
+# at most profile_fetch_max_workers requests in flight. Returns the profiles
+# and the errors of the users whose profile could not be fetched. With
+# fetch=False only the cached profiles are returned
+def get_profiles(user_ids, fetch=True):
+    now = time.time()
+    profiles = {}
+    misses = []
+    with _lock:
+        for user_id in dict.fromkeys(user_ids):
+            cached = _profiles.get(user_id)
+            if cached is not None and cached[1] > now:
+                _profiles.move_to_end(user_id)
+                stats["hits"] += 1
+                profiles[user_id] = cached[0]
+            else:
+                misses.append(user_id)
+    if not misses:
+        return profiles, {}
+
+    stored = _load(misses, now)
+    with _lock:
+        stats["table_hits"] += len(stored)
+    profiles.update(stored)
+    misses = [user_id for user_id in misses if user_id not in stored]
+
+    errors = {}
+    fetched = {}
+    if misses and fetch:
+        line_bot_api = client_registry.get_line_bot_api()
+        max_workers = _get_int("profile_fetch_max_workers", DEFAULT_MAX_WORKERS)
+        max_workers = max(1, min(max_workers, len(misses)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                user_id: executor.submit(line_bot_api.get_profile, user_id)
+                for user_id in misses
+            }
+        for user_id, future in futures.items():
+            try:
+                fetched[user_id] = future.result()
+            except Exception as e:
+                errors[user_id] = e
+        with _lock:
+            stats["fetches"] += len(misses)
+        _save(fetched, now)
+    profiles.update(fetched)
+
+    _remember({**stored, **fetched}, now)
+    return profiles, errors
+
+
+def get_profile(user_id):
+    profiles, errors = get_profiles([user_id])
+    if user_id in errors:
+        raise errors[user_id]
+    return profiles[user_id]
+
+
+def _remember(profiles, now):
+    ttl_seconds = _get_int("profile_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+    max_entries = _get_int("profile_cache_max_entries", DEFAULT_MAX_ENTRIES)
+    with _lock:
+        for user_id, profile in profiles.items():
+            _profiles.pop(user_id, None)
+            _profiles[user_id] = (profile, now + ttl_seconds)
+        # Evict the least recently used profiles
+        while len(_profiles) > max_entries:
+            _profiles.popitem(last=False)
+            stats["evictions"] += 1
+
+
+# Profiles kept in the profile_table by any function, skipping the ones whose
+# TTL has passed but that DynamoDB has not deleted yet. The table only saves
+# profile API calls, so when it cannot be read the profiles are fetched
+def _load(user_ids, now):
+    table_name = os.getenv("profile_table")
+    if not table_name:
+        return {}
+    profiles = {}
+    try:
+        _read_table(table_name, user_ids, now, profiles)
+    except ClientError as e:
+        logging.warning("Could not read profiles from %s: %s", table_name, e)
+    return profiles
+
+
+def _read_table(table_name, user_ids, now, profiles):
+    for item in _batch_get(table_name, user_ids):
+        # Unfollows are recorded for users whose profile is not known
+        if "profile" in item and int(item["expires_at"]["N"]) > now:
+            profiles[item["pk"]["S"]] = Profile.new_from_json_dict(
+                json.loads(item["profile"]["S"])
+            )
+
+
+# Items of the given users, with keys DynamoDB did not get to looked up again
+# after a backoff
+def _batch_get(table_name, user_ids, projection=None):
+    dynamodb = client_registry.get_aws_client("dynamodb")
+    for i in range(0, len(user_ids), MAX_KEYS_PER_GET):
+        keys = {
+            "Keys": [
+                {"pk": {"S": user_id}} for user_id in user_ids[i : i + MAX_KEYS_PER_GET]
+            ]
+        }
+        if projection:
+            keys["ProjectionExpression"] = projection
+        request = {table_name: keys}
+        for attempt in range(retry.get_attempts()):
+            if attempt:
+                time.sleep(retry.backoff_delay(attempt))
+            response = dynamodb.batch_get_item(RequestItems=request)
+            yield from response["Responses"].get(table_name, [])
+            request = response.get("UnprocessedKeys")
+            if not request:
+                break
+
+
+def _save(profiles, now):
+    table_name = os.getenv("profile_table")
+    if not table_name:
+        return
+    ttl_seconds = _get_int("profile_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+    expires_at = str(int(now) + ttl_seconds)
+    for user_id, profile in profiles.items():
+        try:
+            _write_profile(table_name, user_id, profile, expires_at)
+        except ClientError as e:
+            logging.warning(
+                "Could not write the profile of %s to %s: %s", user_id, table_name, e
+            )
+
+
+# Set the profile of the item rather than replacing it, so that a lookup
+# finishing after an unfollow keeps the unfollowed_at written by it
+def _write_profile(table_name, user_id, profile, expires_at):
+    client_registry.get_aws_client("dynamodb").update_item(
+        TableName=table_name,
+        Key={"pk": {"S": user_id}},
+        UpdateExpression="SET profile = :profile, expires_at = :expires_at",
+        ExpressionAttributeValues={
+            ":profile": {"S": json.dumps(profile.as_json_dict())},
+            ":expires_at": {"N": expires_at},
+        },
+    )
+
+
+# Record when a user unfollowed, keeping the profile for when they follow
+# again, so that profile lookups queued before are not applied afterwards
+def record_unfollow(user_id, timestamp):
+    table_name = os.getenv("profile_table")
+    if not table_name:
+        return
+    ttl_seconds = _get_int("profile_cache_ttl_seconds", DEFAULT_TTL_SECONDS)
+    client_registry.get_aws_client("dynamodb").update_item(
+        TableName=table_name,
+        Key={"pk": {"S": user_id}},
+        UpdateExpression=(
+            "SET unfollowed_at = :timestamp,"
+            " expires_at = if_not_exists(expires_at, :expires_at)"
+        ),
+        ExpressionAttributeValues={
+            ":timestamp": {"N": str(timestamp)},
+            ":expires_at": {"N": str(int(time.time()) + ttl_seconds)},
+        },
+    )
+
+
+# Webhook timestamps in milliseconds of the last unfollow of the given users
+def get_unfollows(user_ids):
+    table_name = os.getenv("profile_table")
+    if not table_name:
+        return {}
+    return {
+        item["pk"]["S"]: int(item["unfollowed_at"]["N"])
+        for item in _batch_get(table_name, user_ids, "pk, unfollowed_at")
+        if "unfollowed_at" in item
+    }
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, entries=len(_profiles))
+
+
+metrics.register_counters(
+    "profile_cache",
+    lambda: {
+        "ProfileCacheHits": stats["hits"],
+        "ProfileTableHits": stats["table_hits"],
+        "ProfileFetches": stats["fetches"],
+    },
+)
@@ -0,0 +1,44 @@
+import json
+import os
+
+import client_registry
+
+# SQS accepts at most 10 messages per SendMessageBatch call
+MAX_MESSAGES_PER_BATCH = 10
+
+
+# Queue profile lookups for followers whose endpoint was written without a
+# display name, with the webhook timestamp of their follow. Returns the IDs
+# of the users that could not be queued
+def enqueue(followers):
+    sqs = client_registry.get_aws_client("sqs")
+    items = list(followers.items())
+    failed = []
+    for i in range(0, len(items), MAX_MESSAGES_PER_BATCH):
+        chunk = items[i : i + MAX_MESSAGES_PER_BATCH]
+        response = sqs.send_message_batch(
+            QueueUrl=os.getenv("profile_queue_url"),
+            Entries=[
+                {
+                    "Id": str(n),
+                    "MessageBody": json.dumps(
+                        {"UserId": user_id, "FollowedAt": followed_at}
+                    ),
+                }
+                for n, (user_id, followed_at) in enumerate(chunk)
+            ],
+        )
+        for entry in response.get("Failed", []):
+            failed.append(chunk[int(entry["Id"])][0])
+    return failed
+
+
+# Endpoint update that only sets the display name, leaving the address and
+# opt out status written on follow as they are
+def endpoint_request(user_id, profile):
+    return {
+        "User": {
+            "UserAttributes": {"DisplayName": [profile.display_name]},
+            "UserId": user_id,
+        }
+    }
@@ -0,0 +1,165 @@
+import logging
+import math
+import os
+import random
+import time
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+import metrics
+
+# Request budget per LINE endpoint class as (requests, window in seconds),
+# following the Messaging API rate limits. Budgets can be lowered per class
+# with the rate_limit_<class> environment variables, e.g. rate_limit_multicast
+DEFAULT_BUDGETS = {
+    "multicast": (200, 1),
+    "push": (2000, 1),
+    "profile": (2000, 1),
+    "broadcast": (60, 3600),
+    "narrowcast": (60, 3600),
+    "audience": (60, 60),
+}
+DEFAULT_TIMEOUT_SECONDS = 10
+# A DynamoDB item takes about 1000 writes per second, so the counter of a
+# window is split over enough items to keep each well below that
+MAX_WRITES_PER_SHARD = 500
+# Errors of a table that is missing or cannot be written by the function, with
+# which nothing would be sent until the deployment is fixed
+CONFIG_ERRORS = ("ResourceNotFoundException", "AccessDeniedException")
+BASE_DELAY_SECONDS = 0.05
+MAX_DELAY_SECONDS = 1
+
+_dynamodb = None
+# Shards found empty in the current window of each endpoint class, skipped
+# until the next window
+_exhausted = {}
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def get_budget(endpoint_class):
+    limit, window_seconds = DEFAULT_BUDGETS[endpoint_class]
+    try:
+        limit = int(os.getenv("rate_limit_" + endpoint_class, limit))
+    except ValueError:
+        pass
+    return limit, window_seconds
+
+
+# Budget of each shard of an endpoint class, the shards splitting the budget
+# of a window as evenly as they can
+def get_shard_budgets(endpoint_class):
+    limit, window_seconds = get_budget(endpoint_class)
+    shards = max(1, math.ceil(limit / window_seconds / MAX_WRITES_PER_SHARD))
+    return [limit // shards + (shard < limit % shards) for shard in range(shards)]
+
+
+# Take count tokens from the bucket of an endpoint class shared by all
+# functions through DynamoDB, waiting for the bucket to be refilled at the
+# start of the next window when it is empty. DynamoDB throttling is retried
+# after a backoff until the timeout
+def acquire(endpoint_class, count=1, timeout=DEFAULT_TIMEOUT_SECONDS):
+    table_name = os.getenv("rate_limit_table")
+    if not table_name:
+        return
+    _, window_seconds = get_budget(endpoint_class)
+    shard_budgets = get_shard_budgets(endpoint_class)
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        now = time.time()
+        window = int(now // window_seconds)
+        try:
+            if _take_any(
+                table_name, endpoint_class, window, window_seconds, shard_budgets, count
+            ):
+                return
+            wait_until = (window + 1) * window_seconds
+            # Spread the waiting callers over the start of the next window
+            delay = wait_until - now + random.uniform(0, min(window_seconds, 1) / 10)
+        except (ClientError, BotoCoreError) as e:
+            if _is_config_error(e):
+                # The limiter cannot work until it is deployed again, which
+                # must not stop sending altogether
+                logging.error("Rate limiter misconfigured, not throttling: %s", e)
+                metrics.put_metrics({"RateLimiterFailOpen": count})
+                return
+            attempt += 1
+            delay = random.uniform(
+                0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2**attempt)
+            )
+            wait_until = now + delay
+            logging.warning("Rate limiter call failed, retrying: %s", e)
+        if wait_until > deadline:
+            raise RateLimitTimeout(
+                "No {} budget left within {} seconds".format(endpoint_class, timeout)
+            )
+        time.sleep(delay)
+
+
+# Take the tokens from the first shard, in random order, that has them left
+def _take_any(table_name, endpoint_class, window, window_seconds, budgets, count):
+    exhausted_window, exhausted = _exhausted.get(endpoint_class, (None, set()))
+    if exhausted_window != window:
+        exhausted = set()
+        _exhausted[endpoint_class] = (window, exhausted)
+    shards = [shard for shard in range(len(budgets)) if shard not in exhausted]
+    random.shuffle(shards)
+    for shard in shards:
+        if _take(
+            table_name,
+            _shard_key(endpoint_class, window, shard),
+            window,
+            window_seconds,
+            budgets[shard],
+            count,
+        ):
+            return True
+        exhausted.add(shard)
+    return False
+
+
+# The first shard keeps the key of the unsharded counter
+def _shard_key(endpoint_class, window, shard):
+    key = "{}#{}".format(endpoint_class, window)
+    return "{}#{}".format(key, shard) if shard else key
+
+
+def _take(table_name, key, window, window_seconds, limit, count):
+    try:
+        _get_dynamodb().update_item(
+            TableName=table_name,
+            Key={"pk": {"S": key}},
+            UpdateExpression=(
+                "ADD used :count"
+                " SET expires_at = if_not_exists(expires_at, :expires_at)"
+            ),
+            ConditionExpression="attribute_not_exists(used) OR used <= :remaining",
+            ExpressionAttributeValues={
+                ":count": {"N": str(count)},
+                ":remaining": {"N": str(limit - count)},
+                ":expires_at": {"N": str((window + 2) * window_seconds)},
+            },
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def _is_config_error(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response["Error"]["Code"] in CONFIG_ERRORS
+    )
+
+
+def _get_dynamodb():
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.client("dynamodb")
+    return _dynamodb
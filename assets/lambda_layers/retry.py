@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from linebot.exceptions import LineBotApiError
+from requests.exceptions import ConnectionError, Timeout
+
+import rate_limiter
+
+try:
+    from aiohttp import ClientConnectionError
+except ImportError:  # aiohttp is only used by the asyncio dispatch mode
+    ClientConnectionError = Timeout
+
+RETRYABLE_ERRORS = (
+    Timeout,
+    ConnectionError,
+    ClientConnectionError,
+    asyncio.TimeoutError,
+    rate_limiter.RateLimitTimeout,
+)
+
+DEFAULT_ATTEMPTS = 4
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 8
+
+# Time kept at the end of an invocation to report the failed chunks, rather
+# than being stopped by the function timeout in a retry
+DEADLINE_MARGIN_SECONDS = 3
+
+# Namespace of the retry keys derived from campaign and recipient IDs
+RETRY_KEY_NAMESPACE = uuid.UUID("0b5cbd8e-4c43-4b55-a7a4-3e3a2f0f5e1c")
+
+_deadline = None
+
+
+def get_attempts():
+    try:
+        return max(1, int(os.getenv("line_api_attempts", DEFAULT_ATTEMPTS)))
+    except ValueError:
+        return DEFAULT_ATTEMPTS
+
+
+# Rate limiting, server errors and network failures are worth another try;
+# any other error (bad request, invalid token, ...) fails the same way again
+def is_retryable(error):
+    if isinstance(error, LineBotApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    # AWS calls, such as Pinpoint endpoint updates, are retried the same way
+    if isinstance(error, ClientError):
+        metadata = error.response.get("ResponseMetadata", {})
+        status_code = metadata.get("HTTPStatusCode", 0)
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+# LINE answers 409 when a request with the same X-Line-Retry-Key was accepted
+def is_already_accepted(error):
+    return (
+        isinstance(error, LineBotApiError)
+        and error.status_code == 409
+        and bool(error.accepted_request_id)
+    )
+
+
+# Bound the retries and rate limit waits of the invocation by the time the
+# Lambda context has left, or remove the bound when there is no context
+def set_deadline(context):
+    global _deadline
+    if context is None:
+        _deadline = None
+        return
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    _deadline = time.time() + remaining_seconds - DEADLINE_MARGIN_SECONDS
+
+
+# Seconds left before the deadline, at most limit
+def time_left(limit):
+    if _deadline is None:
+        return limit
+    return max(0, min(limit, _deadline - time.time()))
+
+
+# Exponential backoff with full jitter
+def backoff_delay(attempt):
+    return random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2**attempt))
+
+
+# Call func until it succeeds, retrying retryable errors with backoff
+def call_with_retry(func, attempts=None):
+    attempts = attempts or get_attempts()
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if not _should_retry(e, attempt, attempts, delay):
+                raise
+            logging.warning("API call failed (%r), retrying in %.2f seconds", e, delay)
+            time.sleep(delay)
+
+
+# Coroutine version of call_with_retry
+async def call_with_retry_async(func, attempts=None):
+    attempts = attempts or get_attempts()
+    for attempt in range(attempts):
+        try:
+            return await func()
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if not _should_retry(e, attempt, attempts, delay):
+                raise
+            logging.warning("API call failed (%r), retrying in %.2f seconds", e, delay)
+            await asyncio.sleep(delay)
+
+
+# Retry while attempts are left and the deadline leaves time for another call
+# after the backoff
+def _should_retry(error, attempt, attempts, delay):
+    return (
+        is_retryable(error) and attempt < attempts - 1 and time_left(delay + 1) > delay
+    )
+
+
+# Stable X-Line-Retry-Key for the same parts, so that a request sent again
+# (by a retry, a Lambda retry or an SQS redelivery) is delivered only once
+def retry_key(*parts):
+    return str(uuid.uuid5(RETRY_KEY_NAMESPACE, json.dumps(parts, sort_keys=True)))
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import boto3
+from linebot.exceptions import LineBotApiError
+
+import metrics
+
+# Secrets are kept for this many seconds per execution environment before
+# being fetched again from Secrets Manager
+DEFAULT_TTL_SECONDS = 300
+
+_lock = threading.Lock()
+_secrets = {}
+_client = None
+stats = {"hits": 0, "misses": 0, "refreshes": 0}
+
+
+def get_ttl_seconds():
+    try:
+        return int(os.getenv("secret_ttl_seconds", DEFAULT_TTL_SECONDS))
+    except ValueError:
+        return DEFAULT_TTL_SECONDS
+
+
+# Function to get secret, served from the cache while it is still fresh
+def get_secret(secret_arn=None, force_refresh=False):
+    secret_arn = secret_arn or os.getenv("secret_arn")
+    now = time.monotonic()
+    with _lock:
+        cached = _secrets.get(secret_arn)
+        if cached is not None and not force_refresh and cached[1] > now:
+            stats["hits"] += 1
+            return cached[0]
+        if force_refresh:
+            stats["refreshes"] += 1
+        else:
+            stats["misses"] += 1
+        secret = _fetch_secret(secret_arn)
+        _secrets[secret_arn] = (secret, now + get_ttl_seconds())
+        return secret
+
+
+# Drop cached secrets so that the next call goes to Secrets Manager
+def invalidate(secret_arn=None):
+    with _lock:
+        if secret_arn is None:
+            _secrets.clear()
+        else:
+            _secrets.pop(secret_arn, None)
+
+
+# Run func(secret) and retry it once with a freshly fetched secret when LINE
+# rejects the cached channel access token, e.g. right after a rotation
+def call_with_secret(func, secret_arn=None):
+    secret = get_secret(secret_arn)
+    try:
+        return func(secret)
+    except LineBotApiError as e:
+        if e.status_code != 401:
+            raise
+        logging.warning("LINE returned 401, refreshing cached secret")
+        secret = get_secret(secret_arn, force_refresh=True)
+        return func(secret)
+
+
+def get_stats():
+    return dict(stats)
+
+
+def _get_client():
+    # Create the Secrets Manager client once per execution environment
+    global _client
+    if _client is None:
+        session = boto3.session.Session()
+        _client = session.client(
+            service_name="secretsmanager", region_name=os.getenv("secret_region")
+        )
+    return _client
+
+
+def _fetch_secret(secret_arn):
+    get_secret_value_response = _get_client().get_secret_value(SecretId=secret_arn)
+    # Decrypts secret using the associated KMS key and return a dict
+    return json.loads(get_secret_value_response["SecretString"])
+
+
+metrics.register_counters(
+    "secret_cache",
+    lambda: {
+        "SecretCacheHits": stats["hits"],
+        "SecretCacheMisses": stats["misses"],
+        "SecretCacheRefreshes": stats["refreshes"],
+    },
+)
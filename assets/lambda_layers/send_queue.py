@@ -0,0 +1,72 @@
+import json
+import os
+
+import client_registry
+import dispatcher
+import message_builders
+import payload_cache
+import templates
+
+# Pinpoint event fields that identify the message, so that jobs queued by
+# different invocations of the same campaign can be merged by the worker
+JOB_FIELDS = dispatcher.CAMPAIGN_FIELDS
+
+
+# "direct" sends from the send* functions, "coalesce" queues the recipients so
+# the drainSendQueue worker can merge them into full multicasts and "async"
+# queues them so the worker sends at its own pace while Pinpoint returns
+def get_send_mode():
+    return os.getenv("send_mode", "direct")
+
+
+def is_queued():
+    return get_send_mode() != "direct"
+
+
+# Queue the recipients of a Pinpoint custom channel event for the worker. The
+# message is built up front through the payload cache the worker uses, so an
+# invalid payload is rejected here instead of failing later in the queue, and
+# later invocations of the campaign reuse the built message
+def enqueue(kind, event):
+    job = {field: event.get(field) for field in JOB_FIELDS}
+    job["Kind"] = kind
+    job["Data"] = event.get("Data")
+    job["Recipients"] = dispatcher.get_recipients(event)
+    # Personalized texts are rendered by the worker from the endpoint attributes
+    if kind == "text" and templates.is_personalized(job["Data"]):
+        job["Endpoints"] = event["Endpoints"]
+    validate(job)
+    client_registry.get_aws_client("sqs").send_message(
+        QueueUrl=os.getenv("send_queue_url"), MessageBody=json.dumps(job)
+    )
+    return job
+
+
+# Queue a job again for some of its recipients only, e.g. those whose chunk
+# failed while the others were delivered
+def requeue(job, recipients):
+    job = dict(job, Recipients=list(recipients))
+    if job.get("Endpoints"):
+        job["Endpoints"] = {
+            endpoint_id: endpoint
+            for endpoint_id, endpoint in job["Endpoints"].items()
+            if endpoint["Address"] in recipients
+        }
+    client_registry.get_aws_client("sqs").send_message(
+        QueueUrl=os.getenv("send_queue_url"), MessageBody=json.dumps(job)
+    )
+    return job
+
+
+# Jobs with the same key produce byte-identical messages
+def job_key(job):
+    return dispatcher.campaign_key(job["Kind"], job)
+
+
+# Raise ValueError, KeyError or botocore's ClientError for jobs that cannot be sent
+def validate(job):
+    if job["Kind"] not in message_builders.BUILDERS:
+        raise ValueError("Unknown message kind: {}".format(job["Kind"]))
+    if not job["Recipients"]:
+        raise ValueError("No recipients in event")
+    payload_cache.get_messages(job["Kind"], job)
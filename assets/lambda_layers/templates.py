@@ -0,0 +1,135 @@
+import re
+import threading
+from collections import OrderedDict
+
+from linebot.models import TextSendMessage
+
+import message_builders
+
+# {{Path.To.Attribute}} or {{Path.To.Attribute|fallback}}, resolved against the
+# Pinpoint endpoint of each recipient, e.g. {{User.UserAttributes.DisplayName|there}}
+PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z0-9_.\-]+)\s*(?:\|([^}]*))?\}\}")
+# Variant of a localized template used when no locale of the endpoint matches
+DEFAULT_VARIANT = "default"
+MAX_CACHED_CAMPAIGNS = 64
+
+_lock = threading.Lock()
+_compiled = OrderedDict()
+stats = {"hits": 0, "misses": 0}
+
+
+# A text campaign is personalized when its text is a locale map, even with a
+# single entry, or contains a placeholder
+def is_personalized(data):
+    text = data.get("Text") if isinstance(data, dict) else data
+    return isinstance(text, dict) or any(
+        PLACEHOLDER.search(text) for text in _variants(data).values()
+    )
+
+
+# Render the text of every endpoint and group the recipients whose rendered
+# messages are byte-identical, returning (message, recipients) pairs
+def render_groups(endpoints, data, campaign_key):
+    template = get_template(campaign_key, data)
+    groups = OrderedDict()
+    for endpoint in endpoints.values():
+        text = template.render(endpoint)
+        groups.setdefault(text, []).append(endpoint["Address"])
+    return [
+        (TextSendMessage(text=text), recipients) for text, recipients in groups.items()
+    ]
+
+
+# Compiled templates are kept per campaign key, least recently used first out
+def get_template(campaign_key, data):
+    with _lock:
+        template = _compiled.get(campaign_key)
+        if template is not None:
+            _compiled.move_to_end(campaign_key)
+            stats["hits"] += 1
+            return template
+        stats["misses"] += 1
+    template = Template(_variants(data))
+    with _lock:
+        _compiled[campaign_key] = template
+        while len(_compiled) > MAX_CACHED_CAMPAIGNS:
+            _compiled.popitem(last=False)
+    return template
+
+
+# Text of the campaign for a recipient without an endpoint, i.e. the default
+# variant with the fallbacks of its placeholders
+def render_default(data):
+    return Template(_variants(data)).render({})
+
+
+def get_stats():
+    return dict(stats)
+
+
+class Template:
+    def __init__(self, variants):
+        self.variants = {
+            locale.lower(): _compile(text) for locale, text in variants.items()
+        }
+
+    def render(self, endpoint):
+        parts = self._select(endpoint)
+        return "".join(
+            part if isinstance(part, str) else _resolve(endpoint, *part)
+            for part in parts
+        )
+
+    # Pick the variant for the endpoint locale, e.g. "ja_JP", then its
+    # language, e.g. "ja", and finally the default variant
+    def _select(self, endpoint):
+        locale = _lookup(endpoint, ["Demographic", "Locale"]) or ""
+        locale = locale.replace("-", "_").lower()
+        for candidate in (locale, locale.split("_")[0], DEFAULT_VARIANT):
+            if candidate in self.variants:
+                return self.variants[candidate]
+        return next(iter(self.variants.values()))
+
+
+# Split a template into literal strings and (path, fallback) placeholders
+def _compile(text):
+    parts = []
+    position = 0
+    for match in PLACEHOLDER.finditer(text):
+        if match.start() > position:
+            parts.append(text[position : match.start()])
+        parts.append((match.group(1).split("."), match.group(2) or ""))
+        position = match.end()
+    if position < len(text):
+        parts.append(text[position:])
+    return parts
+
+
+def _resolve(endpoint, path, fallback):
+    value = _lookup(endpoint, path)
+    if value is None or value == "":
+        return fallback
+    return str(value)
+
+
+def _lookup(endpoint, path):
+    value = endpoint
+    for name in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    # Pinpoint user and custom attributes are lists of values
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+# The text campaign data is either the text itself or {"Text": ...}, where
+# the text can also be a map of locale to text with a "default" entry
+def _variants(data):
+    text = data.get("Text") if isinstance(data, dict) else data
+    if text is None:
+        text = message_builders.DEFAULT_TEXT
+    if isinstance(text, dict):
+        return {locale: str(value) for locale, value in text.items()}
+    return {DEFAULT_VARIANT: str(text)}
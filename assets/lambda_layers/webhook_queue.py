@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+
+import client_registry
+
+# SQS accepts at most 10 messages per SendMessageBatch call
+MAX_MESSAGES_PER_BATCH = 10
+
+
+# Raised when SQS did not accept every event, so the webhook fails and LINE
+# delivers the events again
+class EnqueueError(Exception):
+    pass
+
+
+# Events of the same user, group or room share a message group of the FIFO
+# queue, so they are handled in order while others are handled in parallel
+def message_group_id(event):
+    source = event.get("source") or {}
+    return (
+        source.get("userId")
+        or source.get("groupId")
+        or source.get("roomId")
+        or event.get("type", "webhook")
+    )
+
+
+# The webhook event ID, so SQS drops an event delivered again within its five
+# minute deduplication interval
+def deduplication_id(event):
+    if event.get("webhookEventId"):
+        return event["webhookEventId"]
+    return hashlib.sha256(json.dumps(event, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Queue the events of a webhook delivery for processWebhookEvents
+def enqueue(events):
+    sqs = client_registry.get_aws_client("sqs")
+    for i in range(0, len(events), MAX_MESSAGES_PER_BATCH):
+        entries = [
+            {
+                "Id": str(n),
+                "MessageBody": json.dumps(event),
+                "MessageGroupId": message_group_id(event),
+                "MessageDeduplicationId": deduplication_id(event),
+            }
+            for n, event in enumerate(events[i : i + MAX_MESSAGES_PER_BATCH])
+        ]
+        response = sqs.send_message_batch(
+            QueueUrl=os.getenv("webhook_queue_url"), Entries=entries
+        )
+        if response.get("Failed"):
+            raise EnqueueError(
+                "Could not queue {} webhook events: {}".format(
+                    len(response["Failed"]), response["Failed"]
+                )
+            )
+    return len(events)
@@ -11,6 +11,12 @@ from aws_cdk import (
     aws_s3 as _s3,
     aws_s3_deployment as _s3_deploy,
     aws_cloudfront as _cloudfront,
+    aws_cloudfront_origins as _origins,
+    aws_sqs as _sqs,
+    aws_dynamodb as _dynamodb,
+    aws_lambda_event_sources as _event_sources,
+    aws_s3_notifications as _s3_notifications,
+    Duration,
     RemovalPolicy,
 )
 from constructs import Construct
@@ -21,8 +27,21 @@ from aws_solutions_constructs.aws_cloudfront_apigateway_lambda import (
 
 
 class Part1Stack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        send_mode: str = "direct",
+        send_batch_size: int = 100,
+        send_batch_window: Duration = Duration.seconds(5),
+        send_worker_concurrency: int = 5,
+        narrowcast_threshold: int = 0,
+        media_public_key: str = None,
+        **kwargs
+    ) -> None:
         super().__init__(scope, construct_id, **kwargs)
+        if send_mode not in ("direct", "coalesce", "async"):
+            raise ValueError("send_mode must be one of: direct, coalesce, async")
 
         # Initialize Bucket
         image_bucket = _s3.Bucket(
@@ -97,6 +116,116 @@ class Part1Stack(Stack):
             },
         )
 
+        # Serve campaign media through CloudFront signed URLs when a public key
+        # is given, so LINE fetches repeated assets from the edge cache
+        if media_public_key is not None:
+            media_signing_public_key = _cloudfront.PublicKey(
+                self, "media_public_key", encoded_key=media_public_key
+            )
+            media_key_group = _cloudfront.KeyGroup(
+                self, "media_key_group", items=[media_signing_public_key]
+            )
+            # Placeholder for the matching private key, used to sign the URLs
+            media_signing_key = _secrets.Secret(
+                self,
+                "media-signing-key",
+                secret_name="line_media_signing_key",
+                secret_object_value={
+                    "private_key": SecretValue.unsafe_plain_text("INSERT_PRIVATE_KEY"),
+                },
+            )
+            # Objects are requested as /<image|audio|video>/<key>, the prefix
+            # picks the bucket and is removed before the request reaches S3
+            strip_media_prefix = _cloudfront.Function(
+                self,
+                "strip_media_prefix",
+                runtime=_cloudfront.FunctionRuntime.JS_2_0,
+                code=_cloudfront.FunctionCode.from_inline(
+                    "function handler(event) {\n"
+                    "  var request = event.request;\n"
+                    "  request.uri = request.uri.replace(/^\\/[^\\/]+/, '');\n"
+                    "  return request;\n"
+                    "}"
+                ),
+            )
+            media_origins = {
+                kind: _origins.S3BucketOrigin.with_origin_access_control(bucket)
+                for kind, bucket in [
+                    ("image", image_bucket),
+                    ("audio", audio_bucket),
+                    ("video", video_bucket),
+                ]
+            }
+
+            def media_behavior(origin, function_associations):
+                return _cloudfront.BehaviorOptions(
+                    origin=origin,
+                    viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
+                    # The signature query string is not part of the cache key
+                    cache_policy=_cloudfront.CachePolicy.CACHING_OPTIMIZED,
+                    trusted_key_groups=[media_key_group],
+                    function_associations=function_associations,
+                )
+
+            strip_media_prefix_association = _cloudfront.FunctionAssociation(
+                function=strip_media_prefix,
+                event_type=_cloudfront.FunctionEventType.VIEWER_REQUEST,
+            )
+            media_distribution = _cloudfront.Distribution(
+                self,
+                "media_distribution",
+                default_behavior=media_behavior(media_origins["image"], []),
+                additional_behaviors={
+                    kind
+                    + "/*": media_behavior(origin, [strip_media_prefix_association])
+                    for kind, origin in media_origins.items()
+                },
+                minimum_protocol_version=_cloudfront.SecurityPolicyProtocol.TLS_V1_2_2021,
+            )
+            media_environment = {
+                "media_domain": media_distribution.distribution_domain_name,
+                "media_key_pair_id": media_signing_public_key.public_key_id,
+                "media_key_secret_arn": media_signing_key.secret_arn,
+            }
+
+        # Create the table holding the LINE API rate limit buckets shared by all functions
+        rate_limit_table = _dynamodb.Table(
+            self,
+            "rate_limit_table",
+            partition_key=_dynamodb.Attribute(
+                name="pk", type=_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        # Create the table guarding work that must happen only once, such as
+        # broadcasting a campaign
+        idempotency_table = _dynamodb.Table(
+            self,
+            "idempotency_table",
+            partition_key=_dynamodb.Attribute(
+                name="pk", type=_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        # Create the table caching LINE profiles, so followers coming back
+        # do not need another profile lookup
+        profile_table = _dynamodb.Table(
+            self,
+            "profile_table",
+            partition_key=_dynamodb.Attribute(
+                name="pk", type=_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
         # Create a lambda layer that is shared between different functions
         shared_lambda_layer = _python.PythonLayerVersion(
             self,
@@ -104,6 +233,9 @@ class Part1Stack(Stack):
             entry="./assets/lambda_layers",
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
         )
+        # Sending functions wait for the rate limits and retry failed calls,
+        # which takes longer than the default timeout of 3 seconds
+        send_timeout = Duration.minutes(1)
         # Create sendText Lambda Function
         send_text_lambda = _python.PythonFunction(
             self,
@@ -114,9 +246,12 @@ class Part1Stack(Stack):
             handler="lambda_handler",
             description="Lambda function used by Amazon Pinpoint to send Text messages via LINE",
             layers=[shared_lambda_layer],
+            timeout=send_timeout,
             environment={
                 "secret_arn": line_credentials.secret_arn,
                 "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
             },
         )
         # Create sendImage Lambda Function
@@ -129,9 +264,12 @@ class Part1Stack(Stack):
             handler="lambda_handler",
             description="Lambda function used by Amazon Pinpoint to send Image messages via LINE",
             layers=[shared_lambda_layer],
+            timeout=send_timeout,
             environment={
                 "secret_arn": line_credentials.secret_arn,
                 "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
                 "image_bucket": image_bucket.bucket_name,
             },
         )
@@ -145,9 +283,12 @@ class Part1Stack(Stack):
             handler="lambda_handler",
             description="Lambda function used by Amazon Pinpoint to send Audio messages via LINE",
             layers=[shared_lambda_layer],
+            timeout=send_timeout,
             environment={
                 "secret_arn": line_credentials.secret_arn,
                 "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
                 "audio_bucket": audio_bucket.bucket_name,
             },
         )
@@ -161,12 +302,134 @@ class Part1Stack(Stack):
             handler="lambda_handler",
             description="Lambda function used by Amazon Pinpoint to send Video messages via LINE",
             layers=[shared_lambda_layer],
+            timeout=send_timeout,
+            environment={
+                "secret_arn": line_credentials.secret_arn,
+                "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
+                "video_bucket": video_bucket.bucket_name,
+            },
+        )
+        # Create sendImagemap Lambda Function
+        send_imagemap_lambda = _python.PythonFunction(
+            self,
+            "send_imagemap_lambda",
+            entry="./assets/lambda_functions",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            index="sendImagemap.py",
+            handler="lambda_handler",
+            description="Lambda function used by Amazon Pinpoint to send Imagemap messages via LINE",
+            layers=[shared_lambda_layer],
+            timeout=send_timeout,
             environment={
                 "secret_arn": line_credentials.secret_arn,
                 "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
+                "image_bucket": image_bucket.bucket_name,
+            },
+        )
+        # Create sendBundle Lambda Function
+        send_bundle_lambda = _python.PythonFunction(
+            self,
+            "send_bundle_lambda",
+            entry="./assets/lambda_functions",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            index="sendBundle.py",
+            handler="lambda_handler",
+            description="Lambda function used by Amazon Pinpoint to send bundles of up to 5 messages via LINE",
+            layers=[shared_lambda_layer],
+            timeout=send_timeout,
+            environment={
+                "secret_arn": line_credentials.secret_arn,
+                "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "idempotency_table": idempotency_table.table_name,
+                "image_bucket": image_bucket.bucket_name,
+                "audio_bucket": audio_bucket.bucket_name,
                 "video_bucket": video_bucket.bucket_name,
             },
         )
+        # Create a lambda layer with Pillow for the media processing function
+        pillow_lambda_layer = _python.PythonLayerVersion(
+            self,
+            "pillow_lambda_layer",
+            entry="./assets/pillow_layer",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+        )
+        # Create processMedia Lambda Function
+        process_media_lambda = _python.PythonFunction(
+            self,
+            "process_media_lambda",
+            entry="./assets/lambda_functions",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            index="processMedia.py",
+            handler="lambda_handler",
+            description="Lambda function that checks uploaded media against LINE limits and writes previews and manifests",
+            layers=[shared_lambda_layer, pillow_lambda_layer],
+            timeout=Duration.minutes(1),
+            memory_size=1024,
+        )
+        # Process media files when they are uploaded. The manifests and imagemap
+        # tiles processMedia writes into the same buckets have other suffixes,
+        # and the previews it writes are skipped by the function itself
+        image_suffixes = [".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"]
+        media_suffixes = {
+            image_bucket: image_suffixes,
+            audio_bucket: [".mp3", ".m4a"],
+            video_bucket: [".mp4"] + image_suffixes,
+        }
+        for media_bucket, suffixes in media_suffixes.items():
+            for suffix in suffixes:
+                # Suffix filters are case sensitive
+                for cased_suffix in [suffix, suffix.upper()]:
+                    media_bucket.add_event_notification(
+                        _s3.EventType.OBJECT_CREATED,
+                        _s3_notifications.LambdaDestination(process_media_lambda),
+                        _s3.NotificationKeyFilter(suffix=cased_suffix),
+                    )
+            media_bucket.grant_read_write(process_media_lambda)
+        # Verified webhook events are queued per user in a FIFO queue, so the
+        # webhook answers LINE right away and each user's events stay in order
+        webhook_dead_letter_queue = _sqs.Queue(
+            self,
+            "webhook_dead_letter_queue",
+            fifo=True,
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            retention_period=Duration.days(14),
+        )
+        webhook_queue = _sqs.Queue(
+            self,
+            "webhook_queue",
+            fifo=True,
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            visibility_timeout=Duration.minutes(6),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=webhook_dead_letter_queue
+            ),
+        )
+        # Followers whose profile is not cached are queued for a worker that
+        # looks up their display names in bulk
+        profile_dead_letter_queue = _sqs.Queue(
+            self,
+            "profile_dead_letter_queue",
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            retention_period=Duration.days(14),
+        )
+        profile_queue = _sqs.Queue(
+            self,
+            "profile_queue",
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            visibility_timeout=Duration.minutes(12),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=profile_dead_letter_queue
+            ),
+        )
         # Create receive event Lambda Function
         receive_event_lambda = _python.PythonFunction(
             self,
@@ -180,11 +443,37 @@ class Part1Stack(Stack):
             environment={
                 "secret_arn": line_credentials.secret_arn,
                 "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "webhook_queue_url": webhook_queue.queue_url,
+            },
+        )
+        webhook_queue.grant_send_messages(receive_event_lambda)
+        # Create processWebhookEvents Lambda Function
+        process_webhook_events_lambda = _python.PythonFunction(
+            self,
+            "process_webhook_events_lambda",
+            entry="./assets/lambda_functions",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            index="processWebhookEvents.py",
+            handler="lambda_handler",
+            description="Lambda function that updates Pinpoint endpoints from queued LINE events",
+            layers=[shared_lambda_layer],
+            timeout=Duration.minutes(1),
+            environment={
+                "idempotency_table": idempotency_table.table_name,
+                "profile_table": profile_table.table_name,
+                "profile_queue_url": profile_queue.queue_url,
                 "pinpoint_app_id": pinpoint_project.ref,
             },
         )
-        # Grant receive event lambda access to Pinpoint to update endpoints
-        receive_event_lambda.role.add_to_principal_policy(
+        profile_table.grant_read_write_data(process_webhook_events_lambda)
+        profile_queue.grant_send_messages(process_webhook_events_lambda)
+        process_webhook_events_lambda.add_event_source(
+            _event_sources.SqsEventSource(
+                webhook_queue, batch_size=10, report_batch_item_failures=True
+            )
+        )
+        # Grant process webhook events lambda access to Pinpoint to update endpoints
+        process_webhook_events_lambda.role.add_to_principal_policy(
             _iam.PolicyStatement(
                 effect=_iam.Effect.ALLOW,
                 resources=[pinpoint_project.attr_arn + "/endpoints/*"],
@@ -195,7 +484,46 @@ class Part1Stack(Stack):
                 ],
             )
         )
-        # Grant Pinpoint Campaigns ability to invoke send Text/Image/Audio/Video lambda
+        # Create enrichProfiles Lambda Function
+        enrich_profiles_lambda = _python.PythonFunction(
+            self,
+            "enrich_profiles_lambda",
+            entry="./assets/lambda_functions",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            index="enrichProfiles.py",
+            handler="lambda_handler",
+            description="Lambda function that adds LINE display names to Pinpoint endpoints",
+            layers=[shared_lambda_layer],
+            timeout=Duration.minutes(2),
+            environment={
+                "secret_arn": line_credentials.secret_arn,
+                "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                "rate_limit_table": rate_limit_table.table_name,
+                "profile_table": profile_table.table_name,
+                "pinpoint_app_id": pinpoint_project.ref,
+            },
+        )
+        # Profile lookups are collected for up to 30 seconds and made in bulk
+        enrich_profiles_lambda.add_event_source(
+            _event_sources.SqsEventSource(
+                profile_queue,
+                batch_size=100,
+                max_batching_window=Duration.seconds(30),
+                report_batch_item_failures=True,
+            )
+        )
+        profile_table.grant_read_write_data(enrich_profiles_lambda)
+        enrich_profiles_lambda.role.add_to_principal_policy(
+            _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                resources=[pinpoint_project.attr_arn + "/endpoints/*"],
+                actions=[
+                    "mobiletargeting:UpdateEndpoint",
+                    "mobiletargeting:UpdateEndpointsBatch",
+                ],
+            )
+        )
+        # Grant Pinpoint Campaigns ability to invoke send Text/Image/Audio/Video/Imagemap/Bundle lambda
         send_text_lambda.grant_invoke(
             _iam.ServicePrincipal(
                 service="pinpoint.amazonaws.com",
@@ -236,7 +564,27 @@ class Part1Stack(Stack):
                 },
             )
         )
-        # Grant Pinpoint Journeys ability to invoke send Text/Image/Audio/Video lambda
+        send_imagemap_lambda.grant_invoke(
+            _iam.ServicePrincipal(
+                service="pinpoint.amazonaws.com",
+                conditions={
+                    "ArnLike": {
+                        "aws:SourceArn": pinpoint_project.attr_arn + "/campaigns/*",
+                    }
+                },
+            )
+        )
+        send_bundle_lambda.grant_invoke(
+            _iam.ServicePrincipal(
+                service="pinpoint.amazonaws.com",
+                conditions={
+                    "ArnLike": {
+                        "aws:SourceArn": pinpoint_project.attr_arn + "/campaigns/*",
+                    }
+                },
+            )
+        )
+        # Grant Pinpoint Journeys ability to invoke send Text/Image/Audio/Video/Imagemap/Bundle lambda
         send_text_lambda.grant_invoke(
             _iam.ServicePrincipal(
                 service="pinpoint.amazonaws.com",
@@ -277,16 +625,156 @@ class Part1Stack(Stack):
                 },
             )
         )
+        send_imagemap_lambda.grant_invoke(
+            _iam.ServicePrincipal(
+                service="pinpoint.amazonaws.com",
+                conditions={
+                    "ArnLike": {
+                        "aws:SourceArn": pinpoint_project.attr_arn + "/journeys/*",
+                    }
+                },
+            )
+        )
+        send_bundle_lambda.grant_invoke(
+            _iam.ServicePrincipal(
+                service="pinpoint.amazonaws.com",
+                conditions={
+                    "ArnLike": {
+                        "aws:SourceArn": pinpoint_project.attr_arn + "/journeys/*",
+                    }
+                },
+            )
+        )
         # Grant Lambdas access to corresponding S3 buckets
         image_bucket.grant_read(send_image_lambda)
         audio_bucket.grant_read(send_audio_lambda)
         video_bucket.grant_read(send_video_lambda)
+        image_bucket.grant_read(send_imagemap_lambda)
+        image_bucket.grant_read(send_bundle_lambda)
+        audio_bucket.grant_read(send_bundle_lambda)
+        video_bucket.grant_read(send_bundle_lambda)
         ## Grant Lambdas access to Secret
         line_credentials.grant_read(grantee=send_text_lambda)
         line_credentials.grant_read(grantee=send_image_lambda)
         line_credentials.grant_read(grantee=send_audio_lambda)
         line_credentials.grant_read(grantee=send_video_lambda)
+        line_credentials.grant_read(grantee=send_imagemap_lambda)
+        line_credentials.grant_read(grantee=send_bundle_lambda)
         line_credentials.grant_read(grantee=receive_event_lambda)
+        line_credentials.grant_read(grantee=enrich_profiles_lambda)
+        ## Grant Lambdas access to the rate limit table
+        rate_limit_table.grant_read_write_data(send_text_lambda)
+        rate_limit_table.grant_read_write_data(send_image_lambda)
+        rate_limit_table.grant_read_write_data(send_audio_lambda)
+        rate_limit_table.grant_read_write_data(send_video_lambda)
+        rate_limit_table.grant_read_write_data(send_imagemap_lambda)
+        rate_limit_table.grant_read_write_data(send_bundle_lambda)
+        rate_limit_table.grant_read_write_data(enrich_profiles_lambda)
+        ## Grant Lambdas access to the idempotency table
+        idempotency_table.grant_read_write_data(send_text_lambda)
+        idempotency_table.grant_read_write_data(send_image_lambda)
+        idempotency_table.grant_read_write_data(send_audio_lambda)
+        idempotency_table.grant_read_write_data(send_video_lambda)
+        idempotency_table.grant_read_write_data(send_imagemap_lambda)
+        idempotency_table.grant_read_write_data(send_bundle_lambda)
+        idempotency_table.grant_read_write_data(process_webhook_events_lambda)
+
+        # Queue recipients for a worker that merges them into full multicasts
+        # (coalesce) or sends them at a controlled rate (async)
+        if send_mode != "direct":
+            send_dead_letter_queue = _sqs.Queue(
+                self,
+                "send_dead_letter_queue",
+                encryption=_sqs.QueueEncryption.SQS_MANAGED,
+                enforce_ssl=True,
+                retention_period=Duration.days(14),
+            )
+            send_queue = _sqs.Queue(
+                self,
+                "send_queue",
+                encryption=_sqs.QueueEncryption.SQS_MANAGED,
+                enforce_ssl=True,
+                visibility_timeout=Duration.minutes(12),
+                dead_letter_queue=_sqs.DeadLetterQueue(
+                    max_receive_count=5, queue=send_dead_letter_queue
+                ),
+            )
+            # Create drainSendQueue Lambda Function
+            drain_send_queue_lambda = _python.PythonFunction(
+                self,
+                "drain_send_queue_lambda",
+                entry="./assets/lambda_functions",
+                runtime=_lambda.Runtime.PYTHON_3_9,
+                index="drainSendQueue.py",
+                handler="lambda_handler",
+                description="Lambda function that merges queued recipients and sends LINE messages",
+                layers=[shared_lambda_layer],
+                timeout=Duration.minutes(2),
+                # Caps the worker pool, and with it the rate of LINE API calls
+                reserved_concurrent_executions=send_worker_concurrency,
+                environment={
+                    "secret_arn": line_credentials.secret_arn,
+                    "secret_region": os.environ["CDK_DEFAULT_REGION"],
+                    "rate_limit_table": rate_limit_table.table_name,
+                    "idempotency_table": idempotency_table.table_name,
+                    "image_bucket": image_bucket.bucket_name,
+                    "audio_bucket": audio_bucket.bucket_name,
+                    "video_bucket": video_bucket.bucket_name,
+                    "send_queue_url": send_queue.queue_url,
+                    "narrowcast_threshold": str(narrowcast_threshold),
+                },
+            )
+            # The worker queues delayed narrowcast progress checks for itself
+            send_queue.grant_send_messages(drain_send_queue_lambda)
+            # In async mode jobs are picked up right away, without a batching
+            # window, which limits a batch to 10 jobs
+            if send_mode == "coalesce":
+                send_event_source = _event_sources.SqsEventSource(
+                    send_queue,
+                    batch_size=send_batch_size,
+                    max_batching_window=send_batch_window,
+                    report_batch_item_failures=True,
+                )
+            else:
+                send_event_source = _event_sources.SqsEventSource(
+                    send_queue,
+                    batch_size=min(send_batch_size, 10),
+                    report_batch_item_failures=True,
+                )
+            drain_send_queue_lambda.add_event_source(send_event_source)
+            image_bucket.grant_read(drain_send_queue_lambda)
+            audio_bucket.grant_read(drain_send_queue_lambda)
+            video_bucket.grant_read(drain_send_queue_lambda)
+            line_credentials.grant_read(grantee=drain_send_queue_lambda)
+            rate_limit_table.grant_read_write_data(drain_send_queue_lambda)
+            idempotency_table.grant_read_write_data(drain_send_queue_lambda)
+            for send_lambda in [
+                send_text_lambda,
+                send_image_lambda,
+                send_audio_lambda,
+                send_video_lambda,
+                send_imagemap_lambda,
+                send_bundle_lambda,
+            ]:
+                send_lambda.add_environment("send_mode", send_mode)
+                send_lambda.add_environment("send_queue_url", send_queue.queue_url)
+                send_queue.grant_send_messages(send_lambda)
+
+        # Let the media senders sign CloudFront URLs
+        if media_public_key is not None:
+            media_lambdas = [
+                send_image_lambda,
+                send_audio_lambda,
+                send_video_lambda,
+                send_imagemap_lambda,
+                send_bundle_lambda,
+            ]
+            if send_mode != "direct":
+                media_lambdas.append(drain_send_queue_lambda)
+            for media_lambda in media_lambdas:
+                for name, value in media_environment.items():
+                    media_lambda.add_environment(name, value)
+                media_signing_key.grant_read(grantee=media_lambda)
 
         # Generate CloudFront APIGateway To Lambda Architecture
         CloudFrontToApiGatewayToLambda(
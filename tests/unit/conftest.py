@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# Make the shared Lambda layer modules importable, as they are in /opt/python,
+# and the Lambda function handlers
+for path in ["lambda_layers", "lambda_functions"]:
+    sys.path.insert(
+        0, os.path.join(os.path.dirname(__file__), "..", "..", "assets", path)
+    )
+
+
+# Fake credentials for the AWS clients the layer modules create on import, so
+# the tests import those modules in their fixtures, after this one has run
+@pytest.fixture(autouse=True)
+def aws_credentials(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
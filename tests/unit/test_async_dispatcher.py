@@ -0,0 +1,129 @@
+import asyncio
+import functools
+
+import pytest
+from aiohttp import web
+from linebot.models import TextSendMessage
+
+
+# LINE API answering multicasts with the queued statuses, then with 200
+class LineApi:
+    def __init__(self):
+        self.answers = []
+        self.retry_keys = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def multicast(self, request):
+        self.retry_keys.append(request.headers["X-Line-Retry-Key"])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        status, headers = self.answers.pop(0) if self.answers else (200, {})
+        body = {} if status == 200 else {"message": "error"}
+        return web.json_response(body, status=status, headers=headers)
+
+
+@pytest.fixture
+def async_dispatcher(monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "1")
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    import async_dispatcher
+
+    monkeypatch.setattr(async_dispatcher.retry, "_deadline", None)
+    monkeypatch.setattr(async_dispatcher.retry, "backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(
+        async_dispatcher.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": "secret",
+        },
+    )
+    return async_dispatcher
+
+
+@pytest.fixture
+def line_api(async_dispatcher, monkeypatch):
+    api = LineApi()
+    app = web.Application()
+    app.router.add_post("/v2/bot/message/multicast", api.multicast)
+    runner = web.AppRunner(app)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    # The server runs on the event loop of the dispatcher
+    monkeypatch.setattr(async_dispatcher, "_loop", loop)
+    monkeypatch.setattr(async_dispatcher, "_session", None)
+    monkeypatch.setattr(async_dispatcher.client_registry, "_clients", {})
+    monkeypatch.setattr(
+        async_dispatcher,
+        "AsyncLineClient",
+        functools.partial(
+            async_dispatcher.AsyncLineClient,
+            endpoint="http://127.0.0.1:{}".format(port),
+        ),
+    )
+    yield api
+    if async_dispatcher._session is not None:
+        loop.run_until_complete(async_dispatcher._session.close())
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def tasks(async_dispatcher, count):
+    messages = async_dispatcher.payload_cache.PreparedMessages(
+        TextSendMessage(text="Hello")
+    )
+    return [
+        async_dispatcher.dispatcher.SendTask(
+            i, ["U{}a".format(i), "U{}b".format(i)], messages, "key{}".format(i)
+        )
+        for i in range(count)
+    ]
+
+
+def test_requests_in_flight_are_limited(async_dispatcher, line_api):
+    report = async_dispatcher.send_tasks(tasks(async_dispatcher, 6), 2)
+
+    assert [chunk.index for chunk in report.succeeded] == list(range(6))
+    assert line_api.max_in_flight == 2
+
+
+@pytest.mark.parametrize("status", [429, 500])
+def test_throttled_and_failed_requests_are_retried(
+    async_dispatcher, line_api, monkeypatch, status
+):
+    monkeypatch.setenv("line_api_attempts", "3")
+    line_api.answers = [(status, {}), (status, {})]
+
+    report = async_dispatcher.send_tasks(tasks(async_dispatcher, 1))
+
+    assert report.failed == []
+    assert line_api.retry_keys == ["key0", "key0", "key0"]
+
+
+def test_other_errors_fail_the_chunk_at_once(async_dispatcher, line_api, monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "3")
+    line_api.answers = [(400, {})]
+
+    report = async_dispatcher.send_tasks(tasks(async_dispatcher, 2), 1)
+
+    assert [chunk.index for chunk in report.failed] == [0]
+    assert [chunk.index for chunk in report.succeeded] == [1]
+    assert len(line_api.retry_keys) == 2
+
+
+def test_retried_requests_already_accepted_count_as_sent(
+    async_dispatcher, line_api, monkeypatch
+):
+    monkeypatch.setenv("line_api_attempts", "2")
+    line_api.answers = [(500, {}), (409, {"X-Line-Accepted-Request-Id": "accepted"})]
+
+    report = async_dispatcher.send_tasks(tasks(async_dispatcher, 1))
+
+    assert report.failed == []
+    assert line_api.retry_keys == ["key0", "key0"]
@@ -0,0 +1,74 @@
+import os
+import struct
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import audio_metadata
+
+SAMPLE_AUDIO = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "..",
+    "assets",
+    "files",
+    "audio_files",
+    "sample_audio.mp3",
+)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setattr(audio_metadata, "_durations", {})
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="audio")
+        yield client
+
+
+def box(box_type, body):
+    return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+
+def test_reads_mp3_duration_without_changing_the_object(s3):
+    with open(SAMPLE_AUDIO, "rb") as f:
+        s3.put_object(Bucket="audio", Key="sample.mp3", Body=f.read())
+    etag = s3.head_object(Bucket="audio", Key="sample.mp3")["ETag"]
+
+    assert audio_metadata.get_duration_ms(s3, "audio", "sample.mp3") == 27252
+    head = s3.head_object(Bucket="audio", Key="sample.mp3")
+    assert head["Metadata"] == {}
+    assert head["ETag"] == etag
+
+
+def test_reads_m4a_duration_with_moov_after_media_data(s3):
+    # Version 0 movie header with a timescale of 600 and 95 seconds
+    mvhd = box(
+        b"mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 600, 600 * 95) + bytes(80)
+    )
+    body = (
+        box(b"ftyp", b"M4A " + bytes(4))
+        + box(b"mdat", bytes(audio_metadata.HEAD_BYTES * 2))
+        + box(b"moov", mvhd)
+    )
+    s3.put_object(Bucket="audio", Key="voice.m4a", Body=body)
+
+    assert audio_metadata.get_duration_ms(s3, "audio", "voice.m4a") == 95000
+
+
+def test_uses_duration_from_metadata(s3):
+    s3.put_object(
+        Bucket="audio",
+        Key="clip.mp3",
+        Body=b"not audio",
+        Metadata={"duration-ms": "1234"},
+    )
+
+    assert audio_metadata.get_duration_ms(s3, "audio", "clip.mp3") == 1234
+
+
+def test_unreadable_file_has_no_duration(s3):
+    s3.put_object(Bucket="audio", Key="noise.mp3", Body=bytes(1000))
+
+    assert audio_metadata.get_duration_ms(s3, "audio", "noise.mp3") is None
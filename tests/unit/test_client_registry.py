@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def client_registry(monkeypatch):
+    import client_registry
+
+    monkeypatch.setattr(client_registry.metrics, "_counters", {})
+    monkeypatch.setattr(client_registry.metrics, "_published", {})
+    return client_registry
+
+
+def test_registered_counters_are_published_as_deltas(client_registry, capsys):
+    counters = {"CacheHits": 2}
+    client_registry.metrics.register_counters("cache", lambda: dict(counters))
+
+    client_registry.publish_stats()
+    counters["CacheHits"] = 5
+    client_registry.publish_stats()
+    client_registry.publish_stats()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record["CacheHits"] for record in records] == [2, 3]
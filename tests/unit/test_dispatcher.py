@@ -0,0 +1,176 @@
+import json
+
+import boto3
+import pytest
+import responses
+from linebot.models import TextSendMessage
+from moto import mock_aws
+
+MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+BROADCAST_URL = "https://api.line.me/v2/bot/message/broadcast"
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "1")
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    monkeypatch.delenv("idempotency_table", raising=False)
+    monkeypatch.delenv("dispatch_mode", raising=False)
+    import dispatcher
+
+    monkeypatch.setattr(dispatcher.retry, "_deadline", None)
+    monkeypatch.setattr(dispatcher.retry.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(
+        dispatcher.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": "secret",
+        },
+    )
+    return dispatcher
+
+
+def messages(dispatcher):
+    return dispatcher.payload_cache.PreparedMessages(TextSendMessage(text="Hello"))
+
+
+def recipients(count):
+    return ["U{}".format(i) for i in range(count)]
+
+
+def test_chunks_get_the_same_retry_key_when_sent_again(dispatcher):
+    groups = [(messages(dispatcher), recipients(600))]
+
+    keys = [task.retry_key for task in dispatcher.build_tasks(groups, "campaign")]
+
+    assert keys == [
+        task.retry_key for task in dispatcher.build_tasks(groups, "campaign")
+    ]
+    assert len(set(keys)) == 2
+    assert [task.retry_key for task in dispatcher.build_tasks(groups)] == [None, None]
+
+
+def test_only_failed_chunks_are_reported_failed(dispatcher):
+    retry_keys = []
+
+    def multicast(request):
+        retry_keys.append(request.headers["X-Line-Retry-Key"])
+        if "U600" in json.loads(request.body)["to"]:
+            return (500, {}, json.dumps({"message": "Internal error"}))
+        return (200, {}, "{}")
+
+    with responses.RequestsMock() as line_api:
+        line_api.add_callback(responses.POST, MULTICAST_URL, callback=multicast)
+        report = dispatcher.multicast(
+            recipients(1100), messages(dispatcher), campaign_key="campaign"
+        )
+
+    assert [chunk.index for chunk in report.succeeded] == [0, 2]
+    assert [(chunk.index, len(chunk.recipients)) for chunk in report.failed] == [
+        (1, 500)
+    ]
+    assert sorted(retry_keys) == sorted(
+        task.retry_key
+        for task in dispatcher.build_tasks(
+            [(messages(dispatcher), recipients(1100))], "campaign"
+        )
+    )
+
+
+def test_retried_requests_already_accepted_count_as_sent(dispatcher, monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "2")
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(
+            responses.POST,
+            MULTICAST_URL,
+            status=500,
+            json={"message": "Internal error"},
+        )
+        line_api.add(
+            responses.POST,
+            MULTICAST_URL,
+            status=409,
+            json={"message": "The retry key is already accepted"},
+            headers={"X-Line-Accepted-Request-Id": "accepted"},
+        )
+        report = dispatcher.multicast(
+            recipients(2), messages(dispatcher), campaign_key="campaign"
+        )
+        retry_keys = {
+            call.request.headers["X-Line-Retry-Key"] for call in line_api.calls
+        }
+
+    assert report.failed == []
+    assert len(retry_keys) == 1
+
+
+@pytest.fixture
+def idempotency_table(dispatcher, monkeypatch):
+    monkeypatch.setenv("idempotency_table", "idempotency")
+    with mock_aws():
+        dynamodb = boto3.client("dynamodb")
+        dynamodb.create_table(
+            TableName="idempotency",
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(
+            dispatcher.client_registry, "get_aws_client", lambda name: dynamodb
+        )
+        yield dynamodb
+
+
+def test_campaigns_for_all_followers_are_broadcast_once(dispatcher, idempotency_table):
+    data = {"Text": "Hello", "Audience": "ALL_FOLLOWERS"}
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(responses.POST, BROADCAST_URL, json={})
+        reports = [
+            dispatcher.send_campaign(
+                recipients(2), messages(dispatcher), data, "campaign"
+            )
+            for _ in range(2)
+        ]
+        assert len(line_api.calls) == 1
+
+    assert [report.mode for report in reports] == ["broadcast", "broadcast"]
+    assert all(report.failed == [] for report in reports)
+
+
+def test_failed_broadcasts_can_be_sent_again(dispatcher, idempotency_table):
+    data = {"Text": "Hello", "Audience": "ALL_FOLLOWERS"}
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(
+            responses.POST,
+            BROADCAST_URL,
+            status=400,
+            json={"message": "Invalid request"},
+        )
+        line_api.add(responses.POST, BROADCAST_URL, json={})
+        failed = dispatcher.send_campaign(
+            recipients(2), messages(dispatcher), data, "campaign"
+        )
+        sent = dispatcher.send_campaign(
+            recipients(2), messages(dispatcher), data, "campaign"
+        )
+        assert len(line_api.calls) == 2
+
+    assert [chunk.index for chunk in failed.failed] == [0]
+    assert sent.failed == []
+
+
+def test_campaigns_are_not_broadcast_without_the_guard_table(dispatcher):
+    data = {"Text": "Hello", "Audience": "ALL_FOLLOWERS"}
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(responses.POST, MULTICAST_URL, json={})
+        report = dispatcher.send_campaign(
+            recipients(2), messages(dispatcher), data, "campaign"
+        )
+
+    assert report.mode == "threaded"
+    assert report.failed == []
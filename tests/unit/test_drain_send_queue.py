@@ -0,0 +1,155 @@
+import json
+from unittest import mock
+
+import boto3
+import pytest
+import responses
+from moto import mock_aws
+
+MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+NARROWCAST_URL = "https://api.line.me/v2/bot/message/narrowcast"
+UPLOAD_URL = "https://api.line.me/v2/bot/audienceGroup/upload"
+AUDIENCE_URL = "https://api.line.me/v2/bot/audienceGroup/42"
+
+
+@pytest.fixture
+def drain(monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "1")
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    monkeypatch.delenv("idempotency_table", raising=False)
+    with mock_aws():
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="send")["QueueUrl"]
+        monkeypatch.setenv("send_queue_url", queue_url)
+        # Imported here, as the handler opens a LINE API connection on import
+        with mock.patch("http_pool.warm_up"):
+            import drainSendQueue
+
+        dynamodb = boto3.client("dynamodb")
+        dynamodb.create_table(
+            TableName="idempotency",
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(
+            drainSendQueue.client_registry,
+            "get_aws_client",
+            lambda name: dynamodb if name == "dynamodb" else sqs,
+        )
+        monkeypatch.setattr(
+            drainSendQueue.dispatcher.secret_cache,
+            "get_secret",
+            lambda *args, **kwargs: {
+                "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+                "YOUR_CHANNEL_SECRET": "secret",
+            },
+        )
+        yield drainSendQueue, sqs, queue_url
+
+
+def job_record(message_id, recipients):
+    job = {
+        "ApplicationId": "app",
+        "CampaignId": "campaign",
+        "TreatmentId": "0",
+        "Kind": "text",
+        "Data": "Hello",
+        "Recipients": recipients,
+    }
+    return {"messageId": message_id, "body": json.dumps(job)}
+
+
+def test_only_failed_recipients_of_a_message_are_sent_again(drain):
+    drainSendQueue, sqs, queue_url = drain
+    first = ["A{}".format(i) for i in range(300)]
+    second = ["B{}".format(i) for i in range(300)]
+
+    # The second chunk only holds the last 100 recipients of the second job
+    def multicast(request):
+        recipients = json.loads(request.body)["to"]
+        if len(recipients) < 500:
+            return (500, {}, json.dumps({"message": "Internal error"}))
+        return (200, {}, "{}")
+
+    with responses.RequestsMock() as line_api:
+        line_api.add_callback(responses.POST, MULTICAST_URL, callback=multicast)
+        result = drainSendQueue.lambda_handler(
+            {"Records": [job_record("m1", first), job_record("m2", second)]}, None
+        )
+
+    # Neither message is delivered again, as that would send the message twice
+    # to the recipients of the first chunk
+    assert result == {"batchItemFailures": []}
+    queued = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    assert len(queued["Messages"]) == 1
+    assert json.loads(queued["Messages"][0]["Body"])["Recipients"] == sorted(
+        second[200:]
+    )
+
+
+def test_messages_without_delivered_recipients_are_reported(drain):
+    drainSendQueue, sqs, queue_url = drain
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(
+            responses.POST,
+            MULTICAST_URL,
+            json={"message": "Internal error"},
+            status=500,
+        )
+        result = drainSendQueue.lambda_handler(
+            {"Records": [job_record("m1", ["U1", "U2"]), job_record("m2", ["U3"])]},
+            None,
+        )
+
+    assert result == {
+        "batchItemFailures": [{"itemIdentifier": "m1"}, {"itemIdentifier": "m2"}]
+    }
+    assert "Messages" not in sqs.receive_message(QueueUrl=queue_url)
+
+
+def test_campaigns_over_the_threshold_are_narrowcast_once(drain, monkeypatch):
+    drainSendQueue, sqs, queue_url = drain
+    monkeypatch.setenv("idempotency_table", "idempotency")
+    monkeypatch.setenv("narrowcast_threshold", "3")
+    monkeypatch.setattr(drainSendQueue.audience, "POLL_DELAY_SECONDS", 0)
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as line_api:
+        line_api.add(responses.POST, MULTICAST_URL, json={})
+        line_api.add(responses.POST, UPLOAD_URL, json={"audienceGroupId": 42})
+        line_api.add(responses.PUT, UPLOAD_URL, json={})
+        line_api.add(responses.GET, AUDIENCE_URL, json={"status": "READY"})
+        line_api.add(
+            responses.POST,
+            NARROWCAST_URL,
+            json={},
+            headers={"X-Line-Request-Id": "request"},
+        )
+        # Below the threshold, then over it, then added to the same audience
+        for message_id, recipients in [
+            ("m1", ["U1", "U2"]),
+            ("m2", ["U3", "U4"]),
+            ("m3", ["U5"]),
+        ]:
+            result = drainSendQueue.lambda_handler(
+                {"Records": [job_record(message_id, recipients)]}, None
+            )
+            assert result == {"batchItemFailures": []}
+        stage = sqs.receive_message(QueueUrl=queue_url)["Messages"][0]
+        drainSendQueue.lambda_handler(
+            {"Records": [{"messageId": "s1", "body": stage["Body"]}]}, None
+        )
+        # The narrowcast was sent, so later recipients get a multicast
+        drainSendQueue.lambda_handler(
+            {"Records": [job_record("m4", ["U6", "U7"])]}, None
+        )
+        calls = [(call.request.method, call.request.url) for call in line_api.calls]
+        assert calls.count(("POST", MULTICAST_URL)) == 2
+        assert calls.count(("POST", UPLOAD_URL)) == 1
+        assert calls.count(("PUT", UPLOAD_URL)) == 1
+        assert calls.count(("POST", NARROWCAST_URL)) == 1
+        assert json.loads(line_api.calls[1].request.body)["audiences"] == [
+            {"id": "U3"},
+            {"id": "U4"},
+        ]
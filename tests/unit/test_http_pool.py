@@ -0,0 +1,53 @@
+from unittest import mock
+
+import pytest
+import requests
+import responses
+
+
+@pytest.fixture
+def http_pool(monkeypatch):
+    import http_pool
+
+    monkeypatch.setattr(http_pool, "_session", None)
+    monkeypatch.setattr(
+        http_pool, "stats", {"requests": 0, "connections": 0, "connect_ms": 0.0}
+    )
+    return http_pool
+
+
+def test_warm_up_gives_up_quickly_and_quietly(http_pool, monkeypatch):
+    session = mock.Mock()
+    session.head.side_effect = requests.exceptions.ConnectTimeout()
+    monkeypatch.setattr(http_pool, "get_session", lambda: session)
+
+    http_pool.warm_up()
+
+    session.head.assert_called_once_with(
+        http_pool.LINE_API_ENDPOINT, timeout=http_pool.WARM_UP_TIMEOUT
+    )
+
+
+def test_requests_share_one_session(http_pool):
+    client = http_pool.PooledHttpClient()
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(responses.GET, "https://api.line.me/v2/bot/info", json={})
+        line_api.add(responses.POST, "https://api.line.me/v2/bot/message/push", json={})
+        client.get("https://api.line.me/v2/bot/info")
+        response = client.post("https://api.line.me/v2/bot/message/push", data="{}")
+
+    assert response.status_code == 200
+    assert http_pool.get_session() is http_pool.get_session()
+    assert http_pool.get_stats()["requests"] == 2
+
+
+@pytest.mark.parametrize(
+    "read_timeout, timeout", [("20", (3.05, 20.0)), ("slow", (3.05, 10))]
+)
+def test_read_timeout_falls_back_to_the_default(
+    http_pool, monkeypatch, read_timeout, timeout
+):
+    monkeypatch.setenv("line_api_read_timeout", read_timeout)
+
+    assert http_pool.get_timeout() == timeout
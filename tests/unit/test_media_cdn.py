@@ -0,0 +1,78 @@
+import base64
+import json
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+def private_key_pem():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("utf-8")
+
+
+@pytest.fixture
+def media_cdn(monkeypatch):
+    monkeypatch.setenv("media_domain", "media.example.com")
+    monkeypatch.setenv("media_key_pair_id", "K1")
+    import media_cdn
+
+    monkeypatch.setattr(media_cdn.client_registry, "_clients", {})
+    monkeypatch.setattr(
+        media_cdn.secret_cache,
+        "get_secret",
+        mock.Mock(return_value={"private_key": private_key_pem()}),
+    )
+    return media_cdn
+
+
+def query(url):
+    return {name: values[0] for name, values in parse_qs(urlsplit(url).query).items()}
+
+
+# CloudFront's URL safe base64 variant
+def decode(value):
+    return base64.b64decode(value.replace("-", "+").replace("_", "=").replace("~", "/"))
+
+
+def test_objects_are_signed_for_their_kind(media_cdn):
+    url = media_cdn.signed_url("image", "sale 1.jpg", 3600)
+
+    assert url.startswith("https://media.example.com/image/sale%201.jpg?")
+    assert query(url)["Key-Pair-Id"] == "K1"
+    assert {"Expires", "Signature"} <= set(query(url))
+
+
+def test_base_urls_allow_every_url_under_them(media_cdn):
+    url = media_cdn.signed_base_url("image", "imagemap/sale", 3600)
+
+    policy = json.loads(decode(query(url)["Policy"]))
+    assert url.startswith("https://media.example.com/image/imagemap/sale?")
+    assert policy["Statement"][0]["Resource"] == (
+        "https://media.example.com/image/imagemap/sale/*"
+    )
+
+
+def test_media_urls_come_from_s3_until_the_signing_key_is_set(media_cdn, monkeypatch):
+    monkeypatch.setenv("image_bucket", "images")
+    media_cdn.secret_cache.get_secret.return_value = {
+        "private_key": "INSERT_PRIVATE_KEY"
+    }
+    import message_builders
+
+    monkeypatch.setattr(message_builders, "_urls", {})
+    monkeypatch.setattr(
+        message_builders.s3,
+        "generate_presigned_url",
+        mock.Mock(return_value="https://s3/sale.jpg"),
+    )
+
+    with pytest.raises(ValueError):
+        media_cdn.signed_url("image", "sale.jpg", 3600)
+    assert message_builders.media_url("image", "sale.jpg") == "https://s3/sale.jpg"
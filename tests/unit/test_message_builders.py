@@ -0,0 +1,60 @@
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def message_builders(monkeypatch):
+    monkeypatch.delenv("presigned_url_margin_seconds", raising=False)
+    import message_builders
+
+    monkeypatch.setattr(message_builders, "_urls", {})
+    monkeypatch.setattr(message_builders, "url_stats", {"hits": 0, "misses": 0})
+    monkeypatch.setattr(message_builders.time, "monotonic", mock.Mock(return_value=0))
+    urls = iter("https://s3/{}".format(n) for n in range(10))
+    monkeypatch.setattr(
+        message_builders.s3,
+        "generate_presigned_url",
+        mock.Mock(side_effect=lambda *args, **kwargs: next(urls)),
+    )
+    return message_builders
+
+
+def test_presigned_urls_are_reused_until_the_margin_before_they_expire(
+    message_builders,
+):
+    reuse_seconds = (
+        message_builders.PRESIGNED_URL_EXPIRY
+        - message_builders.DEFAULT_PRESIGNED_URL_MARGIN
+    )
+    first = message_builders.presigned_url("images", "sale.jpg")
+    message_builders.time.monotonic.return_value = reuse_seconds - 1
+    reused = message_builders.presigned_url("images", "sale.jpg")
+    message_builders.time.monotonic.return_value = reuse_seconds
+    regenerated = message_builders.presigned_url("images", "sale.jpg")
+
+    assert first == reused == "https://s3/0"
+    assert regenerated == "https://s3/1"
+    assert message_builders.get_url_stats() == {"hits": 1, "misses": 2}
+    message_builders.s3.generate_presigned_url.assert_called_with(
+        "get_object",
+        Params={"Bucket": "images", "Key": "sale.jpg"},
+        ExpiresIn=message_builders.PRESIGNED_URL_EXPIRY,
+    )
+
+
+def test_each_object_gets_its_own_url(message_builders):
+    assert message_builders.presigned_url("images", "a.jpg") == "https://s3/0"
+    assert message_builders.presigned_url("images", "b.jpg") == "https://s3/1"
+    assert message_builders.presigned_url("audio", "a.jpg") == "https://s3/2"
+
+
+@pytest.mark.parametrize(
+    "margin, expected", [("60", 60), ("7200", 3600), ("-1", 0), ("soon", 900)]
+)
+def test_margin_stays_within_the_url_lifetime(
+    message_builders, monkeypatch, margin, expected
+):
+    monkeypatch.setenv("presigned_url_margin_seconds", margin)
+
+    assert message_builders.get_presigned_url_margin() == expected
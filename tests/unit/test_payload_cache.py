@@ -0,0 +1,42 @@
+import json
+from collections import OrderedDict
+
+import pytest
+from linebot.models import TextSendMessage
+
+
+@pytest.fixture
+def payload_cache(monkeypatch):
+    import payload_cache
+
+    monkeypatch.setattr(payload_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(payload_cache, "_size", 0)
+    monkeypatch.setattr(
+        payload_cache, "stats", {"hits": 0, "misses": 0, "evictions": 0}
+    )
+    return payload_cache
+
+
+def test_prepared_messages_are_spliced_into_request_bodies(payload_cache):
+    messages = payload_cache.PreparedMessages(TextSendMessage(text="こんにちは"))
+
+    body = payload_cache.encode_body(
+        {"to": ["U1"], "messages": payload_cache.request_messages(messages)}
+    )
+
+    assert messages.json in body
+    assert json.loads(body) == {
+        "to": ["U1"],
+        "messages": [{"type": "text", "text": "こんにちは"}],
+    }
+
+
+def test_messages_are_built_once_per_campaign(payload_cache):
+    event = {"CampaignId": "campaign", "TreatmentId": "0", "Data": "Hello"}
+
+    messages = payload_cache.get_messages("text", event)
+
+    assert payload_cache.get_messages("text", dict(event)) is messages
+    assert payload_cache.get_messages("text", dict(event, Data="Bye")) is not messages
+    assert payload_cache.get_stats()["hits"] == 1
+    assert payload_cache.get_stats()["misses"] == 2
@@ -0,0 +1,87 @@
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+
+def client_error(status_code):
+    return ClientError(
+        {
+            "Error": {"Code": "BadRequestException"},
+            "ResponseMetadata": {"HTTPStatusCode": status_code},
+        },
+        "UpdateEndpointsBatch",
+    )
+
+
+@pytest.fixture
+def pinpoint_endpoints(monkeypatch):
+    import pinpoint_endpoints
+
+    monkeypatch.setattr(pinpoint_endpoints.retry, "backoff_delay", lambda attempt: 0)
+    return pinpoint_endpoints
+
+
+@pytest.fixture
+def pinpoint(monkeypatch, pinpoint_endpoints):
+    client = mock.Mock()
+    monkeypatch.setattr(
+        pinpoint_endpoints.EndpointBatch, "_client", lambda self: client
+    )
+    return client
+
+
+def endpoint(user_id):
+    return {"Address": user_id, "ChannelType": "CUSTOM"}
+
+
+def test_writes_endpoints_in_batches_of_100(pinpoint, pinpoint_endpoints):
+    batch = pinpoint_endpoints.EndpointBatch("app")
+    for i in range(250):
+        batch.add("U{}".format(i), endpoint("U{}".format(i)))
+    batch.discard("U0")
+    batch.add("U1", endpoint("U1-updated"))
+
+    assert batch.flush() == []
+    sizes = [
+        len(call.kwargs["EndpointBatchRequest"]["Item"])
+        for call in pinpoint.update_endpoints_batch.call_args_list
+    ]
+    assert sizes == [100, 100, 49]
+    items = pinpoint.update_endpoints_batch.call_args_list[-1].kwargs[
+        "EndpointBatchRequest"
+    ]["Item"]
+    assert items[-1] == {"Address": "U1-updated", "ChannelType": "CUSTOM", "Id": "U1"}
+    assert batch.calls == 3
+    assert not batch.pending
+
+
+def test_rejected_batch_is_written_one_by_one(pinpoint, pinpoint_endpoints):
+    pinpoint.update_endpoints_batch.side_effect = client_error(400)
+
+    def update_endpoint(**kwargs):
+        if kwargs["EndpointId"] == "U2":
+            raise client_error(400)
+
+    pinpoint.update_endpoint.side_effect = update_endpoint
+    batch = pinpoint_endpoints.EndpointBatch("app")
+    for i in range(3):
+        batch.add("U{}".format(i), endpoint("U{}".format(i)))
+
+    assert batch.flush() == ["U2"]
+    assert pinpoint.update_endpoint.call_count == 3
+    assert pinpoint.update_endpoint.call_args_list[0].kwargs == {
+        "ApplicationId": "app",
+        "EndpointId": "U0",
+        "EndpointRequest": endpoint("U0"),
+    }
+
+
+def test_throttled_batch_is_retried(pinpoint, pinpoint_endpoints):
+    pinpoint.update_endpoints_batch.side_effect = [client_error(429), {}]
+    batch = pinpoint_endpoints.EndpointBatch("app")
+    batch.add("U0", endpoint("U0"))
+
+    assert batch.flush() == []
+    assert batch.calls == 2
+    pinpoint.update_endpoint.assert_not_called()
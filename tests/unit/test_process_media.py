@@ -0,0 +1,169 @@
+import io
+from urllib.parse import quote_plus
+
+import boto3
+import pytest
+from moto import mock_aws
+from PIL import Image
+
+import media_derivatives
+
+
+@pytest.fixture
+def image_bucket(monkeypatch):
+    monkeypatch.setenv("image_bucket", "images")
+    monkeypatch.delenv("media_domain", raising=False)
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="images")
+        yield boto3.client("s3")
+
+
+def upload(s3, key, image_format, size=(1200, 800)):
+    buffer = io.BytesIO()
+    image = Image.new("RGBA", size, (200, 30, 30, 128))
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+    image.save(buffer, format=image_format)
+    s3.put_object(Bucket="images", Key=key, Body=buffer.getvalue())
+    return {
+        "s3": {
+            "bucket": {"name": "images"},
+            # Keys are URL encoded in S3 event notifications
+            "object": {"key": quote_plus(key), "size": buffer.tell()},
+        }
+    }
+
+
+def read_image(s3, key):
+    body = s3.get_object(Bucket="images", Key=key)["Body"].read()
+    return Image.open(io.BytesIO(body)), len(body)
+
+
+def test_writes_preview_of_uploaded_image(image_bucket):
+    import processMedia
+
+    record = upload(image_bucket, "banner+sale.png", "PNG")
+    assert processMedia.lambda_handler({"Records": [record]}, None) == {
+        "processed": 1,
+        "violations": 0,
+    }
+    preview, size = read_image(
+        image_bucket, media_derivatives.preview_key("banner+sale.png")
+    )
+    assert preview.format == "JPEG"
+    assert max(preview.size) <= 240
+    assert size <= media_derivatives.MAX_PREVIEW_BYTES
+    # A compliant original is sent as is
+    with pytest.raises(image_bucket.exceptions.NoSuchKey):
+        image_bucket.get_object(
+            Bucket="images", Key=media_derivatives.original_key("banner+sale.png")
+        )
+
+
+def test_converts_image_in_unsupported_format(image_bucket):
+    import processMedia
+
+    record = upload(image_bucket, "photo.webp", "WEBP")
+    assert processMedia.lambda_handler({"Records": [record]}, None)["violations"] == 1
+    original, _ = read_image(image_bucket, media_derivatives.original_key("photo.webp"))
+    assert original.format == "JPEG"
+    assert original.size == (1200, 800)
+
+
+def test_reports_images_that_cannot_be_decoded(image_bucket, monkeypatch):
+    import processMedia
+
+    monkeypatch.setattr(processMedia.Image, "MAX_IMAGE_PIXELS", 1000)
+    bomb = upload(image_bucket, "bomb.png", "PNG")
+    truncated = upload(image_bucket, "truncated.png", "PNG")
+    body = image_bucket.get_object(Bucket="images", Key="truncated.png")["Body"]
+    image_bucket.put_object(
+        Bucket="images", Key="truncated.png", Body=body.read()[:200]
+    )
+
+    result = processMedia.lambda_handler({"Records": [bomb, truncated]}, None)
+
+    assert result == {"processed": 2, "violations": 2}
+    for key in ["bomb.png", "truncated.png"]:
+        manifest = media_derivatives.read_manifest(image_bucket, "images", key)
+        assert manifest["problems"]
+
+
+def test_ignores_derived_files(image_bucket):
+    import processMedia
+
+    record = upload(image_bucket, media_derivatives.preview_key("a.png"), "PNG")
+    assert processMedia.lambda_handler({"Records": [record]}, None)["processed"] == 0
+
+
+def test_image_message_uses_derivatives(image_bucket):
+    import message_builders
+    import processMedia
+
+    processMedia.lambda_handler(
+        {"Records": [upload(image_bucket, "photo.webp", "WEBP")]}, None
+    )
+    message = message_builders.build_image_message("photo.webp")
+    assert "/derived/original/photo.webp.jpg" in message.original_content_url
+    assert "/derived/preview/photo.webp.jpg" in message.preview_image_url
+
+
+def test_video_message_uses_cover_from_video_bucket(image_bucket, monkeypatch):
+    import message_builders
+    import processMedia
+
+    monkeypatch.setenv("video_bucket", "images")
+    cover = upload(image_bucket, "launch.jpg", "JPEG")
+    image_bucket.put_object(Bucket="images", Key="launch.mp4", Body=b"video")
+    video = {
+        "s3": {
+            "bucket": {"name": "images"},
+            "object": {"key": "launch.mp4", "size": 5},
+        }
+    }
+    processMedia.lambda_handler({"Records": [cover, video]}, None)
+    manifest = message_builders.media_derivatives.load_manifest(
+        image_bucket, "images", "launch.mp4"
+    )
+    assert manifest["cover"] == "launch.jpg"
+
+    message = message_builders.build_video_message({"video_file_key": "launch.mp4"})
+    assert "/launch.mp4?" in message.original_content_url
+    assert "/derived/preview/launch.jpg.jpg?" in message.preview_image_url
+
+
+def test_cover_uploaded_after_its_video_is_recorded(image_bucket):
+    import processMedia
+
+    image_bucket.put_object(Bucket="images", Key="launch.mp4", Body=b"video")
+    video = {
+        "s3": {
+            "bucket": {"name": "images"},
+            "object": {"key": "launch.mp4", "size": 5},
+        }
+    }
+    processMedia.lambda_handler({"Records": [video]}, None)
+    manifest = media_derivatives.read_manifest(image_bucket, "images", "launch.mp4")
+    assert manifest["cover"] is None
+
+    cover = upload(image_bucket, "launch.png", "PNG")
+    processMedia.lambda_handler({"Records": [cover]}, None)
+
+    manifest = media_derivatives.read_manifest(image_bucket, "images", "launch.mp4")
+    assert manifest["cover"] == "launch.png"
+
+
+def test_writes_imagemap_tiles_for_every_width(image_bucket):
+    import processMedia
+
+    record = upload(image_bucket, "imagemap/sale.png", "PNG", size=(2080, 1040))
+    processMedia.lambda_handler({"Records": [record]}, None)
+
+    base = media_derivatives.imagemap_base_key("imagemap/sale.png")
+    for width in media_derivatives.IMAGEMAP_WIDTHS:
+        tile, _ = read_image(image_bucket, "{}/{}".format(base, width))
+        assert tile.size == (width, width // 2)
+    manifest = media_derivatives.load_manifest(
+        image_bucket, "images", "imagemap/sale.png"
+    )
+    assert (manifest["base_width"], manifest["base_height"]) == (1040, 520)
@@ -0,0 +1,168 @@
+import json
+import time
+from collections import OrderedDict
+from unittest import mock
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from linebot.models import Profile
+from moto import mock_aws
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setenv("pinpoint_app_id", "app")
+    monkeypatch.delenv("profile_table", raising=False)
+    monkeypatch.delenv("idempotency_table", raising=False)
+    import processWebhookEvents
+
+    monkeypatch.setattr(processWebhookEvents.profile_cache, "_profiles", OrderedDict())
+    monkeypatch.setattr(processWebhookEvents.idempotency, "_recent", OrderedDict())
+    pinpoint = mock.Mock()
+    enqueued = {}
+
+    def enqueue(followers):
+        enqueued.update(followers)
+        return []
+
+    monkeypatch.setattr(
+        processWebhookEvents.client_registry,
+        "get_aws_client",
+        lambda service_name: pinpoint,
+    )
+    monkeypatch.setattr(
+        processWebhookEvents.client_registry, "publish_stats", lambda: None
+    )
+    monkeypatch.setattr(processWebhookEvents.profile_enrichment, "enqueue", enqueue)
+    return processWebhookEvents, pinpoint, enqueued
+
+
+def record(event_type, user_id, event_id, timestamp=1):
+    event = {
+        "type": event_type,
+        "timestamp": timestamp,
+        "mode": "active",
+        "webhookEventId": event_id,
+        "source": {"type": "user", "userId": user_id},
+    }
+    return {
+        "messageId": event_id,
+        "body": json.dumps(event),
+        "attributes": {"MessageGroupId": user_id},
+    }
+
+
+def test_follows_are_written_at_once_and_enriched_later(handler):
+    processWebhookEvents, pinpoint, enqueued = handler
+    processWebhookEvents.profile_cache._remember(
+        {"U1": Profile(user_id="U1", display_name="Known")}, time.time()
+    )
+    records = [
+        record("follow", "U1", "e1"),
+        record("follow", "U2", "e2", timestamp=2),
+        record("follow", "U3", "e3", timestamp=3),
+        record("unfollow", "U3", "e4", timestamp=4),
+    ]
+
+    result = processWebhookEvents.lambda_handler({"Records": records}, None)
+
+    assert result == {"batchItemFailures": []}
+    items = pinpoint.update_endpoints_batch.call_args.kwargs["EndpointBatchRequest"][
+        "Item"
+    ]
+    assert [item["Id"] for item in items] == ["U1", "U2"]
+    assert items[0]["User"]["UserAttributes"] == {"DisplayName": ["Known"]}
+    assert items[1]["User"] == {"UserId": "U2"}
+    assert enqueued == {"U2": 2}
+    pinpoint.delete_endpoint.assert_called_once_with(
+        ApplicationId="app", EndpointId="U3"
+    )
+
+
+def test_events_after_a_failed_one_of_the_same_user_are_retried(handler):
+    processWebhookEvents, pinpoint, enqueued = handler
+    pinpoint.delete_endpoint.side_effect = ClientError(
+        {"Error": {"Code": "BadRequestException"}}, "DeleteEndpoint"
+    )
+    records = [
+        record("unfollow", "U1", "e1"),
+        record("follow", "U2", "e2"),
+        record("follow", "U1", "e3"),
+    ]
+
+    result = processWebhookEvents.lambda_handler({"Records": records}, None)
+
+    assert result == {
+        "batchItemFailures": [{"itemIdentifier": "e1"}, {"itemIdentifier": "e3"}]
+    }
+    items = pinpoint.update_endpoints_batch.call_args.kwargs["EndpointBatchRequest"][
+        "Item"
+    ]
+    assert [item["Id"] for item in items] == ["U2"]
+    assert enqueued == {"U2": 1}
+
+
+def test_redelivered_events_are_dropped_unless_they_failed(handler):
+    processWebhookEvents, pinpoint, enqueued = handler
+    pinpoint.delete_endpoint.side_effect = [
+        ClientError({"Error": {"Code": "BadRequestException"}}, "DeleteEndpoint"),
+        {},
+    ]
+    records = [record("follow", "U1", "e1"), record("unfollow", "U2", "e2")]
+    processWebhookEvents.lambda_handler({"Records": records}, None)
+
+    result = processWebhookEvents.lambda_handler({"Records": records}, None)
+
+    assert result == {"batchItemFailures": []}
+    # Only the unfollow that failed the first time is handled again
+    pinpoint.update_endpoints_batch.assert_called_once()
+    assert pinpoint.delete_endpoint.call_count == 2
+
+
+def test_events_of_a_failed_invocation_are_handled_again(monkeypatch, handler):
+    processWebhookEvents, pinpoint, enqueued = handler
+    monkeypatch.setenv("idempotency_table", "idempotency")
+    with mock_aws():
+        dynamodb = boto3.client("dynamodb")
+        dynamodb.create_table(
+            TableName="idempotency",
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(
+            processWebhookEvents.client_registry,
+            "get_aws_client",
+            lambda service_name: dynamodb if service_name == "dynamodb" else pinpoint,
+        )
+        pinpoint.update_endpoints_batch.side_effect = [
+            EndpointConnectionError(endpoint_url="https://pinpoint"),
+            {},
+        ]
+        records = [record("follow", "U1", "e1"), record("follow", "U2", "e2")]
+        with pytest.raises(EndpointConnectionError):
+            processWebhookEvents.lambda_handler({"Records": records}, None)
+
+        result = processWebhookEvents.lambda_handler({"Records": records}, None)
+        duplicate = processWebhookEvents.lambda_handler({"Records": records}, None)
+
+    assert result == duplicate == {"batchItemFailures": []}
+    assert pinpoint.update_endpoints_batch.call_count == 2
+    assert enqueued == {"U1": 1, "U2": 1}
+
+
+def test_malformed_event_ttl_falls_back_to_the_default(monkeypatch, handler):
+    processWebhookEvents, pinpoint, enqueued = handler
+    monkeypatch.setenv("webhook_event_ttl_seconds", "one day")
+    complete = mock.Mock()
+    monkeypatch.setattr(processWebhookEvents.idempotency, "complete", complete)
+
+    result = processWebhookEvents.lambda_handler(
+        {"Records": [record("follow", "U1", "e1")]}, None
+    )
+
+    assert result == {"batchItemFailures": []}
+    complete.assert_called_once_with(
+        "webhook:e1", processWebhookEvents.DEFAULT_EVENT_TTL_SECONDS
+    )
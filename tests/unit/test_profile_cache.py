@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from unittest import mock
+
+import boto3
+import pytest
+from linebot.models import Profile
+from moto import mock_aws
+
+
+@pytest.fixture
+def profile_cache(monkeypatch):
+    monkeypatch.setenv("profile_table", "profiles")
+    import profile_cache
+
+    monkeypatch.setattr(profile_cache, "_profiles", OrderedDict())
+    with mock_aws():
+        dynamodb = boto3.client("dynamodb")
+        dynamodb.create_table(
+            TableName="profiles",
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setattr(
+            profile_cache.client_registry,
+            "get_aws_client",
+            lambda service_name: dynamodb,
+        )
+        yield profile_cache
+
+
+@pytest.fixture
+def line_bot_api(monkeypatch, profile_cache):
+    client = mock.Mock()
+    client.get_profile.side_effect = lambda user_id: Profile(
+        user_id=user_id, display_name="name of " + user_id
+    )
+    monkeypatch.setattr(
+        profile_cache.client_registry, "get_line_bot_api", lambda: client
+    )
+    return client
+
+
+def test_fetches_each_profile_once(profile_cache, line_bot_api):
+    profiles, errors = profile_cache.get_profiles(["U1", "U2", "U1"])
+    assert errors == {}
+    assert profiles["U2"].display_name == "name of U2"
+    assert line_bot_api.get_profile.call_count == 2
+
+    profiles, errors = profile_cache.get_profiles(["U1", "U2"])
+    assert profiles["U1"].display_name == "name of U1"
+    assert line_bot_api.get_profile.call_count == 2
+
+
+def test_other_execution_environments_read_the_table(
+    monkeypatch, profile_cache, line_bot_api
+):
+    profile_cache.get_profiles(["U1"])
+    # A new execution environment starts with an empty memory cache
+    monkeypatch.setattr(profile_cache, "_profiles", OrderedDict())
+
+    assert profile_cache.get_profile("U1").display_name == "name of U1"
+    assert line_bot_api.get_profile.call_count == 1
+
+
+def test_failed_lookups_are_returned_and_not_cached(profile_cache, line_bot_api):
+    line_bot_api.get_profile.side_effect = [Profile(display_name="A"), ValueError()]
+
+    profiles, errors = profile_cache.get_profiles(["U1", "U2"])
+
+    assert list(profiles) == ["U1"]
+    assert isinstance(errors["U2"], ValueError)
+    assert "U2" not in profile_cache._profiles
+
+
+def test_fetched_profiles_keep_the_unfollow_of_the_user(profile_cache, line_bot_api):
+    profile_cache.record_unfollow("U1", 5)
+
+    profile_cache.get_profiles(["U1"])
+
+    assert profile_cache.get_unfollows(["U1"]) == {"U1": 5}
@@ -0,0 +1,81 @@
+from unittest import mock
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import rate_limiter
+
+
+@pytest.fixture
+def rate_limit_table(monkeypatch):
+    with mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName="rate-limit",
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        monkeypatch.setenv("rate_limit_table", "rate-limit")
+        monkeypatch.setattr(rate_limiter, "_dynamodb", None)
+        monkeypatch.setattr(rate_limiter, "_exhausted", {})
+        yield
+
+
+def test_acquire_within_budget(rate_limit_table, monkeypatch):
+    monkeypatch.setenv("rate_limit_narrowcast", "3")
+    for _ in range(3):
+        rate_limiter.acquire("narrowcast", timeout=0)
+
+
+def test_acquire_times_out_when_budget_is_used(rate_limit_table, monkeypatch):
+    monkeypatch.setenv("rate_limit_narrowcast", "2")
+    rate_limiter.acquire("narrowcast", count=2, timeout=0)
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        rate_limiter.acquire("narrowcast", timeout=0)
+
+
+def test_acquire_without_table_does_not_throttle(monkeypatch):
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    rate_limiter.acquire("multicast", count=10000, timeout=0)
+
+
+def test_high_budgets_are_split_over_shards(rate_limit_table, monkeypatch):
+    monkeypatch.setenv("rate_limit_push", "1001")
+    assert rate_limiter.get_shard_budgets("push") == [334, 334, 333]
+    assert rate_limiter.get_shard_budgets("narrowcast") == [60]
+
+    monkeypatch.setattr(rate_limiter, "get_budget", lambda endpoint_class: (3, 3600))
+    monkeypatch.setattr(
+        rate_limiter, "get_shard_budgets", lambda endpoint_class: [1, 1, 1]
+    )
+    for _ in range(3):
+        rate_limiter.acquire("push", timeout=0)
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        rate_limiter.acquire("push", timeout=0)
+    items = boto3.client("dynamodb").scan(TableName="rate-limit")["Items"]
+    assert sorted(int(item["used"]["N"]) for item in items) == [1, 1, 1]
+
+
+def test_throttling_is_retried_instead_of_failing_open(rate_limit_table, monkeypatch):
+    dynamodb = mock.Mock()
+    dynamodb.update_item.side_effect = ClientError(
+        {"Error": {"Code": "ProvisionedThroughputExceededException"}}, "UpdateItem"
+    )
+    monkeypatch.setattr(rate_limiter, "_dynamodb", dynamodb)
+    monkeypatch.setattr(rate_limiter.time, "sleep", lambda seconds: None)
+
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        rate_limiter.acquire("multicast", timeout=0.5)
+    assert dynamodb.update_item.call_count > 1
+
+
+def test_missing_table_fails_open_with_a_metric(rate_limit_table, monkeypatch):
+    monkeypatch.setenv("rate_limit_table", "missing")
+    put_metrics = mock.Mock()
+    monkeypatch.setattr(rate_limiter.metrics, "put_metrics", put_metrics)
+
+    rate_limiter.acquire("multicast", timeout=0)
+
+    put_metrics.assert_called_once_with({"RateLimiterFailOpen": 1})
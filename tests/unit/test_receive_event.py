@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+
+@pytest.fixture
+def receive_event(monkeypatch):
+    import receiveEvent
+
+    monkeypatch.setattr(
+        receiveEvent.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": "secret",
+        },
+    )
+    return receiveEvent
+
+
+def signed_event(body):
+    signature = hmac.new(b"secret", body.encode("utf-8"), hashlib.sha256).digest()
+    return {
+        "headers": {"x-line-signature": base64.b64encode(signature).decode()},
+        "body": body,
+    }
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ClientError({"Error": {"Code": "AccessDenied"}}, "SendMessageBatch"),
+        EndpointConnectionError(endpoint_url="https://sqs"),
+    ],
+)
+def test_queue_errors_ask_line_to_redeliver(receive_event, monkeypatch, error):
+    def enqueue(events):
+        raise error
+
+    monkeypatch.setattr(receive_event.webhook_queue, "enqueue", enqueue)
+
+    response = receive_event.lambda_handler(
+        signed_event(json.dumps({"events": [{"type": "follow"}]})), None
+    )
+
+    assert response["statusCode"] == 500
+
+
+def test_signatures_are_checked_again_with_a_rotated_secret(receive_event, monkeypatch):
+    secrets = iter(["old", "secret"])
+    monkeypatch.setattr(
+        receive_event.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": next(secrets),
+        },
+    )
+    monkeypatch.setattr(receive_event.webhook_queue, "enqueue", lambda events: None)
+
+    response = receive_event.lambda_handler(
+        signed_event(json.dumps({"events": [{"type": "follow"}]})), None
+    )
+
+    assert response["statusCode"] == 200
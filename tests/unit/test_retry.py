@@ -0,0 +1,71 @@
+from unittest import mock
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+import retry
+
+
+def line_error(status_code):
+    return LineBotApiError(status_code, {}, error=Error(message="error"))
+
+
+@pytest.fixture(autouse=True)
+def no_deadline(monkeypatch):
+    monkeypatch.setattr(retry, "_deadline", None)
+    monkeypatch.setattr(retry.time, "sleep", mock.Mock())
+
+
+def test_calls_are_not_retried_past_the_invocation_deadline():
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = (
+        retry.DEADLINE_MARGIN_SECONDS * 1000
+    )
+    retry.set_deadline(context)
+    func = mock.Mock(side_effect=line_error(500))
+
+    with pytest.raises(LineBotApiError):
+        retry.call_with_retry(func, attempts=4)
+
+    assert func.call_count == 1
+    retry.time.sleep.assert_not_called()
+    assert retry.time_left(10) == 0
+
+
+def test_retry_keys_are_stable_for_the_same_parts():
+    key = retry.retry_key({"CampaignId": "c", "TreatmentId": "0"}, ["U1", "U2"])
+
+    assert key == retry.retry_key({"TreatmentId": "0", "CampaignId": "c"}, ["U1", "U2"])
+    assert key != retry.retry_key({"CampaignId": "c", "TreatmentId": "0"}, ["U1"])
+
+
+def test_retryable_errors_are_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+    func = mock.Mock(side_effect=[line_error(500), line_error(429), "sent"])
+
+    assert retry.call_with_retry(func, attempts=4) == "sent"
+
+    assert func.call_count == 3
+    assert retry.time.sleep.call_args_list == [
+        mock.call(retry.BASE_DELAY_SECONDS),
+        mock.call(retry.BASE_DELAY_SECONDS * 2),
+    ]
+
+
+def test_other_errors_are_not_retried():
+    func = mock.Mock(side_effect=line_error(400))
+
+    with pytest.raises(LineBotApiError):
+        retry.call_with_retry(func, attempts=4)
+
+    assert func.call_count == 1
+
+
+def test_only_conflicts_with_an_accepted_request_are_already_accepted():
+    accepted = LineBotApiError(
+        409, {}, accepted_request_id="request", error=Error(message="error")
+    )
+
+    assert retry.is_already_accepted(accepted)
+    assert not retry.is_already_accepted(line_error(409))
@@ -0,0 +1,53 @@
+from unittest import mock
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+
+@pytest.fixture
+def secret_cache(monkeypatch):
+    monkeypatch.setenv("secret_arn", "arn")
+    monkeypatch.delenv("secret_ttl_seconds", raising=False)
+    import secret_cache
+
+    monkeypatch.setattr(secret_cache, "_secrets", {})
+    monkeypatch.setattr(secret_cache, "stats", {"hits": 0, "misses": 0, "refreshes": 0})
+    versions = iter({"YOUR_CHANNEL_ACCESS_TOKEN": str(n)} for n in range(10))
+    monkeypatch.setattr(
+        secret_cache, "_fetch_secret", mock.Mock(side_effect=lambda arn: next(versions))
+    )
+    monkeypatch.setattr(secret_cache.time, "monotonic", mock.Mock(return_value=0))
+    return secret_cache
+
+
+def test_secrets_are_fetched_again_once_they_expire(secret_cache):
+    first = secret_cache.get_secret()
+    secret_cache.time.monotonic.return_value = secret_cache.DEFAULT_TTL_SECONDS - 1
+    cached = secret_cache.get_secret()
+    secret_cache.time.monotonic.return_value = secret_cache.DEFAULT_TTL_SECONDS
+    expired = secret_cache.get_secret()
+
+    assert first is cached
+    assert expired["YOUR_CHANNEL_ACCESS_TOKEN"] == "1"
+    assert secret_cache.get_stats() == {"hits": 1, "misses": 2, "refreshes": 0}
+
+
+def test_invalidated_and_refreshed_secrets_are_fetched_again(secret_cache):
+    secret_cache.get_secret()
+    secret_cache.invalidate()
+    secret_cache.get_secret()
+    refreshed = secret_cache.get_secret(force_refresh=True)
+
+    assert refreshed["YOUR_CHANNEL_ACCESS_TOKEN"] == "2"
+    assert secret_cache.get_secret() is refreshed
+    assert secret_cache.get_stats() == {"hits": 1, "misses": 2, "refreshes": 1}
+
+
+def test_calls_rejected_with_401_are_retried_with_a_refreshed_secret(secret_cache):
+    def call(secret):
+        if secret["YOUR_CHANNEL_ACCESS_TOKEN"] == "0":
+            raise LineBotApiError(401, {}, error=Error(message="Invalid token"))
+        return secret["YOUR_CHANNEL_ACCESS_TOKEN"]
+
+    assert secret_cache.call_with_secret(call) == "1"
@@ -0,0 +1,105 @@
+import json
+import logging
+from collections import OrderedDict
+from unittest import mock
+
+import pytest
+import responses
+
+MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+
+
+@pytest.fixture
+def send_bundle(monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "1")
+    monkeypatch.delenv("send_mode", raising=False)
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    monkeypatch.delenv("idempotency_table", raising=False)
+    # Imported here, as the handler opens a LINE API connection on import
+    with mock.patch("http_pool.warm_up"):
+        import sendBundle
+
+    monkeypatch.setattr(sendBundle.payload_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(sendBundle.payload_cache, "_size", 0)
+    monkeypatch.setattr(sendBundle.client_registry, "publish_stats", lambda: None)
+    monkeypatch.setattr(
+        sendBundle.dispatcher.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": "secret",
+        },
+    )
+    return sendBundle
+
+
+def event(specs, recipient_count=2):
+    return {
+        "ApplicationId": "app",
+        "CampaignId": "campaign",
+        "TreatmentId": "0",
+        "Data": {"Messages": specs},
+        "Endpoints": {
+            "U{}".format(i): {"Address": "U{}".format(i), "ChannelType": "CUSTOM"}
+            for i in range(recipient_count)
+        },
+    }
+
+
+def text(value):
+    return {"Type": "text", "Text": value}
+
+
+def test_every_chunk_of_recipients_gets_the_whole_bundle(send_bundle):
+    with responses.RequestsMock() as line_api:
+        line_api.add(responses.POST, MULTICAST_URL, json={})
+        result = send_bundle.lambda_handler(
+            event([text("New arrivals!"), text("See you soon")], 600), None
+        )
+        bodies = [json.loads(call.request.body) for call in line_api.calls]
+
+    assert result == "Line bundle Campaign successfully ran"
+    assert sorted(len(body["to"]) for body in bodies) == [100, 500]
+    for body in bodies:
+        assert [message["text"] for message in body["messages"]] == [
+            "New arrivals!",
+            "See you soon",
+        ]
+
+
+@pytest.mark.parametrize(
+    "specs",
+    [
+        [text(str(i)) for i in range(6)],
+        [text("Hi"), {"Type": "sticker"}],
+        [text("Hi"), {"Type": "bundle", "Messages": [text("Hi")]}],
+        [{"Type": "imagemap", "Alt_text": "Sale"}],
+        [],
+    ],
+)
+def test_bundles_with_an_invalid_item_are_not_sent(send_bundle, caplog, specs):
+    # No LINE API call is made, the RequestsMock would reject it
+    with responses.RequestsMock():
+        result = send_bundle.lambda_handler(event(specs), None)
+
+    assert result is None
+    assert "Invalid campaign payload" in caplog.text
+
+
+def test_failed_chunks_are_logged_and_counted(send_bundle, caplog, capsys):
+    caplog.set_level(logging.INFO)
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(
+            responses.POST,
+            MULTICAST_URL,
+            status=400,
+            json={"message": "Invalid messages"},
+            headers={"X-Line-Request-Id": "request"},
+        )
+        send_bundle.lambda_handler(event([text("Hi")]), None)
+
+    assert "Sent 0/1 chunks to 2 recipients" in caplog.text
+    assert "Chunk 0 (2 recipients) failed: 400 Invalid messages" in caplog.text
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert (record["ChunksFailed"], record["RecipientsFailed"]) == (1, 2)
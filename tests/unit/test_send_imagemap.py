@@ -0,0 +1,128 @@
+import json
+from collections import OrderedDict
+from unittest import mock
+
+import boto3
+import pytest
+import responses
+from moto import mock_aws
+
+MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+BASE_URL = "https://media.example.com/image/derived/imagemap/sale.png?Signature=s"
+AREA = {"x": 0, "y": 0, "width": 520, "height": 520}
+
+
+@pytest.fixture
+def send_imagemap(monkeypatch):
+    monkeypatch.setenv("line_api_attempts", "1")
+    monkeypatch.setenv("image_bucket", "images")
+    monkeypatch.delenv("send_mode", raising=False)
+    monkeypatch.delenv("rate_limit_table", raising=False)
+    monkeypatch.delenv("idempotency_table", raising=False)
+    # Imported here, as the handler opens a LINE API connection on import
+    with mock.patch("http_pool.warm_up"):
+        import sendImagemap
+    message_builders = sendImagemap.payload_cache.message_builders
+
+    monkeypatch.setattr(sendImagemap.payload_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(sendImagemap.payload_cache, "_size", 0)
+    monkeypatch.setattr(message_builders.media_derivatives, "_manifests", {})
+    monkeypatch.setattr(message_builders, "_urls", {})
+    monkeypatch.setattr(message_builders.media_cdn, "is_enabled", lambda: True)
+    monkeypatch.setattr(
+        message_builders.media_cdn,
+        "signed_base_url",
+        lambda kind, path, expires_in: BASE_URL,
+    )
+    monkeypatch.setattr(sendImagemap.client_registry, "publish_stats", lambda: None)
+    monkeypatch.setattr(
+        sendImagemap.dispatcher.secret_cache,
+        "get_secret",
+        lambda *args, **kwargs: {
+            "YOUR_CHANNEL_ACCESS_TOKEN": "token",
+            "YOUR_CHANNEL_SECRET": "secret",
+        },
+    )
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="images")
+        monkeypatch.setattr(message_builders, "s3", s3)
+        yield sendImagemap, s3
+
+
+def event(data):
+    return {
+        "ApplicationId": "app",
+        "CampaignId": "campaign",
+        "TreatmentId": "0",
+        "Data": data,
+        "Endpoints": {
+            user_id: {"Address": user_id, "ChannelType": "CUSTOM"}
+            for user_id in ["U1", "U2"]
+        },
+    }
+
+
+def put_manifest(s3, key):
+    s3.put_object(
+        Bucket="images",
+        Key="derived/manifest/{}.json".format(key),
+        Body=json.dumps(
+            {"base": "derived/" + key, "base_width": 1040, "base_height": 520}
+        ),
+    )
+
+
+def test_imagemaps_point_at_the_precomputed_tiles(send_imagemap):
+    sendImagemap, s3 = send_imagemap
+    put_manifest(s3, "imagemap/sale.png")
+    data = {
+        "Imagemap_bucket_key": "imagemap/sale.png",
+        "Alt_text": "Sale",
+        "Actions": [
+            {"type": "uri", "linkUri": "https://example.com", "area": AREA},
+            {"type": "message", "text": "Tell me more", "area": AREA},
+        ],
+    }
+
+    with responses.RequestsMock() as line_api:
+        line_api.add(responses.POST, MULTICAST_URL, json={})
+        result = sendImagemap.lambda_handler(event(data), None)
+        body = json.loads(line_api.calls[0].request.body)
+
+    assert result == "Line imagemap Campaign successfully ran"
+    assert body["messages"] == [
+        {
+            "type": "imagemap",
+            "baseUrl": BASE_URL,
+            "altText": "Sale",
+            "baseSize": {"width": 1040, "height": 520},
+            "actions": [
+                {"type": "uri", "linkUri": "https://example.com", "area": AREA},
+                {"type": "message", "text": "Tell me more", "area": AREA},
+            ],
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        # Uploaded elsewhere, so no tiles were written for it
+        {"Imagemap_bucket_key": "sale.png", "Actions": []},
+        {
+            "Imagemap_bucket_key": "imagemap/sale.png",
+            "Actions": [{"type": "postback", "area": AREA}],
+        },
+        {"Imagemap_bucket_key": "imagemap/sale.png"},
+    ],
+)
+def test_imagemaps_without_tiles_or_with_unknown_actions_are_not_sent(
+    send_imagemap, data
+):
+    sendImagemap, s3 = send_imagemap
+    put_manifest(s3, "imagemap/sale.png")
+
+    # No LINE API call is made, the RequestsMock would reject it
+    with responses.RequestsMock():
+        assert sendImagemap.lambda_handler(event(data), None) is None
@@ -0,0 +1,93 @@
+import json
+from collections import OrderedDict
+from unittest import mock
+
+import boto3
+import pytest
+import responses
+from moto import mock_aws
+
+
+@pytest.fixture
+def send_text(monkeypatch):
+    monkeypatch.setenv("send_mode", "async")
+    with mock_aws():
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="send")["QueueUrl"]
+        monkeypatch.setenv("send_queue_url", queue_url)
+        # Imported here, as the handler opens a LINE API connection on import
+        with mock.patch("http_pool.warm_up"):
+            import sendText
+
+        monkeypatch.setattr(
+            sendText.client_registry, "get_aws_client", lambda name: sqs
+        )
+        monkeypatch.setattr(sendText.payload_cache, "_entries", OrderedDict())
+        monkeypatch.setattr(sendText.payload_cache, "_size", 0)
+        yield sendText, sqs, queue_url
+
+
+def event(*user_ids):
+    return {
+        "ApplicationId": "app",
+        "CampaignId": "campaign",
+        "TreatmentId": "0",
+        "Data": "Hello",
+        "Endpoints": {
+            user_id: {"Address": user_id, "ChannelType": "CUSTOM"}
+            for user_id in user_ids
+        },
+    }
+
+
+def queued_jobs(sqs, queue_url):
+    response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+    return [json.loads(message["Body"]) for message in response.get("Messages", [])]
+
+
+def test_queued_campaigns_are_left_to_the_worker(send_text):
+    sendText, sqs, queue_url = send_text
+
+    # No LINE API call is made, the RequestsMock would reject it
+    with responses.RequestsMock():
+        result = sendText.lambda_handler(event("U1", "U2"), None)
+
+    assert result == "Line Text Campaign successfully queued"
+    jobs = queued_jobs(sqs, queue_url)
+    assert [(job["Kind"], job["Recipients"]) for job in jobs] == [
+        ("text", ["U1", "U2"])
+    ]
+
+
+def test_jobs_of_the_same_campaign_are_merged(send_text):
+    sendText, sqs, queue_url = send_text
+    sendText.lambda_handler(event("U1"), None)
+    sendText.lambda_handler(event("U2", "U3"), None)
+
+    first, second = queued_jobs(sqs, queue_url)
+
+    assert sendText.send_queue.job_key(first) == sendText.send_queue.job_key(second)
+
+
+def test_messages_are_built_once_for_the_queued_jobs_of_a_campaign(
+    send_text, monkeypatch
+):
+    sendText, sqs, queue_url = send_text
+    build_message = mock.Mock(
+        wraps=sendText.payload_cache.message_builders.build_message
+    )
+    monkeypatch.setattr(
+        sendText.payload_cache.message_builders, "build_message", build_message
+    )
+
+    sendText.lambda_handler(event("U1"), None)
+    sendText.lambda_handler(event("U2"), None)
+
+    build_message.assert_called_once_with("text", "Hello")
+
+
+def test_invalid_campaigns_are_not_queued(send_text):
+    sendText, sqs, queue_url = send_text
+
+    assert sendText.lambda_handler(event(), None) is None
+    assert queued_jobs(sqs, queue_url) == []
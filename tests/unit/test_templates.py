@@ -0,0 +1,85 @@
+from collections import OrderedDict
+
+import pytest
+
+
+@pytest.fixture
+def templates(monkeypatch):
+    import templates
+
+    monkeypatch.setattr(templates, "_compiled", OrderedDict())
+    monkeypatch.setattr(templates, "stats", {"hits": 0, "misses": 0})
+    return templates
+
+
+def endpoint(user_id, locale=None, display_name=None):
+    endpoint = {"Address": user_id, "User": {"UserId": user_id}}
+    if locale:
+        endpoint["Demographic"] = {"Locale": locale}
+    if display_name:
+        endpoint["User"]["UserAttributes"] = {"DisplayName": [display_name]}
+    return endpoint
+
+
+@pytest.mark.parametrize(
+    "data, personalized",
+    [
+        ("Hi", False),
+        ({"Text": "Hi", "Audience": "segment"}, False),
+        (None, False),
+        ("Hi {{User.UserAttributes.DisplayName}}", True),
+        ({"Text": {"default": "Hi"}}, True),
+        ({"Text": {"ja": "こんにちは"}}, True),
+    ],
+)
+def test_locale_maps_and_placeholders_are_personalized(templates, data, personalized):
+    assert templates.is_personalized(data) is personalized
+
+
+def test_recipients_with_the_same_rendered_text_are_grouped(templates):
+    data = {
+        "Text": {
+            "default": "Hi {{User.UserAttributes.DisplayName|there}}",
+            "ja": "こんにちは {{User.UserAttributes.DisplayName|皆さん}}",
+        }
+    }
+    endpoints = {
+        "U1": endpoint("U1", "ja_JP", "Aki"),
+        "U2": endpoint("U2", "en_US"),
+        "U3": endpoint("U3"),
+        "U4": endpoint("U4", "ja-JP"),
+    }
+
+    groups = templates.render_groups(endpoints, data, "campaign")
+
+    assert [(message.text, recipients) for message, recipients in groups] == [
+        ("こんにちは Aki", ["U1"]),
+        ("Hi there", ["U2", "U3"]),
+        ("こんにちは 皆さん", ["U4"]),
+    ]
+
+
+def test_a_single_locale_is_used_for_every_recipient(templates):
+    groups = templates.render_groups(
+        {"U1": endpoint("U1", "en_US")}, {"Text": {"ja": "こんにちは"}}, "campaign"
+    )
+
+    assert [(message.text, recipients) for message, recipients in groups] == [
+        ("こんにちは", ["U1"])
+    ]
+
+
+def test_templates_are_compiled_once_per_campaign(templates):
+    templates.get_template("campaign", "Hi")
+    template = templates.get_template("campaign", "changed")
+
+    assert template.render(endpoint("U1")) == "Hi"
+    assert templates.get_stats() == {"hits": 1, "misses": 1}
+
+
+def test_text_messages_never_carry_a_locale_map(templates):
+    import message_builders
+
+    message = message_builders.build_text_message({"Text": {"default": "Hi"}})
+
+    assert message.text == "Hi"